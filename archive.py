@@ -0,0 +1,266 @@
+"""
+Content-addressed archive of scraped guild profile pages and the rosters parsed from them.
+
+Pages and rosters are cut into chunks at content-defined boundaries (line and list item ends), and every chunk is stored
+once, compressed, in an append-only pack file. Two snapshots that differ in a few members thus share all but a few
+chunks, so the archive grows with the number of roster changes rather than with the number of refreshes. An identical
+snapshot adds nothing but a row in the index. Chunks are read back through a memory map of the pack file.
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+from db_handler import PRAGMAS
+
+# Content-defined boundaries: after a line or a list item, so one member joining only changes the chunk around it
+BOUNDARY = re.compile(rb'(?<=\n)|(?<=</li>)')
+
+# A chunk ends after a piece whose checksum has these bits unset, making chunks 16 pieces long on average
+CHUNK_MASK = 0xF
+
+# Chunks are never longer than this, long pieces (e.g. minified pages without line breaks) are cut
+MAX_CHUNK = 64 * 1024
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chunks(digest BLOB PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL)
+        WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS objects(digest BLOB PRIMARY KEY, size INTEGER NOT NULL, chunks BLOB NOT NULL)
+        WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS snapshots(
+        id INTEGER PRIMARY KEY,
+        timestamp TEXT NOT NULL,
+        page BLOB NOT NULL,
+        roster BLOB NOT NULL,
+        members INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_snapshots_timestamp ON snapshots(timestamp);
+"""
+
+
+def split_chunks(data):
+    """
+    Cuts data into chunks at content-defined boundaries.
+
+    :param data: Bytes to cut.
+    :return: List of chunks (bytes), together exactly the data.
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for piece in BOUNDARY.split(data):
+        for start in range(0, len(piece), MAX_CHUNK):
+            part = piece[start:start + MAX_CHUNK]
+            chunk.append(part)
+            size += len(part)
+            if zlib.crc32(part) & CHUNK_MASK == 0 or size >= MAX_CHUNK:
+                chunks.append(b''.join(chunk))
+                chunk = []
+                size = 0
+    if chunk:
+        chunks.append(b''.join(chunk))
+    return chunks
+
+
+def serialise_roster(roster):
+    """
+    :param roster: List of (name, link to family page) tuples, optionally followed by rank.
+    :return: Bytes with a member per line.
+    """
+    return ''.join(json.dumps(list(member), ensure_ascii=False) + '\n' for member in roster).encode()
+
+
+def deserialise_roster(data):
+    """
+    :param data: Bytes made by serialise_roster.
+    :return: List of member tuples.
+    """
+    return [tuple(json.loads(line)) for line in data.decode().splitlines()]
+
+
+class SnapshotArchive:
+    """
+    Archive of (timestamp, page, roster) snapshots, stored in a directory as a pack file with an SQLite index.
+    Safe to share between threads.
+    """
+
+    def __init__(self, directory, level=6):
+        """
+        :param directory: Directory to keep the archive in, created if it does not exist.
+        :param level: zlib compression level of chunks.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.level = level
+        self.lock = threading.RLock()
+        self.index = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        for pragma, value in PRAGMAS:
+            self.index.execute(f"PRAGMA {pragma} = {value}")
+        self.index.executescript(SCHEMA)
+        self.pack = open(os.path.join(directory, 'chunks.pack'), 'a+b')
+        # Memory map of the pack file, remapped once it has grown past the mapped part
+        self.map = None
+
+    def put(self, data):
+        """
+        Stores data, unless it is stored already.
+
+        :param data: Bytes to store.
+        :return: SHA-256 digest (bytes) of the data, by which it can be retrieved.
+        """
+        digest = hashlib.sha256(data).digest()
+        with self.lock:
+            if self.index.execute("SELECT 1 FROM objects WHERE digest = ?", (digest,)).fetchone():
+                return digest
+            chunks = split_chunks(data)
+            digests = [hashlib.sha256(chunk).digest() for chunk in chunks]
+            known = set()
+            # Look up which chunks are stored already in batches, keeping below SQLite's limit on parameters
+            for start in range(0, len(digests), 500):
+                batch = digests[start:start + 500]
+                known.update(row[0] for row in self.index.execute(
+                    f"SELECT digest FROM chunks WHERE digest IN ({','.join('?' * len(batch))})", batch))
+
+            # Append new chunks to the pack before indexing them, so the index never points past the pack
+            self.pack.seek(0, os.SEEK_END)
+            offset = self.pack.tell()
+            new_chunks = []
+            for chunk, chunk_digest in zip(chunks, digests):
+                if chunk_digest in known:
+                    continue
+                known.add(chunk_digest)
+                compressed = zlib.compress(chunk, self.level)
+                self.pack.write(compressed)
+                new_chunks.append((chunk_digest, offset, len(compressed)))
+                offset += len(compressed)
+            self.pack.flush()
+            with self.index:
+                self.index.executemany("INSERT INTO chunks(digest, offset, length) VALUES(?,?,?)", new_chunks)
+                self.index.execute("INSERT INTO objects(digest, size, chunks) VALUES(?,?,?)",
+                                   (digest, len(data), b''.join(digests)))
+        return digest
+
+    def get(self, digest):
+        """
+        Retrieves stored data.
+
+        :param digest: SHA-256 digest of the data, as returned by put.
+        :return: Bytes, None if nothing is stored under the digest.
+        """
+        with self.lock:
+            row = self.index.execute("SELECT chunks FROM objects WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            digests = [row[0][idx:idx + 32] for idx in range(0, len(row[0]), 32)]
+            # Empty data has no chunks, and the pack file may still be empty, which cannot be mapped
+            if not digests:
+                return b''
+            locations = {}
+            for start in range(0, len(digests), 500):
+                batch = digests[start:start + 500]
+                locations.update((chunk_digest, (offset, length)) for chunk_digest, offset, length in self.index.execute(
+                    f"SELECT digest, offset, length FROM chunks WHERE digest IN ({','.join('?' * len(batch))})", batch))
+            pack = self.mapped(max(offset + length for offset, length in locations.values()))
+            return b''.join(zlib.decompress(pack[offset:offset + length])
+                            for offset, length in (locations[chunk_digest] for chunk_digest in digests))
+
+    def mapped(self, end):
+        """
+        :param end: Offset up to which the pack file has to be readable.
+        :return: Memory map of the pack file.
+        """
+        if self.map is None or len(self.map) < end:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.pack.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def store(self, timestamp, page, roster):
+        """
+        Archives a snapshot.
+
+        :param timestamp: Datetime the page was fetched at.
+        :param page: Page as fetched (str or bytes).
+        :param roster: List of (name, link to family page) tuples parsed from the page.
+        :return: Tuple of the digests of the page and the roster.
+        """
+        page_digest = self.put(page.encode() if isinstance(page, str) else page)
+        roster_digest = self.put(serialise_roster(roster))
+        with self.lock, self.index:
+            self.index.execute("INSERT INTO snapshots(timestamp, page, roster, members) VALUES(?,?,?,?)",
+                               (timestamp.strftime('%Y-%m-%d %H:%M:%S'), page_digest, roster_digest, len(roster)))
+        return page_digest, roster_digest
+
+    def snapshots(self, since=None, until=None):
+        """
+        Lists archived snapshots, oldest first.
+
+        :param since: (Optional) Datetime from which to list snapshots.
+        :param until: (Optional) Datetime up to (and including) which to list snapshots.
+        :return: List of (datetime, page digest, roster digest, number of members) tuples.
+        """
+        since = (since or datetime.min).strftime('%Y-%m-%d %H:%M:%S')
+        until = (until or datetime.max).strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            rows = self.index.execute("SELECT timestamp, page, roster, members FROM snapshots "
+                                      "WHERE timestamp >= ? AND timestamp <= ? ORDER BY timestamp, id",
+                                      (since, until)).fetchall()
+        return [(datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S'), page, roster, members)
+                for timestamp, page, roster, members in rows]
+
+    def page(self, digest):
+        """
+        :param digest: Digest of an archived page.
+        :return: The page (str).
+        """
+        return self.get(digest).decode(errors='replace')
+
+    def roster(self, digest):
+        """
+        :param digest: Digest of an archived roster.
+        :return: List of member tuples.
+        """
+        return deserialise_roster(self.get(digest))
+
+    def replay(self, since=None, until=None):
+        """
+        Reads back the archived rosters in order. A roster shared by consecutive snapshots is only read once.
+
+        :param since: (Optional) Datetime from which to replay.
+        :param until: (Optional) Datetime up to which to replay.
+        :return: Generator of (datetime, roster) tuples.
+        """
+        previous_digest = roster = None
+        for timestamp, _, roster_digest, _ in self.snapshots(since, until):
+            if roster_digest != previous_digest:
+                roster = self.roster(roster_digest)
+                previous_digest = roster_digest
+            yield timestamp, roster
+
+    def stats(self):
+        """
+        :return: Dictionary with the number of snapshots, distinct objects and chunks, the total size of all
+                 snapshots and the size of the pack file in bytes.
+        """
+        with self.lock:
+            snapshots, = self.index.execute("SELECT COUNT(*) FROM snapshots").fetchone()
+            objects, = self.index.execute("SELECT COUNT(*) FROM objects").fetchone()
+            chunks, = self.index.execute("SELECT COUNT(*) FROM chunks").fetchone()
+            archived, = self.index.execute("SELECT COALESCE(SUM(o.size), 0) FROM snapshots s "
+                                           "JOIN objects o ON o.digest IN (s.page, s.roster)").fetchone()
+            self.pack.seek(0, os.SEEK_END)
+            return {'snapshots': snapshots, 'objects': objects, 'chunks': chunks, 'archived_bytes': archived,
+                    'pack_bytes': self.pack.tell()}
+
+    def close(self):
+        """ Closes the pack file and index. """
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.pack.close()
+            self.index.close()
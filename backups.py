@@ -0,0 +1,171 @@
+import glob
+import gzip
+import hashlib
+import os
+from datetime import datetime
+from time import perf_counter
+
+# Size of the pieces backups are compressed, hashed and decompressed in, so memory use does not grow with the database
+CHUNK_SIZE = 1024 * 1024
+
+
+def copy_chunked(source, target):
+    """
+    Copies one file object to another in chunks.
+
+    :param source: File object to read from.
+    :param target: File object to write to.
+    :return: Number of bytes copied.
+    """
+    copied = 0
+    while chunk := source.read(CHUNK_SIZE):
+        target.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def file_digest(location):
+    """
+    :param location: Location of a file.
+    :return: Hexadecimal SHA-256 digest of its contents.
+    """
+    digest = hashlib.sha256()
+    with open(location, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def throughput(size, seconds):
+    """
+    :param size: Number of bytes processed.
+    :param seconds: Seconds it took.
+    :return: MiB per second, None if it took no measurable time.
+    """
+    return round(size / 1024 / 1024 / seconds, 1) if seconds else None
+
+
+class Backups:
+    """
+    Rotating, gzip compressed backups of the database in a directory.
+    Backups are hot copies made with SQLite's online backup API, named after the moment they were made. A backup of a
+    database that did not change since the previous backup is not kept, so frequent backups cost little disk space.
+    """
+
+    def __init__(self, db, directory, keep=7, prefix='roster', pages=1024, level=1):
+        """
+        :param db: DB_Handler of the database to back up.
+        :param directory: Directory to keep backups in, created if it does not exist.
+        :param keep: Number of most recent backups to keep, older ones are removed.
+        :param prefix: Start of the file names of backups.
+        :param pages: Number of database pages copied per step of the online backup.
+        :param level: gzip compression level, compressing takes most of the time of a backup, so it defaults to fastest.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.db = db
+        self.directory = directory
+        self.keep = keep
+        self.prefix = prefix
+        self.pages = pages
+        self.level = level
+
+    def list(self):
+        """
+        :return: List of the locations of all backups, oldest first.
+        """
+        return sorted(glob.glob(os.path.join(glob.escape(self.directory), f'{glob.escape(self.prefix)}-*.db.gz')))
+
+    def create(self):
+        """
+        Backs up the database, unless it did not change since the latest backup, and removes backups beyond the
+        number to keep.
+
+        :return: Dictionary with the location of the backup, whether it was skipped, the size of the database and of
+                 the backup in bytes, the seconds taken by copying and by compressing and the throughput in MiB/s.
+        """
+        started = perf_counter()
+        location = os.path.join(self.directory, f'{self.prefix}-{datetime.now():%Y%m%d-%H%M%S}.db.gz')
+        # Copy to an uncompressed file first, compressing while copying would hold up the online backup
+        copy = f'{location}.tmp'
+        try:
+            self.db.backup(copy, self.pages)
+            copied = perf_counter()
+            size = os.path.getsize(copy)
+            digest = file_digest(copy)
+
+            backups = self.list()
+            if backups and self.read_digest(backups[-1]) == digest:
+                seconds = perf_counter() - started
+                return {'backup': backups[-1], 'skipped': True, 'bytes': size, 'compressed_bytes': None,
+                        'copy_seconds': round(copied - started, 3), 'compress_seconds': None,
+                        'seconds': round(seconds, 3), 'mib_per_second': throughput(size, seconds)}
+
+            # Compress under a temporary name, so an interrupted backup never looks like a complete one
+            with open(copy, 'rb') as source, gzip.open(f'{location}.part', 'wb', compresslevel=self.level) as target:
+                copy_chunked(source, target)
+            os.replace(f'{location}.part', location)
+            with open(f'{location}.sha256', 'w') as digest_file:
+                digest_file.write(digest)
+        finally:
+            for leftover in (copy, f'{location}.part'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        self.prune()
+        seconds = perf_counter() - started
+        return {'backup': location, 'skipped': False, 'bytes': size, 'compressed_bytes': os.path.getsize(location),
+                'copy_seconds': round(copied - started, 3), 'compress_seconds': round(seconds - (copied - started), 3),
+                'seconds': round(seconds, 3), 'mib_per_second': throughput(size, seconds)}
+
+    def restore(self, location=None):
+        """
+        Replaces the contents of the database by a backup. The backup is decompressed in chunks to a temporary file
+        next to it, which is checked before anything is replaced.
+
+        :param location: (Optional) Location of the backup, defaults to the latest.
+        :return: Dictionary with the location of the backup, the size of the restored database in bytes, the seconds
+                 taken and the throughput in MiB/s.
+        """
+        if location is None:
+            backups = self.list()
+            if not backups:
+                raise FileNotFoundError(f'No backups in {self.directory}!')
+            location = backups[-1]
+        started = perf_counter()
+        copy = f'{location}.restore.tmp'
+        try:
+            with gzip.open(location, 'rb') as source, open(copy, 'wb') as target:
+                size = copy_chunked(source, target)
+            self.db.restore(copy, self.pages)
+        finally:
+            if os.path.exists(copy):
+                os.remove(copy)
+        seconds = perf_counter() - started
+        return {'backup': location, 'bytes': size, 'seconds': round(seconds, 3),
+                'mib_per_second': throughput(size, seconds)}
+
+    def prune(self):
+        """
+        Removes the oldest backups beyond the number to keep.
+
+        :return: List of removed backups.
+        """
+        backups = self.list()
+        removed = backups[:max(len(backups) - self.keep, 0)]
+        for location in removed:
+            os.remove(location)
+            if os.path.exists(f'{location}.sha256'):
+                os.remove(f'{location}.sha256')
+        return removed
+
+    @staticmethod
+    def read_digest(location):
+        """
+        :param location: Location of a backup.
+        :return: Digest of the uncompressed backup, None if it is not known.
+        """
+        try:
+            with open(f'{location}.sha256') as digest_file:
+                return digest_file.read().strip()
+        except FileNotFoundError:
+            return None
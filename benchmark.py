@@ -0,0 +1,593 @@
+"""
+Micro-benchmarks of the roster update path: parse -> diff -> persist -> render, and of starting the bot.
+
+Everything runs offline, on synthetic guild profile pages written to disk and on pre-seeded SQLite databases of
+configurable size. Every stage is timed and its peak (Python) memory use is measured separately. Results can be stored
+as JSON and compared to a stored baseline, failing when a stage got slower or hungrier than allowed.
+
+Refreshing many tenants at once is benchmarked against a local stand-in for the Pearl Abyss website, measuring the
+throughput of refreshes and the memory kept per tenant. Crawling the family pages of a guild is benchmarked against the
+same stand-in, one page at a time and concurrently, followed by an incremental crawl after the roster changed.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --threshold 1.5
+    python benchmark.py --sizes 1000 --tenants 200 --concurrency 8
+    python benchmark.py --sizes 100 --profiles 500 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+from crawler import ProfileCrawler
+from formatter import Formatter
+from sage import Sage
+from scraper import PA_Scraper
+from tenants import Tenant, Tenants
+from workers import Workers
+
+# Numbers of guild members to benchmark with
+SIZES = (100, 1000, 10000)
+
+# Share of the roster that joins, leaves or changes page between two updates
+TURNOVER = 0.05
+
+# Number of timed runs per stage, the median of which is reported
+REPEAT = 5
+
+# A stage regresses when it takes more than this many times its baseline
+THRESHOLD = 1.5
+
+# Differences smaller than these are noise rather than regressions
+MIN_DIFFERENCE_MS = 1.0
+MIN_DIFFERENCE_KIB = 64.0
+
+# Run in a fresh interpreter to time importing the bot and opening its database, without connecting to Discord
+STARTUP_SCRIPT = """
+import asyncio, json, roster_bot
+from time import perf_counter
+imported = perf_counter() - roster_bot.started
+roster_bot.configure()
+asyncio.run(roster_bot.setup())
+print(json.dumps({'import': imported, 'setup': perf_counter() - roster_bot.started}))
+roster_bot.workers.shutdown()
+roster_bot.sage.close()
+"""
+
+PROFILE_URL = 'https://www.naeu.playblackdesert.com/en-US/Adventure/Profile?profileTarget='
+
+# Members per guild, and seconds the stand-in server takes to answer, when benchmarking tenants
+TENANT_SIZE = 100
+TENANT_LATENCY = 0.05
+
+# Requests per second the crawler may send the stand-in server, and seconds the server takes to answer a family page
+PROFILE_RATE = 200.0
+PROFILE_LATENCY = 0.05
+
+
+def synthetic_roster(size, seed=0):
+    """
+    Makes up a roster of unique family names with links to their family pages.
+
+    :param size: Number of members.
+    :param seed: Seed of the random generator, the same seed gives the same roster.
+    :return: List of (name, link to family page) tuples.
+    """
+    rng = random.Random(seed)
+    syllables = ['ka', 'ri', 'mo', 'zen', 'tha', 'el', 'dor', 'vi', 'ash', 'lu', 'nor', 'qi', 'sar', 'ul', 'bre']
+    names = set()
+    while len(names) < size:
+        name = ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 5))).capitalize()
+        if rng.random() < 0.3:
+            name += str(rng.randint(1, 999))
+        names.add(name)
+    return [(name, f'{PROFILE_URL}{rng.getrandbits(96):024x}%3d') for name in sorted(names, key=lambda _: rng.random())]
+
+
+def churned_roster(roster, turnover=TURNOVER, seed=1):
+    """
+    Derives the roster of a next update: some members left, others joined and some got a new family page.
+
+    :param roster: List of (name, link to family page) tuples.
+    :param turnover: Share of the roster that leaves, and (separately) joins and changes page.
+    :param seed: Seed of the random generator.
+    :return: List of (name, link to family page) tuples.
+    """
+    rng = random.Random(seed)
+    count = int(len(roster) * turnover)
+    left = set(rng.sample(range(len(roster)), count))
+    moved = set(rng.sample(range(len(roster)), count)) - left
+    new_roster = [(name, f'{PROFILE_URL}{rng.getrandbits(96):024x}%3d' if idx in moved else page)
+                  for idx, (name, page) in enumerate(roster) if idx not in left]
+    names = {name for name, _ in roster}
+    new_roster += [member for member in synthetic_roster(count * 2, seed + 1) if member[0] not in names][:count]
+    return new_roster
+
+
+def guild_page_html(guild, roster):
+    """
+    Renders a guild profile page with the same structure as the one hosted by Pearl Abyss.
+
+    :param guild: Guild name.
+    :param roster: List of (name, link to family page) tuples.
+    :return: HTML string.
+    """
+    items = ''.join(f'<li><div class="user_info"><span class="info"><span class="text">'
+                    f'<a href="{page}">{name}</a></span></span></div>'
+                    f'<div class="guild_info"><span>Lv. {idx % 60}</span></div></li>\n'
+                    for idx, (name, page) in enumerate(roster))
+    # Real pages carry plenty of markup around the member list, which the parser has to read past (or skip)
+    head = ''.join(f'<script>var config{idx} = {{"key": "<ul>{idx}</ul>"}};</script>\n' for idx in range(50))
+    footer = ''.join(f'<li><a href="/en-US/News/{idx}">News {idx}</a></li>\n' for idx in range(200))
+    return (f'<!DOCTYPE html><html><head><title>{guild}</title>{head}</head><body>'
+            f'<div class="container"><h2 class="guild_name">{guild}</h2><br>'
+            f'<ul class="adventure_list_table">{items}</ul></div>'
+            f'<footer><ul>{footer}</ul></footer></body></html>')
+
+
+def family_page_html(name, characters=6):
+    """
+    Renders a family profile page with the details the crawler reads from it.
+
+    :param name: Family name.
+    :param characters: Number of characters of the family.
+    :return: HTML string.
+    """
+    items = ''.join(f'<li><div class="character_desc_area"><p class="character_title">{name}{idx}</p>'
+                    f'<span class="character_symbol"><em>Class{idx}</em></span>'
+                    f'<div class="character_info"><span class="level">Lv. {50 + idx}</span></div></div></li>\n'
+                    for idx in range(characters))
+    footer = ''.join(f'<li><a href="/en-US/News/{idx}">News {idx}</a></li>\n' for idx in range(200))
+    return (f'<!DOCTYPE html><html><head><title>{name}</title></head><body>'
+            f'<div class="profile_detail"><p class="nick">{name}</p><ul class="line_list">'
+            f'<li class="guild"><span class="desc"><a href="/en-US/Adventure/Guild">Benchmark</a></span></li>'
+            f'<li class="created"><span class="desc">2019-03-01</span></li>'
+            f'<li class="contribution"><span class="desc">{len(name) * 17}</span></li></ul></div>'
+            f'<ul class="character_list">{items}</ul><footer><ul>{footer}</ul></footer></body></html>')
+
+
+def seed_database(db_file, roster):
+    """
+    Creates a roster database holding the given roster.
+
+    :param db_file: Location of the database to create.
+    :param roster: List of (name, link to family page) tuples.
+    """
+    sage = Sage(db_file)
+    sage.compare_guild_members(roster)
+    sage.close()
+
+
+def measure(setup, repeat=REPEAT):
+    """
+    Times a stage and measures its peak memory use.
+
+    :param setup: Function without arguments preparing a run, returning the function to run and a cleanup function.
+                  Neither preparing nor cleaning up is measured.
+    :param repeat: Number of timed runs.
+    :return: Dictionary with median and minimum milliseconds and peak KiB allocated by Python.
+    """
+    timings = []
+    for _ in range(repeat):
+        run, cleanup = setup()
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+        cleanup()
+
+    # Tracing allocations slows everything down, so memory is measured in a run of its own
+    run, cleanup = setup()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        cleanup()
+    return {'median_ms': round(statistics.median(timings), 3), 'min_ms': round(min(timings), 3),
+            'peak_kib': round(peak / 1024, 1)}
+
+
+def nothing():
+    pass
+
+
+def benchmark_size(size, workdir, repeat=REPEAT, turnover=TURNOVER, parser=None):
+    """
+    Benchmarks every stage for a roster of a given size.
+
+    :param size: Number of guild members.
+    :param workdir: Directory to write pages and databases to.
+    :param repeat: Number of timed runs per stage.
+    :param turnover: Share of the roster changing between updates.
+    :param parser: (Optional) Roster parser backend, defaults to the fastest available.
+    :return: Dictionary with results per stage.
+    """
+    guild = 'Benchmark'
+    old_roster = synthetic_roster(size)
+    new_roster = churned_roster(old_roster, turnover)
+
+    # The page of the next update is read from disk, exactly as disk_update does
+    html_loc = os.path.join(workdir, f'guild_{size}.html')
+    with open(html_loc, 'w') as html_file:
+        html_file.write(guild_page_html(guild, new_roster))
+    seeded = os.path.join(workdir, f'seeded_{size}.db')
+    seed_database(seeded, old_roster)
+
+    scraper = PA_Scraper(guild, 'EU', parser=parser)
+    parsed = scraper.parse_roster(html_loc)
+    if parsed != new_roster:
+        raise RuntimeError(f'Parsed roster of {size} members does not match the generated one!')
+
+    def fresh_sage():
+        # Every run starts from the seeded database, so each one applies the same changes
+        db_file = os.path.join(workdir, f'run_{size}.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+        shutil.copyfile(seeded, db_file)
+        return Sage(db_file)
+
+    sage = fresh_sage()
+    old_members = sage.stored_members()
+    diff = sage.diff_roster(old_members, parsed)
+    changes = sage.apply_diff(diff)
+    last_update = sage.last_update
+    sage.close()
+
+    def setup_persist():
+        run_sage = fresh_sage()
+        return (lambda: run_sage.apply_diff(diff)), run_sage.close
+
+    def render():
+        # A new formatter has an empty render cache, so the pages are rendered in full
+        formatter = Formatter()
+        formatter.format_roster(guild, parsed)
+        formatter.format_roster_changes(guild, last_update, changes)
+
+    results = {
+        'parse': measure(lambda: ((lambda: scraper.parse_roster(html_loc)), nothing), repeat),
+        'diff': measure(lambda: ((lambda: sage.diff_roster(old_members, parsed)), nothing), repeat),
+        'persist': measure(setup_persist, repeat),
+        'render': measure(lambda: (render, nothing), repeat),
+    }
+    results['changes'] = len(changes)
+    return results
+
+
+def benchmark_startup(workdir, repeat=REPEAT):
+    """
+    Times starting the bot in a fresh interpreter: importing it, and getting ready to connect (reading the
+    configuration and opening the database).
+
+    :param workdir: Directory to put the database in.
+    :param repeat: Number of starts.
+    :return: Dictionary with results per phase.
+    """
+    db_file = os.path.join(workdir, 'startup.db')
+    env = {**os.environ, 'DISCORD_TOKEN': 'benchmark', 'ADMIN_IDS': '0', 'PERMITTED_ROLE_IDS': '0',
+           'SERVICED_CHANNELS': 'roster', 'GUILD_NAME': 'Benchmark', 'REGION': 'EU', 'DB': db_file}
+    # The first start creates the database, later starts find it migrated already, as after a restart
+    timings = {'import': [], 'setup': []}
+    for _ in range(repeat + 1):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        phases = json.loads(output.strip().splitlines()[-1])
+        for phase, seconds in phases.items():
+            timings[phase].append(seconds * 1000)
+    return {phase: {'median_ms': round(statistics.median(times[1:]), 3), 'min_ms': round(min(times[1:]), 3)}
+            for phase, times in timings.items()}
+
+
+async def tenant_rounds(count, workdir, size, repeat, turnover, concurrency, latency, trace=False):
+    """
+    Refreshes a number of tenants, each following a guild of its own, in rounds against a local stand-in server: a cold
+    round opening every tenant and applying its full roster, rounds in which every roster changed and rounds in which
+    none did.
+
+    :param count: Number of tenants.
+    :param workdir: Directory to put the databases in.
+    :param size: Number of members per guild.
+    :param repeat: Number of rounds with and without changes.
+    :param turnover: Share of every roster changing between rounds with changes.
+    :param concurrency: Maximum number of requests in flight at once.
+    :param latency: Seconds the stand-in server takes to answer a request.
+    :param trace: Whether to only run the cold round, measuring the memory kept by Python per tenant.
+    :return: Dictionary with milliseconds per round by kind of round, or KiB per tenant if tracing.
+    """
+    from aiohttp import web
+    rosters = [synthetic_roster(size, seed) for seed in range(count)]
+    variants = [[guild_page_html(f'Guild{idx}', roster) for idx, roster in enumerate(rosters)],
+                [guild_page_html(f'Guild{idx}', churned_roster(roster, turnover, idx + 1))
+                 for idx, roster in enumerate(rosters)]]
+    served = variants[0]
+
+    async def guild_profile(request):
+        await asyncio.sleep(latency)
+        return web.Response(text=served[int(request.query['guildName'][5:])], content_type='text/html')
+    app = web.Application()
+    app.router.add_get('/en-US/Adventure/Guild/GuildProfile', guild_profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    os.makedirs(workdir, exist_ok=True)
+    workers = Workers()
+    registry = Sage(os.path.join(workdir, 'registry.db'))
+    tenants = Tenants(registry.db, os.path.join(workdir, 'tenants'), workers, f'http://127.0.0.1:{port}', concurrency)
+    for idx in range(count):
+        await tenants.configure(Tenant(idx + 1, f'Guild{idx}', 'EU', roster_channel=1))
+
+    async def refresh(tenant):
+        refreshed = await tenant.refresh(workers)
+        return None if refreshed is None else refreshed[1]
+
+    async def refresh_round(changed):
+        for tenant in tenants.tenants.values():
+            tenant.due = 0.0
+        start = time.perf_counter()
+        refreshed = await tenants.refresh_due(refresh)
+        milliseconds = (time.perf_counter() - start) * 1000
+        if len(refreshed) != count or any((changes is None) == changed for changes in refreshed.values()):
+            raise RuntimeError('Not every tenant was refreshed as expected!')
+        return milliseconds
+
+    try:
+        if trace:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            await refresh_round(True)
+            kept = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            return {'kib_per_tenant': round(kept / count / 1024, 1)}
+        timings = {'cold': [await refresh_round(True)], 'changed': [], 'unchanged': []}
+        for run in range(repeat):
+            served = variants[(run + 1) % 2]
+            timings['changed'].append(await refresh_round(True))
+            timings['unchanged'].append(await refresh_round(False))
+        return timings
+    finally:
+        await tenants.close_session()
+        workers.shutdown()
+        tenants.close()
+        registry.close()
+        await runner.cleanup()
+
+
+def benchmark_tenants(count, workdir, size=TENANT_SIZE, repeat=REPEAT, turnover=TURNOVER, concurrency=8,
+                      latency=TENANT_LATENCY):
+    """
+    Benchmarks refreshing many tenants at once, see tenant_rounds.
+
+    :param count: Number of tenants.
+    :param workdir: Directory to put the databases in.
+    :param size: Number of members per guild.
+    :param repeat: Number of rounds with and without changes.
+    :param turnover: Share of every roster changing between rounds with changes.
+    :param concurrency: Maximum number of requests in flight at once.
+    :param latency: Seconds the stand-in server takes to answer a request.
+    :return: Dictionary with results per kind of round, refreshes per second and memory kept per tenant.
+    """
+    timings = asyncio.run(tenant_rounds(count, os.path.join(workdir, 'timed'), size, repeat, turnover, concurrency,
+                                        latency))
+    # Tracing allocations slows everything down, so memory is measured in a run of its own
+    memory = asyncio.run(tenant_rounds(count, os.path.join(workdir, 'traced'), size, repeat, turnover, concurrency,
+                                       latency, trace=True))
+    results = {kind: {'median_ms': round(statistics.median(times), 3), 'min_ms': round(min(times), 3)}
+               for kind, times in timings.items()}
+    for result in results.values():
+        result['per_second'] = round(count / result['median_ms'] * 1000, 1)
+    results.update(memory)
+    results['tenants'] = count
+    return results
+
+
+async def profile_crawls(size, workdir, turnover, concurrency, rate, latency):
+    """
+    Crawls the family pages of a guild against a local stand-in server: one page at a time, concurrently, and
+    incrementally after the roster changed.
+
+    :param size: Number of members of the guild.
+    :param workdir: Directory to put the databases in.
+    :param turnover: Share of the roster changing before the incremental crawl.
+    :param concurrency: Maximum number of requests in flight at once while crawling concurrently.
+    :param rate: Maximum number of requests per second to the stand-in server.
+    :param latency: Seconds the stand-in server takes to answer a request.
+    :return: Dictionary with the statistics of every crawl, by kind of crawl.
+    """
+    from aiohttp import web
+
+    async def family_profile(request):
+        await asyncio.sleep(latency)
+        return web.Response(text=family_page_html(request.query['profileTarget'][:8]), content_type='text/html')
+    app = web.Application()
+    app.router.add_get('/en-US/Adventure/Profile', family_profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base_url = f'http://127.0.0.1:{runner.addresses[0][1]}'
+
+    os.makedirs(workdir, exist_ok=True)
+    roster = synthetic_roster(size)
+    crawls = {}
+    try:
+        for kind, workers in (('serial', 1), ('concurrent', concurrency)):
+            db_file = os.path.join(workdir, f'{kind}.db')
+            seed_database(db_file, roster)
+            sage = Sage(db_file)
+            crawler = ProfileCrawler(workers, rate, timedelta(days=7), base_url)
+            try:
+                crawls[kind] = await crawler.crawl(sage)
+                if kind == 'concurrent':
+                    # Nothing is due right after a crawl, until members join or change their family page
+                    crawls['repeated'] = await crawler.crawl(sage)
+                    sage.compare_guild_members(churned_roster(roster, turnover))
+                    crawls['incremental'] = await crawler.crawl(sage)
+            finally:
+                await crawler.close()
+                sage.close()
+    finally:
+        await runner.cleanup()
+    return crawls
+
+
+def benchmark_profiles(size, workdir, turnover=TURNOVER, concurrency=8, rate=PROFILE_RATE, latency=PROFILE_LATENCY):
+    """
+    Benchmarks crawling the family pages of a guild, see profile_crawls.
+
+    :param size: Number of members of the guild.
+    :param workdir: Directory to put the databases in.
+    :param turnover: Share of the roster changing before the incremental crawl.
+    :param concurrency: Maximum number of requests in flight at once while crawling concurrently.
+    :param rate: Maximum number of requests per second to the stand-in server.
+    :param latency: Seconds the stand-in server takes to answer a request.
+    :return: Dictionary with results per kind of crawl.
+    """
+    crawls = asyncio.run(profile_crawls(size, os.path.join(workdir, 'profiles'), turnover, concurrency, rate,
+                                        latency))
+    results = {}
+    for kind, stats in crawls.items():
+        milliseconds = round(stats['seconds'] * 1000, 3)
+        results[kind] = {'median_ms': milliseconds, 'min_ms': milliseconds, 'due': stats['due'],
+                         'fetched': stats['fetched'], 'failed': stats['failed'],
+                         'per_second': round(stats['due'] / stats['seconds'], 1) if stats['seconds'] else 0.0}
+    results['members'] = size
+    return results
+
+
+def run_benchmarks(sizes=SIZES, repeat=REPEAT, turnover=TURNOVER, parser=None, tenants=0, concurrency=8,
+                   profiles=0):
+    """
+    Benchmarks every stage for every roster size.
+
+    :param sizes: Numbers of guild members.
+    :param repeat: Number of timed runs per stage.
+    :param turnover: Share of the roster changing between updates.
+    :param parser: (Optional) Roster parser backend.
+    :param tenants: Number of tenants to refresh at once, 0 to not benchmark tenants.
+    :param concurrency: Maximum number of requests in flight at once while refreshing tenants or crawling profiles.
+    :param profiles: Number of members whose family pages to crawl, 0 to not benchmark crawling.
+    :return: Dictionary with the circumstances of the benchmark and the results per size.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='roster-bench-') as workdir:
+        for size in sizes:
+            results[str(size)] = benchmark_size(size, workdir, repeat, turnover, parser)
+        results['startup'] = benchmark_startup(workdir, repeat)
+        if tenants:
+            results['tenants'] = benchmark_tenants(tenants, workdir, repeat=repeat, turnover=turnover,
+                                                   concurrency=concurrency)
+        if profiles:
+            results['profiles'] = benchmark_profiles(profiles, workdir, turnover, concurrency)
+    backend = PA_Scraper('Benchmark', 'EU', parser=parser).extractor.backend
+    return {'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'parser': backend,
+                     'repeat': repeat, 'turnover': turnover, 'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results': results}
+
+
+def find_regressions(current, baseline, threshold=THRESHOLD):
+    """
+    Compares results to a baseline. Sizes or stages missing from either are skipped.
+
+    :param current: Results of run_benchmarks.
+    :param baseline: Stored results of run_benchmarks.
+    :param threshold: Factor a stage may grow by before it regresses.
+    :return: List of descriptions of regressions.
+    """
+    regressions = []
+    for size, stages in current['results'].items():
+        for stage, now in stages.items():
+            before = baseline.get('results', {}).get(size, {}).get(stage)
+            if not isinstance(now, dict) or not isinstance(before, dict):
+                continue
+            # The fastest run is least disturbed by whatever else the machine is doing
+            for key, minimum in (('min_ms', MIN_DIFFERENCE_MS), ('peak_kib', MIN_DIFFERENCE_KIB)):
+                if key not in now or key not in before:
+                    continue
+                if now[key] > before[key] * threshold and now[key] - before[key] > minimum:
+                    regressions.append(f'{stage} of {size}: {key} {before[key]} -> {now[key]} '
+                                       f'({now[key] / before[key]:.2f}x)')
+    return regressions
+
+
+def print_results(current, baseline=None):
+    """ Prints a table of the results, compared to the baseline if there is one. """
+    print(f'{"size":>7} {"stage":<8} {"median ms":>10} {"min ms":>10} {"peak KiB":>10} {"vs baseline":>12}')
+    for size, stages in current['results'].items():
+        for stage, result in stages.items():
+            if not isinstance(result, dict):
+                continue
+            line = f'{size:>7} {stage:<8} {result["median_ms"]:>10} {result["min_ms"]:>10} ' \
+                   f'{result.get("peak_kib", "-"):>10}'
+            before = (baseline or {}).get('results', {}).get(size, {}).get(stage)
+            if before and before['min_ms']:
+                line += f' {result["min_ms"] / before["min_ms"]:>11.2f}x'
+            print(line)
+    tenants = current['results'].get('tenants')
+    if tenants:
+        print(f"{tenants['tenants']} tenants: {tenants['changed']['per_second']} refreshes/s with changes, "
+              f"{tenants['unchanged']['per_second']} without, {tenants['kib_per_tenant']} KiB kept per tenant")
+    profiles = current['results'].get('profiles')
+    if profiles:
+        print(f"{profiles['members']} family pages: {profiles['serial']['per_second']} pages/s one at a time, "
+              f"{profiles['concurrent']['per_second']} concurrently, {profiles['repeated']['due']} due when crawled "
+              f"again, {profiles['incremental']['due']} after the roster changed")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Benchmark parsing, diffing, persisting and rendering rosters.')
+    arg_parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                            help='Comma separated numbers of guild members (default: %(default)s)')
+    arg_parser.add_argument('--repeat', type=int, default=REPEAT, help='Timed runs per stage (default: %(default)s)')
+    arg_parser.add_argument('--turnover', type=float, default=TURNOVER,
+                            help='Share of the roster changing between updates (default: %(default)s)')
+    arg_parser.add_argument('--parser', choices=('lxml', 'stream'), help='Roster parser backend')
+    arg_parser.add_argument('--tenants', type=int, default=0,
+                            help='Number of tenants to refresh at once against a local stand-in server (default: none)')
+    arg_parser.add_argument('--concurrency', type=int, default=8,
+                            help='Maximum requests in flight while refreshing tenants or crawling profiles '
+                                 '(default: %(default)s)')
+    arg_parser.add_argument('--profiles', type=int, default=0,
+                            help='Number of family pages to crawl against a local stand-in server (default: none)')
+    arg_parser.add_argument('--output', help='Store the results as JSON in this file')
+    arg_parser.add_argument('--baseline', help='Compare to results stored in this file, failing on regressions')
+    arg_parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                            help='Factor a stage may grow by before failing (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+
+    current = run_benchmarks([int(size) for size in args.sizes.split(',')], args.repeat, args.turnover, args.parser,
+                             args.tenants, args.concurrency, args.profiles)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(current, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(current, output_file, indent=2)
+
+    if baseline is not None:
+        regressions = find_regressions(current, baseline, args.threshold)
+        for regression in regressions:
+            print(f'Regression! {regression}')
+        if regressions:
+            return 1
+        print(f'No regressions beyond {args.threshold}x the baseline.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
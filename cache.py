@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry once full.
+    Counts hits, misses and evictions, so its size can be tuned. Safe to share between threads.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: Maximum number of entries kept.
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped whenever entries are forgotten, so values read before that are not stored afterwards
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Looks up a key, marking it as most recently used.
+
+        :param key: Key to look up.
+        :return: (found, value) tuple. A cached value may be None, e.g. for something known not to exist.
+        """
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value, generation=None):
+        """
+        Stores a value, evicting the least recently used entry if the cache is full.
+
+        :param key: Key to store the value under.
+        :param value: Value to store.
+        :param generation: (Optional) Generation of the cache before the value was read. The value is not stored if
+                           entries have been forgotten since, as it may have been read before they changed.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Forgets a single key.
+
+        :param key: Key to forget.
+        """
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def invalidate_value(self, value):
+        """
+        Forgets all keys that map to the given value.
+
+        :param value: Value to forget.
+        """
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, cached in self.entries.items() if cached == value]:
+                del self.entries[key]
+
+    def clear(self):
+        """ Forgets all entries, but keeps counting. """
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: Dictionary with size, maximum size, hits, misses and evictions.
+        """
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
@@ -0,0 +1,189 @@
+"""
+Enrichment crawler reading the profile pages of guild members, which the roster only links to.
+
+Pages are fetched by a bounded number of concurrent requests, and requests to a single host are spread out so it is sent
+no more than a number of requests per second. Only the pages of members without a profile, whose profile is older than
+a time to live, or whose family page changed are fetched, so a crawl after an update mostly fetches the pages of members
+who just joined.
+"""
+import asyncio
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+from time import perf_counter
+from urllib.parse import urlsplit
+import aiohttp
+from metrics import SCRAPER, SCRAPER_RESPONSES
+from outbox import RouteBudget
+from profile_parser import ProfileExtractor
+
+# Number of fetched profiles stored at once, so an interrupted crawl keeps most of its work
+STORE_BATCH = 50
+
+
+class ProfileCrawler:
+    """
+    Crawler of the family profile pages of guild members. A single crawler may crawl the rosters of several guilds at
+    once, sharing its budgets and connections.
+    """
+
+    def __init__(self, concurrency=4, rate=10.0, ttl=timedelta(days=7), base_url=None, connect_timeout=5.0,
+                 read_timeout=15.0, retries=2, backoff=0.5, parser=None, session=None, limiter=None):
+        """
+        :param concurrency: Maximum number of pages fetched at once per crawl.
+        :param rate: Maximum number of requests per second to a single host, requests are spread evenly.
+        :param ttl: Timedelta after which a fetched profile is fetched again.
+        :param base_url: (Optional) Host to fetch family pages from instead of the one they link to, e.g. a local
+                         stand-in server.
+        :param connect_timeout: Seconds to wait for a connection to be established.
+        :param read_timeout: Seconds to wait for data between reads.
+        :param retries: Number of additional attempts after a failed request.
+        :param backoff: Initial delay in seconds between attempts, doubled after every attempt.
+        :param parser: (Optional) Profile parser backend ('stream' or 'lxml'), defaults to the fastest available.
+        :param session: (Optional) Client session shared with others, which is left open by close.
+        :param limiter: (Optional) Semaphore shared with others, limiting how many requests are in flight.
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.ttl = ttl
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.extractor = ProfileExtractor(parser)
+        self.session = session
+        self.owns_session = session is None
+        self.limiter = limiter
+        # Budget of every host requests were made to
+        self.budgets = {}
+
+    async def get_session(self):
+        """
+        Provides the client session, (re)creating it when there is none.
+
+        :return: Pooled aiohttp client session.
+        """
+        if self.owns_session and (self.session is None or self.session.closed):
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    def locate(self, family_page):
+        """
+        :param family_page: Link to a family page, as listed on the guild page.
+        :return: URL to fetch the family page from.
+        """
+        if self.base_url is None:
+            return family_page
+        parts = urlsplit(family_page)
+        return f'{self.base_url}{parts.path}' + (f'?{parts.query}' if parts.query else '')
+
+    async def throttle(self, host):
+        """
+        Waits until the budget of a host allows another request, and spends it.
+
+        :param host: Host the request is made to.
+        """
+        budget = self.budgets.get(host)
+        if budget is None:
+            budget = self.budgets[host] = RouteBudget(1, 1 / self.rate)
+        while (wait := budget.wait_time(time.monotonic())) > 0:
+            await asyncio.sleep(wait)
+        budget.spend(time.monotonic())
+
+    async def fetch(self, url):
+        """
+        Retrieves a family page. Failed attempts (connection errors, timeouts, rate limits, server errors) are retried
+        with exponential backoff, a rate limit also holds up other requests to the host for as long as it asks.
+
+        :param url: URL of the family page.
+        :return: HTML of the family page, None if there is no such page.
+        """
+        start = perf_counter()
+        result = 'failed'
+        host = urlsplit(url).netloc
+        try:
+            session = await self.get_session()
+            delay = self.backoff
+            for attempt in range(self.retries + 1):
+                try:
+                    # Wait for the host before taking a slot of the limiter, which is shared with roster refreshes
+                    await self.throttle(host)
+                    async with self.limiter or nullcontext():
+                        async with session.get(url, timeout=self.timeout) as response:
+                            SCRAPER_RESPONSES.inc(str(response.status))
+                            if response.status == 404:
+                                result = 'missing'
+                                return None
+                            if response.status == 429 or response.status >= 500:
+                                if response.status == 429 and response.headers.get('Retry-After', '').isdigit():
+                                    self.budgets[host].block(time.monotonic(), int(response.headers['Retry-After']))
+                                raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                                  status=response.status, message=response.reason)
+                            response.raise_for_status()
+                            html = await response.text(errors='replace')
+                            result = 'fetched'
+                            return html
+                except aiohttp.ClientResponseError as e:
+                    if (e.status != 429 and e.status < 500) or attempt == self.retries:
+                        raise
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    SCRAPER_RESPONSES.inc(type(e).__name__)
+                    if attempt == self.retries:
+                        raise
+                # Wait before trying again
+                await asyncio.sleep(delay)
+                delay *= 2
+        finally:
+            SCRAPER.observe(perf_counter() - start, 'profile', result)
+
+    async def crawl(self, sage, executor=None, limit=None):
+        """
+        Fetches the profiles of the guild members whose profile is due and stores them.
+        Pages are parsed and profiles stored on worker threads. A page that cannot be fetched is left for the next
+        crawl, the others are still stored.
+
+        :param sage: Sage of the guild to crawl.
+        :param executor: (Optional) Executor to parse and store on, defaults to the event loop's default executor.
+        :param limit: (Optional) Maximum number of pages to fetch.
+        :return: Dictionary with the number of profiles that were due, fetched, not found and failed, and the seconds
+                 taken.
+        """
+        start = perf_counter()
+        loop = asyncio.get_running_loop()
+        due = await loop.run_in_executor(executor, sage.stale_profiles, self.ttl, limit)
+        stats = {'due': len(due), 'fetched': 0, 'missing': 0, 'failed': 0}
+        pending = []
+        members = iter(due)
+
+        async def store():
+            batch = pending[:]
+            del pending[:]
+            await loop.run_in_executor(executor, sage.store_profiles, batch)
+
+        async def work():
+            # Every worker takes the next member from the shared iterator until none are left
+            for family, family_page in members:
+                try:
+                    html = await self.fetch(self.locate(family_page))
+                    profile = None if html is None else \
+                        await loop.run_in_executor(executor, self.extractor.from_html, html)
+                except Exception as e:
+                    print(f'Could not fetch the family page of {family}: {e!r}')
+                    stats['failed'] += 1
+                    continue
+                stats['fetched' if profile is not None else 'missing'] += 1
+                pending.append((family, family_page, profile))
+                if len(pending) >= STORE_BATCH:
+                    await store()
+
+        await asyncio.gather(*[work() for _ in range(min(self.concurrency, len(due)))])
+        if pending:
+            await store()
+        stats['seconds'] = round(perf_counter() - start, 3)
+        return stats
+
+    async def close(self):
+        """ Closes the client session and its pooled connections, unless it was given by somebody else. """
+        if self.owns_session and self.session is not None and not self.session.closed:
+            await self.session.close()
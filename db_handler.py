@@ -1,29 +1,130 @@
+import calendar
+import difflib
+import gzip
+import re
 import sqlite3
+import threading
+from contextlib import nullcontext
 from sqlite3 import connect, Error
-from datetime import datetime
+from datetime import datetime, timedelta
+from metrics import DB_QUERIES, timed
+from migrations import MIGRATIONS, HOT_LOOKUPS, SEARCH_INDEX, SEARCH_INDEX_VERSION
+
+# Pragmas applied to every new connection: write-ahead logging lets readers continue during writes,
+# NORMAL synchronisation is safe with WAL, and a larger page cache and memory map keep hot pages in memory
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),  # In KiB when negative
+    ('mmap_size', 64 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+)
+
+# Statements of the transaction a dump is wrapped in, replaced by a transaction of its own when loading it
+DUMP_TRANSACTION = ('BEGIN TRANSACTION;', 'COMMIT;')
+
+# Statements dumping the search index: its virtual table is written to the schema directly and its shadow tables are
+# copied, which cannot be replayed. The index is left out of dumps and rebuilt when a dump is loaded instead.
+SEARCH_INDEX_STATEMENT = re.compile(r"""(PRAGMA writable_schema|INSERT INTO sqlite_master|"""
+                                    r"""(CREATE TABLE|INSERT INTO) ['"]?family_search)""")
+
+
+def open_dump(dump_file, mode):
+    """Opens an SQL dump as text, gzip compressed when its name ends in .gz.
+
+    Args:
+        dump_file (str): Location of the dump.
+        mode (str): 'r' to read or 'w' to write.
+    Returns:
+        File object.
+    """
+    if dump_file.endswith('.gz'):
+        return gzip.open(dump_file, mode + 't', encoding='utf-8')
+    return open(dump_file, mode, encoding='utf-8')
+
+
+def week_of(moment):
+    """Tells which week a moment falls in, as stored in roster_churn.
+
+    Args:
+        moment (datetime): A moment.
+    Returns:
+        str: Date of the Monday starting the week, as YYYY-MM-DD.
+    """
+    return (moment.date() - timedelta(days=moment.weekday())).isoformat()
+
+
+def epoch_seconds(moment):
+    """Counts the seconds from the epoch to a moment, as SQLite does for stored (local) timestamps.
+
+    Args:
+        moment (datetime): A moment, without time zone.
+    Returns:
+        int: Whole seconds since 1970-01-01 00:00:00.
+    """
+    return calendar.timegm(moment.timetuple())
+
 
 class DB_Handler:
     """
     Class handling interactions between the bot and its SQLite database.
     """
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, thread_readers=True):
         """
         Class is initialised by preparing a connection to a given database file.
 
         Args:
             db_file (str): Name (and location) of the database file
+            thread_readers (bool): Whether every thread reads through a connection of its own, rather than sharing the
+                main connection. Sharing saves file handles when many databases are open at once.
         """
         self.db_file = db_file
+        self.thread_readers = thread_readers
         self.connection = None
+        # The connection is long-lived and may be shared between threads, so writes are serialised
+        self.lock = threading.RLock()
+        # Every thread reads through a connection of its own, so reads never wait for a write to finish
+        self.readers = threading.local()
+        self.reader_connections = []
 
-    def create_connection(self):
-        """Try to connect to existing SQLite database."""
+    def open(self):
+        """Opens a tuned connection to the database file.
+
+        Returns:
+            sqlite3.Connection: The new connection.
+        """
         try:
-            self.connection = connect(self.db_file)
+            connection = connect(self.db_file, check_same_thread=False, cached_statements=256)
         except Error as e:
             print(e)
             raise
+        for pragma, value in PRAGMAS:
+            connection.execute(f"PRAGMA {pragma} = {value}")
+        return connection
+
+    def create_connection(self):
+        """Try to connect to existing SQLite database. An already open connection is reused."""
+        if self.connection is None:
+            self.connection = self.open()
+
+    def reader(self):
+        """Provides the connection the current thread reads through.
+
+        Returns:
+            sqlite3.Connection: Connection of the current thread, or None if reads have to share the main connection.
+        """
+        # An in-memory database only exists within the main connection
+        if self.db_file == ':memory:' or not self.thread_readers:
+            return None
+        connection = getattr(self.readers, 'connection', None)
+        if connection is None:
+            connection = self.open()
+            self.readers.connection = connection
+            with self.lock:
+                self.reader_connections.append(connection)
+        return connection
 
     def execute_commit(self, sql, values=None):
         """
@@ -34,16 +135,50 @@ class DB_Handler:
             values (tuple): (Optional) Tuple of values inserted for each question mark '?' in sql
             """
         if self.connection is not None:
-            # Either insert values into SQL statement or just execute without if none are provided
-            if values:
-                self.connection.cursor().execute(sql, values)
-            else:
-                self.connection.cursor().execute(sql)
-            # Commit to database
-            self.connection.commit()
+            with self.lock:
+                # Either insert values into SQL statement or just execute without if none are provided
+                if values:
+                    self.connection.cursor().execute(sql, values)
+                else:
+                    self.connection.cursor().execute(sql)
+                # Commit to database
+                self.connection.commit()
         else:
             raise FileNotFoundError("Error! No database connection.")
-    
+
+    def fetch_one(self, sql, values=()):
+        """
+        Execute given SQL statement and retrieve the first resulting row.
+
+        Args:
+            sql (str): SQL statement to execute. Values are inserted for question marks '?'
+            values (tuple): (Optional) Tuple of values inserted for each question mark '?' in sql
+        Returns:
+            First resulting row (tuple), None if there are no results.
+        """
+        reader = self.reader()
+        with self.lock if reader is None else nullcontext():
+            cur = (reader or self.connection).execute(sql, values)
+            row = cur.fetchone()
+            # Finish the statement, an unfinished one would keep reading from an outdated snapshot
+            cur.close()
+            return row
+
+    def fetch_all(self, sql, values=()):
+        """
+        Execute given SQL statement and retrieve all resulting rows.
+
+        Args:
+            sql (str): SQL statement to execute. Values are inserted for question marks '?'
+            values (tuple): (Optional) Tuple of values inserted for each question mark '?' in sql
+        Returns:
+            List of resulting rows (tuples).
+        """
+        reader = self.reader()
+        with self.lock if reader is None else nullcontext():
+            return (reader or self.connection).execute(sql, values).fetchall()
+
+    @timed(DB_QUERIES)
     def get_variable(self, variable):
         """ Retrieves value of a stored variable.
 
@@ -51,13 +186,12 @@ class DB_Handler:
             variable (str): Name of variable to look for.
 
         Returns:
-            str: Value of requested variable.
+            str: Value of requested variable, None if it has never been stored.
         """
-        cur = self.connection.cursor()
-        cur.execute(f"SELECT value FROM roster_status WHERE variable = '{variable}'")
-
-        return cur.fetchone()[0]
+        row = self.fetch_one("SELECT value FROM roster_status WHERE variable = ?", (variable,))
+        return row[0] if row else None
 
+    @timed(DB_QUERIES)
     def replace_variable(self, variable, value):
         """Replace (add or change) specific variable in table of variables.
 
@@ -65,26 +199,125 @@ class DB_Handler:
             variable (str): Name of variable to replace.
             value (str): Value to associate with variable.
         """
-        sql = "REPLACE INTO roster_status (variable, value) VALUES ('{}', '{}')".\
-            format(variable, value)
-        self.execute_commit(sql)
+        self.execute_commit("REPLACE INTO roster_status (variable, value) VALUES (?, ?)", (variable, value))
 
+    @timed(DB_QUERIES)
     def initialise_database(self, dump_file):
         """
         Initialise database based on an exported SQLite database.
+        The dump is read statement by statement and applied in a single transaction, so it is never held in memory.
+        The search index is rebuilt afterwards, and the schema brought up to date.
 
         Args:
-            dump_file (str): Location of the exported SQLite database.
+            dump_file (str): Location of the exported SQLite database, gzip compressed if its name ends in .gz.
 
         """
         # Don't try to populate the database if there is no connection
         if self.connection is not None:
-            # Read from given dump file
-            with open(dump_file, 'r') as df:
-                self.connection.cursor().executescript(df.read())
+            # Read from given dump file, a statement may span several lines
+            with open_dump(dump_file, 'r') as df, self.lock:
+                cursor = self.connection.cursor()
+                try:
+                    cursor.execute("BEGIN")
+                    lines = []
+                    for line in df:
+                        lines.append(line)
+                        statement = ''.join(lines)
+                        if not sqlite3.complete_statement(statement):
+                            continue
+                        lines = []
+                        # Older dumps still contain the search index
+                        if statement.strip() not in DUMP_TRANSACTION and \
+                                not SEARCH_INDEX_STATEMENT.match(statement.lstrip()):
+                            cursor.execute(statement)
+                    self.connection.commit()
+                except Error:
+                    self.connection.rollback()
+                    raise
+                # Dumps of older schemas get their search index from the migrations
+                if self.get_schema_version() >= SEARCH_INDEX_VERSION:
+                    self.connection.executescript(f"BEGIN;\n{SEARCH_INDEX}\nCOMMIT;")
+            self.migrate()
         else:
             raise FileNotFoundError("Error! No database connection.")
 
+    def get_schema_version(self):
+        """Queries the version of the last migration applied to the database.
+
+        Returns:
+            int: Schema version, 0 for a database that has never been migrated.
+        """
+        if not self.fetch_one("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'roster_status'"):
+            return 0
+        return int(self.get_variable('schema_version') or 0)
+
+    @timed(DB_QUERIES)
+    def migrate(self):
+        """
+        Apply all migrations newer than the current schema version, in order.
+        Every migration is applied in its own transaction together with the new schema version.
+
+        Returns:
+            int: Schema version after migrating.
+        """
+        if self.connection is None:
+            raise FileNotFoundError("Error! No database connection.")
+        with self.lock:
+            version = self.get_schema_version()
+            for number, description, script in MIGRATIONS:
+                if number <= version:
+                    continue
+                print(f'Migrating database to version {number}: {description}')
+                try:
+                    self.connection.executescript(
+                        f"BEGIN;\n{script}\n"
+                        f"REPLACE INTO roster_status (variable, value) VALUES ('schema_version', '{number}');\n"
+                        f"COMMIT;")
+                except Error:
+                    self.connection.rollback()
+                    raise
+                version = number
+        return version
+
+    def explain(self, sql, values=()):
+        """ Retrieves the query plan SQLite chooses for a statement.
+
+        Args:
+            sql (str): SQL statement to explain. Values are inserted for question marks '?'
+            values (tuple): (Optional) Tuple of values inserted for each question mark '?' in sql
+        Returns:
+            List of query plan steps (str).
+        """
+        return [row[3] for row in self.fetch_all(f"EXPLAIN QUERY PLAN {sql}", values)]
+
+    def unindexed_lookups(self):
+        """ Checks which hot lookups would have to scan a full table rather than use an index.
+
+        Returns:
+            Dictionary with the offending SQL statements as keys and their query plans as values.
+        """
+        unindexed = {}
+        for sql, values in HOT_LOOKUPS:
+            try:
+                plan = self.explain(sql, values)
+            except Error as e:
+                # Lookups on tables or columns that do not exist (yet) cannot use an index either
+                unindexed[sql] = [str(e)]
+                continue
+            if any(step.startswith('SCAN') and 'USING' not in step for step in plan):
+                unindexed[sql] = plan
+        return unindexed
+
+    def get_data_version(self):
+        """Queries the data version of the connection writes go through. It changes whenever another connection,
+        e.g. of another process, commits to the database, but not for commits through this connection.
+
+        Returns:
+            int: Data version.
+        """
+        with self.lock:
+            return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
     def get_last_update(self):
         """Queries when the last update was performed.
 
@@ -98,6 +331,7 @@ class DB_Handler:
         """
         self.replace_variable('last_update', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
+    @timed(DB_QUERIES)
     def add_guild_member(self, member, rank=None, family_page=None):
         """
         Add a (new) family to the guild_members table
@@ -115,6 +349,7 @@ class DB_Handler:
         # Execute and commit insert
         self.execute_commit(sql, values)
 
+    @timed(DB_QUERIES)
     def remove_guild_member(self, member):
         """
         Delete a family from the guild_members table
@@ -123,19 +358,321 @@ class DB_Handler:
             member (str): family name of the deleted member
         """
         # Execute and commit delete
-        self.execute_commit(f"DELETE FROM guild_members WHERE family='{member}'")
+        self.execute_commit("DELETE FROM guild_members WHERE family = ?", (member,))
 
+    @timed(DB_QUERIES)
     def get_all_guild_members(self):
         """ Query all family names from the guild_members table.
 
         Returns:
             A list of all guild members (family name) in the database.
         """
-        cur = self.connection.cursor()
-        cur.execute("SELECT family FROM guild_members")
+        return [row[0] for row in self.fetch_all("SELECT family FROM guild_members")]
+
+    @timed(DB_QUERIES)
+    def get_guild_members(self):
+        """ Query all families with their rank and family page from the guild_members table.
+
+        Returns:
+            Dictionary with family names as keys and (rank, family_page) tuples as values, ordered by family name.
+        """
+        # Ordered by the primary key, so a Roster of the members does not have to sort them
+        rows = self.fetch_all("SELECT family, rank, family_page FROM guild_members ORDER BY family")
+        return {family: (rank, family_page) for family, rank, family_page in rows}
+
+    @timed(DB_QUERIES)
+    def apply_roster_changes(self, joined, left, changed, events=(), timestamp=None):
+        """
+        Apply all changes to the guild_members table in a single transaction, together with the time of the update
+        and the events describing them.
+
+        Args:
+            joined (list): (family, rank, family_page) tuples of members who joined
+            left (list): Family names of members who left
+            changed (list): (family, rank, family_page) tuples of members whose rank or family page changed
+            events (list): (family, event, old_rank, new_rank) tuples to append to the roster_events table
+            timestamp (datetime): (Optional) Time of the update, defaults to now
+        """
+        moment = timestamp or datetime.now()
+        timestamp = moment.strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock, self.connection:
+            cur = self.connection.cursor()
+            cur.executemany("INSERT INTO roster_events(family, event, timestamp, old_rank, new_rank) VALUES(?,?,?,?,?)",
+                            [(family, event, timestamp, old_rank, new_rank)
+                             for family, event, old_rank, new_rank in events])
+            cur.executemany("INSERT INTO guild_members(family, rank, family_page) VALUES(?,?,?)", joined)
+            # Leaves and changes are staged in temporary tables, so each is applied in a single pass over the roster
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS left_members(family TEXT PRIMARY KEY)")
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS changed_members"
+                        "(family TEXT PRIMARY KEY, rank TEXT, family_page TEXT)")
+            cur.executemany("INSERT OR IGNORE INTO temp.left_members(family) VALUES(?)", [(family,) for family in left])
+            cur.executemany("INSERT OR REPLACE INTO temp.changed_members(family, rank, family_page) VALUES(?,?,?)",
+                            changed)
+            if joined or left:
+                self.update_tenure_aggregates(cur, joined, moment)
+            cur.execute("DELETE FROM guild_members WHERE family IN (SELECT family FROM temp.left_members)")
+            cur.execute("""UPDATE guild_members
+                           SET rank = (SELECT rank FROM temp.changed_members c WHERE c.family = guild_members.family),
+                               family_page = (SELECT family_page FROM temp.changed_members c
+                                              WHERE c.family = guild_members.family)
+                           WHERE family IN (SELECT family FROM temp.changed_members)""")
+            cur.execute("DELETE FROM temp.left_members")
+            cur.execute("DELETE FROM temp.changed_members")
+            cur.execute("REPLACE INTO roster_status (variable, value) VALUES (?, ?)", ('last_update', timestamp))
+
+    def update_tenure_aggregates(self, cur, joined, moment):
+        """
+        Brings the churn and tenure aggregates up to date with a roster diff, within the transaction applying it.
+        Members who left are expected in the temp.left_members table.
+
+        Args:
+            cur (sqlite3.Cursor): Cursor of the transaction applying the diff.
+            joined (list): (family, rank, family_page) tuples of members who joined
+            moment (datetime): Time of the update
+        """
+        seconds = epoch_seconds(moment)
+        # The stints of members who left end now
+        stints, since_seconds = cur.execute(
+            "SELECT COUNT(*), COALESCE(SUM(CAST(strftime('%s', since) AS INTEGER)), 0) FROM member_tenure "
+            "WHERE family IN (SELECT family FROM temp.left_members)").fetchone()
+        cur.execute("DELETE FROM member_tenure WHERE family IN (SELECT family FROM temp.left_members)")
+        cur.executemany("INSERT INTO member_tenure(family, since) VALUES(?,?)",
+                        [(family, moment.strftime('%Y-%m-%d %H:%M:%S')) for family, _, _ in joined])
+        cur.execute("UPDATE tenure_totals SET members = members + ?, since_seconds = since_seconds + ?, "
+                    "stints = stints + ?, stint_seconds = stint_seconds + ?",
+                    (len(joined) - stints, len(joined) * seconds - since_seconds, stints,
+                     stints * seconds - since_seconds))
+        leaves = cur.execute("SELECT COUNT(*) FROM temp.left_members").fetchone()[0]
+        cur.execute("INSERT INTO roster_churn(week, joins, leaves) VALUES(?,?,?) ON CONFLICT(week) "
+                    "DO UPDATE SET joins = joins + excluded.joins, leaves = leaves + excluded.leaves",
+                    (week_of(moment), len(joined), leaves))
+
+    @timed(DB_QUERIES)
+    def get_roster_stats(self, weeks=8, longest=5):
+        """ Query the churn and tenure aggregates, without going through the roster history.
+
+        Args:
+            weeks (int): Number of most recent weeks to retrieve joins and leaves of.
+            longest (int): Number of longest serving members to retrieve.
+        Returns:
+            Dictionary with the number of members, the sum of the moments they joined and the number and total length
+            of the stints of members who left (in seconds), (week, joins, leaves) tuples of the most recent weeks
+            first and (family, since) tuples of the longest serving members.
+        """
+        members, since_seconds, stints, stint_seconds = \
+            self.fetch_one("SELECT members, since_seconds, stints, stint_seconds FROM tenure_totals") or (0, 0, 0, 0)
+        return {'members': members, 'since_seconds': since_seconds, 'stints': stints, 'stint_seconds': stint_seconds,
+                'weeks': self.fetch_all("SELECT week, joins, leaves FROM roster_churn ORDER BY week DESC LIMIT ?",
+                                        (weeks,)),
+                'longest': self.fetch_all("SELECT family, since FROM member_tenure ORDER BY since, family LIMIT ?",
+                                          (longest,))}
+
+    @timed(DB_QUERIES)
+    def get_tenure_aggregates(self):
+        """ Query the churn and tenure aggregates in full, e.g. to compare them to a recomputation.
 
-        return [row[0] for row in cur.fetchall()]
+        Returns:
+            Dictionary with the (joins, leaves) tuples per week, the since of every member and the totals as a
+            (members, since_seconds, stints, stint_seconds) tuple.
+        """
+        return {'weeks': {week: (joins, leaves) for week, joins, leaves
+                          in self.fetch_all("SELECT week, joins, leaves FROM roster_churn")},
+                'tenure': dict(self.fetch_all("SELECT family, since FROM member_tenure")),
+                'totals': tuple(self.fetch_one("SELECT members, since_seconds, stints, stint_seconds "
+                                               "FROM tenure_totals") or (0, 0, 0, 0))}
+
+    @timed(DB_QUERIES)
+    def replace_tenure_aggregates(self, aggregates):
+        """
+        Replace the churn and tenure aggregates, in a single transaction.
 
+        Args:
+            aggregates (dict): Aggregates as returned by get_tenure_aggregates.
+        """
+        with self.lock, self.connection:
+            cur = self.connection.cursor()
+            cur.execute("DELETE FROM roster_churn")
+            cur.executemany("INSERT INTO roster_churn(week, joins, leaves) VALUES(?,?,?)",
+                            [(week, *counts) for week, counts in aggregates['weeks'].items()])
+            cur.execute("DELETE FROM member_tenure")
+            cur.executemany("INSERT INTO member_tenure(family, since) VALUES(?,?)", aggregates['tenure'].items())
+            cur.execute("REPLACE INTO tenure_totals(id, members, since_seconds, stints, stint_seconds) "
+                        "VALUES(1,?,?,?,?)", aggregates['totals'])
+
+    @timed(DB_QUERIES)
+    def get_membership_events(self):
+        """ Query all joins and leaves, oldest first.
+
+        Returns:
+            List of (family, event, timestamp) tuples.
+        """
+        return self.fetch_all("SELECT family, event, timestamp FROM roster_events WHERE event IN ('joined', 'left') "
+                              "ORDER BY timestamp, id")
+
+    @timed(DB_QUERIES)
+    def get_events_since(self, since, limit=1000):
+        """ Query roster events from a moment onward, oldest first.
+
+        Args:
+            since (datetime): Moment from which to retrieve events.
+            limit (int): Maximum number of events to retrieve.
+        Returns:
+            List of (family, event, timestamp, old_rank, new_rank) tuples.
+        """
+        return self.fetch_all("SELECT family, event, timestamp, old_rank, new_rank FROM roster_events "
+                              "WHERE timestamp >= ? ORDER BY timestamp, id LIMIT ?",
+                              (since.strftime('%Y-%m-%d %H:%M:%S'), limit))
+
+    @timed(DB_QUERIES)
+    def get_latest_event_time(self):
+        """ Query the time of the most recent roster event.
+
+        Returns:
+            datetime: Time of the most recent event, None if there are no events.
+        """
+        row = self.fetch_one("SELECT MAX(timestamp) FROM roster_events")
+        return datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S') if row and row[0] else None
+
+    @timed(DB_QUERIES)
+    def get_family_events(self, family, limit=100):
+        """ Query the roster events of a family, most recent first.
+
+        Args:
+            family (str): Family name to retrieve events of.
+            limit (int): Maximum number of events to retrieve.
+        Returns:
+            List of (family, event, timestamp, old_rank, new_rank) tuples.
+        """
+        return self.fetch_all("SELECT family, event, timestamp, old_rank, new_rank FROM roster_events "
+                              "WHERE family = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (family, limit))
+
+    @timed(DB_QUERIES)
+    def get_roster_messages(self, channel_id):
+        """ Query the messages a roster is posted as in a channel.
+
+        Args:
+            channel_id (int): ID of the Discord channel.
+        Returns:
+            Dictionary with page numbers as keys and (message_id, content_hash) tuples as values.
+        """
+        rows = self.fetch_all("SELECT page, message_id, content_hash FROM roster_messages WHERE channel_id = ? "
+                              "ORDER BY page", (channel_id,))
+        return {page: (message_id, content_hash) for page, message_id, content_hash in rows}
+
+    @timed(DB_QUERIES)
+    def replace_roster_messages(self, channel_id, messages):
+        """
+        Replace the messages a roster is posted as in a channel, in a single transaction.
+
+        Args:
+            channel_id (int): ID of the Discord channel.
+            messages (list): (page, message_id, content_hash) tuples of all pages of the roster
+        """
+        with self.lock, self.connection:
+            cur = self.connection.cursor()
+            cur.execute("DELETE FROM roster_messages WHERE channel_id = ?", (channel_id,))
+            cur.executemany("INSERT INTO roster_messages(channel_id, page, message_id, content_hash) VALUES(?,?,?,?)",
+                            [(channel_id, *message) for message in messages])
+
+    @timed(DB_QUERIES)
+    def get_stale_profiles(self, fetched_before, limit=None):
+        """ Query the guild members whose profile is due to be fetched: those without a profile, those whose profile
+        was fetched before a moment and those whose family page changed since.
+
+        Args:
+            fetched_before (datetime): Profiles fetched before this moment are stale.
+            limit (int): (Optional) Maximum number of members to retrieve.
+        Returns:
+            List of (family, family_page) tuples, members without a profile first, then the longest fetched ago.
+        """
+        return self.fetch_all("SELECT m.family, m.family_page FROM guild_members m "
+                              "LEFT JOIN family_profiles p ON p.family = m.family "
+                              "WHERE m.family_page IS NOT NULL "
+                              "AND (p.family IS NULL OR p.fetched < ? OR p.family_page IS NOT m.family_page) "
+                              "ORDER BY p.fetched IS NOT NULL, p.fetched, m.family LIMIT ?",
+                              (fetched_before.strftime('%Y-%m-%d %H:%M:%S'), -1 if limit is None else limit))
+
+    @timed(DB_QUERIES)
+    def replace_profiles(self, profiles, timestamp=None):
+        """
+        Replace the profiles of families and their characters, in a single transaction.
+
+        Args:
+            profiles (list): (family, family_page, profile) tuples, where profile is a dictionary with guild, created,
+                contribution and a list of (name, class, level) characters, or None if the family page showed no
+                family.
+            timestamp (datetime): (Optional) Moment the profiles were fetched, defaults to now.
+        """
+        fetched = (timestamp or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock, self.connection:
+            cur = self.connection.cursor()
+            cur.executemany("REPLACE INTO family_profiles(family, family_page, fetched, found, guild, created, "
+                            "contribution) VALUES(?,?,?,?,?,?,?)",
+                            [(family, family_page, fetched, profile is not None,
+                              *((profile['guild'], profile['created'], profile['contribution']) if profile
+                                else (None, None, None)))
+                             for family, family_page, profile in profiles])
+            cur.executemany("DELETE FROM family_characters WHERE family = ?",
+                            [(family,) for family, _, _ in profiles])
+            cur.executemany("INSERT INTO family_characters(family, position, name, class, level) VALUES(?,?,?,?,?)",
+                            [(family, position, *character)
+                             for family, _, profile in profiles if profile
+                             for position, character in enumerate(profile['characters'])])
+
+    @timed(DB_QUERIES)
+    def get_profile(self, family):
+        """ Retrieves the stored profile of a family.
+
+        Args:
+            family (str): Family name.
+        Returns:
+            Dictionary with family_page, fetched, found, guild, created, contribution and a list of (name, class,
+            level) characters, None if no profile was fetched.
+        """
+        row = self.fetch_one("SELECT family_page, fetched, found, guild, created, contribution FROM family_profiles "
+                             "WHERE family = ?", (family,))
+        if row is None:
+            return None
+        profile = dict(zip(('family_page', 'fetched', 'found', 'guild', 'created', 'contribution'), row))
+        profile['found'] = bool(profile['found'])
+        profile['characters'] = self.fetch_all("SELECT name, class, level FROM family_characters WHERE family = ? "
+                                               "ORDER BY position", (family,))
+        return profile
+
+    @timed(DB_QUERIES)
+    def get_tenants(self):
+        """ Query the configuration of all tenants.
+
+        Returns:
+            List of (server_id, guild, region, roster_channel_id, serviced_channels, permitted_role_ids, roster_sort,
+            roster_group_by_rank) tuples, ordered by server ID.
+        """
+        return self.fetch_all("SELECT server_id, guild, region, roster_channel_id, serviced_channels, "
+                              "permitted_role_ids, roster_sort, roster_group_by_rank FROM tenants ORDER BY server_id")
+
+    @timed(DB_QUERIES)
+    def replace_tenant(self, tenant):
+        """
+        Add/replace the configuration of a tenant.
+
+        Args:
+            tenant (tuple): (server_id, guild, region, roster_channel_id, serviced_channels, permitted_role_ids,
+                roster_sort, roster_group_by_rank), with channels and role IDs comma separated.
+        """
+        self.execute_commit("REPLACE INTO tenants(server_id, guild, region, roster_channel_id, serviced_channels, "
+                            "permitted_role_ids, roster_sort, roster_group_by_rank) VALUES(?,?,?,?,?,?,?,?)", tenant)
+
+    @timed(DB_QUERIES)
+    def remove_tenant(self, server_id):
+        """
+        Delete the configuration of a tenant. Its roster database is left alone.
+
+        Args:
+            server_id (int): ID of the Discord server of the tenant.
+        """
+        self.execute_commit("DELETE FROM tenants WHERE server_id = ?", (server_id,))
+
+    @timed(DB_QUERIES)
     def find_family(self, family):
         """ Retrieves stored information on a specified family.
 
@@ -144,28 +681,57 @@ class DB_Handler:
         Returns:
             Complete results found for specified family name.
         """
-        cur = self.connection.cursor()
-        cur.execute(f"SELECT * FROM guild_members WHERE family = '{family}'")
+        with self.lock:
+            cur = self.connection.execute("SELECT family, rank, family_page FROM guild_members WHERE family = ?",
+                                          (family,))
 
-        # Returns dictionary with column names as keys and corresponding values
-        return dict(zip([desc[0] for desc in cur.description], cur.fetchone()))
+            # Returns dictionary with column names as keys and corresponding values
+            return dict(zip([desc[0] for desc in cur.description], cur.fetchone()))
 
-    def replace_alias(self, family, disc_name):
+    @timed(DB_QUERIES)
+    def search_families(self, text, limit=5, candidates=25):
+        """ Searches guild members with a name resembling the given text, through the trigram index.
+
+        Args:
+            text (str): (Partial or misspelled) family name to search for.
+            limit (int): Maximum number of families to return.
+            candidates (int): Number of best matches in the index that are ranked by similarity.
+        Returns:
+            List of family names, most similar first.
+        """
+        # Any family sharing a trigram with the text is a candidate, those sharing most trigrams are ranked first
+        trigrams = {text[idx:idx + 3].lower() for idx in range(len(text) - 2)}
+        if not trigrams:
+            return []
+        match = ' OR '.join('"{}"'.format(trigram.replace('"', '""')) for trigram in sorted(trigrams))
+        rows = self.fetch_all("SELECT family FROM family_search WHERE family_search MATCH ? ORDER BY rank LIMIT ?",
+                              (match, candidates))
+
+        # Order the few candidates by how similar they are as a whole
+        families = [row[0] for row in rows]
+        families.sort(key=lambda family: difflib.SequenceMatcher(None, text.lower(), family.lower()).ratio(),
+                      reverse=True)
+        return families[:limit]
+
+    @timed(DB_QUERIES)
+    def replace_alias(self, family, disc_name, disc_id=None):
         """
         Add/replace a family = discord user combination to the database
 
         Args:
             family (str): in-game family name
             disc_name (str): username on Discord server
+            disc_id (int): (Optional) user ID on Discord
         """
         # Construct sql statement and corresponding values
-        sql = """REPLACE INTO family_to_discord(family, discord_name)
-                  VALUES(?,?)"""
-        values = (family, disc_name)
+        sql = """REPLACE INTO family_to_discord(family, discord_name, discord_id)
+                  VALUES(?,?,?)"""
+        values = (family, disc_name, disc_id)
 
         # Execute and commit insert
         self.execute_commit(sql, values)
 
+    @timed(DB_QUERIES)
     def remove_alias(self, disc_name):
         """
         Delete an alias from the family_to_discord table
@@ -174,8 +740,9 @@ class DB_Handler:
             disc_name (str): discord name of the deleted alias
         """
         # Execute and commit delete
-        self.execute_commit(f"DELETE FROM family_to_discord WHERE discord_name='{disc_name}'")
+        self.execute_commit("DELETE FROM family_to_discord WHERE discord_name = ?", (disc_name,))
 
+    @timed(DB_QUERIES)
     def find_alias(self, family):
         """ Retrieves stored alias for a specified family.
 
@@ -184,12 +751,22 @@ class DB_Handler:
         Returns:
             Alias (str) if found, otherwise None.
         """
-        cur = self.connection.cursor()
-        cur.execute(f"SELECT discord_name FROM family_to_discord WHERE family = '{family}'")
-
         # Return Discord name if found, otherwise None
-        return cur.fetchone()
+        return self.fetch_one("SELECT discord_name FROM family_to_discord WHERE family = ?", (family,))
+
+    @timed(DB_QUERIES)
+    def find_families_by_discord_id(self, disc_id):
+        """ Retrieves all families a Discord user is known as.
+
+        Args:
+            disc_id (int): User ID on Discord.
+        Returns:
+            List of family names, empty if none are known.
+        """
+        return [row[0] for row in self.fetch_all("SELECT family FROM family_to_discord WHERE discord_id = ? "
+                                                 "ORDER BY family", (disc_id,))]
 
+    @timed(DB_QUERIES)
     def find_page(self, family):
         """ Retrieves stored webpage for a specified family.
 
@@ -198,12 +775,10 @@ class DB_Handler:
         Returns:
             Webpage (str) with family information if found, otherwise None.
         """
-        cur = self.connection.cursor()
-        cur.execute(f"SELECT family_page FROM guild_members WHERE family = '{family}'")
-
         # Return webpage if found, otherwise None
-        return cur.fetchone()
+        return self.fetch_one("SELECT family_page FROM guild_members WHERE family = ?", (family,))
 
+    @timed(DB_QUERIES)
     def query(self, query):
         """ A debugging function for executing any sql statement on the database.
 
@@ -212,25 +787,91 @@ class DB_Handler:
         Returns:
             Result of executing the query.
         """
-        self.connection.row_factory = sqlite3.Row
-        cur = self.connection.cursor()
-        cur.execute(query)
+        with self.lock:
+            cur = self.connection.cursor()
+            cur.row_factory = sqlite3.Row
+            cur.execute(query)
 
-        # Returns list of rows, where row is a dictionary with column names as keys and corresponding values
-        return cur.fetchall()
+            # Returns list of rows, where row is a dictionary with column names as keys and corresponding values
+            return cur.fetchall()
 
+    @timed(DB_QUERIES)
     def dump(self, dump_file):
         """
-        Dumps database to specified file.
+        Dumps database to specified file, leaving out the search index (which is rebuilt when the dump is loaded).
+        The dump is read through a connection of its own in a single read transaction, so it is consistent while
+        writes carry on.
 
         Args:
-            dump_file (str): Location of the file to dump the database to.
+            dump_file (str): Location of the file to dump the database to, gzip compressed if its name ends in .gz.
         """
-        with open(dump_file, 'w') as df:
-            for line in self.connection.iterdump():
-                df.write(line + '\n')
+        # An in-memory database only exists within the main connection
+        connection = None if self.db_file == ':memory:' else self.open()
+        try:
+            with open_dump(dump_file, 'w') as df, self.lock if connection is None else nullcontext():
+                if connection is not None:
+                    connection.execute("BEGIN")
+                for line in (connection or self.connection).iterdump():
+                    if not SEARCH_INDEX_STATEMENT.match(line):
+                        df.write(line + '\n')
+        finally:
+            if connection is not None:
+                connection.close()
+
+    @timed(DB_QUERIES)
+    def backup(self, backup_file, pages=1024):
+        """
+        Copies the database to a file with SQLite's online backup API.
+        The copy is made a number of pages at a time through a connection of its own, which holds a single read
+        transaction throughout. Writes carry on meanwhile (thanks to WAL) without making SQLite restart the copy.
+
+        Args:
+            backup_file (str): Location of the copy, overwritten if it exists.
+            pages (int): Number of pages copied per step.
+        """
+        connection = None if self.db_file == ':memory:' else self.open()
+        target = connect(backup_file)
+        try:
+            with self.lock if connection is None else nullcontext():
+                if connection is not None:
+                    # Pin the snapshot to copy, otherwise every write by another connection starts the copy over
+                    connection.execute("BEGIN")
+                    connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                (connection or self.connection).backup(target, pages=pages)
+        finally:
+            target.close()
+            if connection is not None:
+                connection.close()
+
+    @timed(DB_QUERIES)
+    def restore(self, backup_file, pages=1024):
+        """
+        Replaces the contents of the database by those of a copy made with backup.
+        The copy is checked first and then applied in one go, readers see either the old or the restored database.
+
+        Args:
+            backup_file (str): Location of the copy.
+            pages (int): Number of pages copied per step.
+        """
+        if self.connection is None:
+            raise FileNotFoundError("Error! No database connection.")
+        source = connect(backup_file)
+        try:
+            result = source.execute("PRAGMA quick_check").fetchone()[0]
+            if result != 'ok':
+                raise sqlite3.DatabaseError(f'Backup {backup_file} is damaged: {result}')
+            with self.lock:
+                source.backup(self.connection, pages=pages)
+        finally:
+            source.close()
 
     def close_connection(self):
         """ Close connection to current SQLite database. """
         if self.connection:
-            self.connection.close()
+            with self.lock:
+                for reader in self.reader_connections:
+                    reader.close()
+                self.reader_connections = []
+                self.readers = threading.local()
+                self.connection.close()
+                self.connection = None
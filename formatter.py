@@ -1,10 +1,23 @@
-from table2ascii import table2ascii, PresetStyle
+import hashlib
+from cache import LRUCache
+from metrics import RENDERS
+from roster import Roster
+
+# Discord refuses messages longer than this
+MESSAGE_LIMIT = 2000
 
 class Formatter:
     """
     Format pretty stuff.
     """
 
+    def __init__(self, cache_size=64):
+        """
+        :param cache_size: Number of rendered messages (lists of pages) to remember.
+        """
+        # Rendered pages by hash of everything they were rendered from
+        self.render_cache = LRUCache(cache_size)
+
     def list_to_table(self, in_list, columns):
         """
 
@@ -23,90 +36,395 @@ class Formatter:
         # Deliver the final table
         return table
 
-    def format_table(self, entries, columns=2, header=None):
+    def table_lines(self, entries, columns=2, header=None):
         """
-        Turns a given list to a printable table with specified number of columns.
+        Turns a given list to the lines of a table with specified number of columns.
         :param entries: List to convert.
         :param columns: Number of columns in the table.
         :param header: (Optional) Headers to put on the table.
-        :return: Formatted table
+        :return: List of lines of the table.
         """
+        # table2ascii takes a while to import, so only do so once the first table is made
+        from table2ascii import table2ascii, PresetStyle
+
         # Convert 1D list to 2D table with defined number of columns
         table_body = self.list_to_table(entries, columns)
 
         # If a header has been provided, put it on top, otherwise construct a table with only a body
         if header:
             print_table = table2ascii(header=header, body=table_body, style=PresetStyle.markdown)
-        print_table = table2ascii(body=table_body, style=PresetStyle.markdown)
+        else:
+            print_table = table2ascii(body=table_body, style=PresetStyle.markdown)
+        return print_table.split('\n')
+
+    def format_table(self, entries, columns=2, header=None):
+        """
+        Turns a given list to a printable table with specified number of columns.
+        :param entries: List to convert.
+        :param columns: Number of columns in the table.
+        :param header: (Optional) Headers to put on the table.
+        :return: Formatted table
+        """
+        print_table = '\n'.join(self.table_lines(entries, columns, header))
 
         # Put the result in a codeblock
         return f"```{print_table}```"
 
-    def format_roster(self, guild, members):
+    def paginate(self, title, sections, limit=MESSAGE_LIMIT):
+        """
+        Splits a message into pages that each fit in a single Discord message.
+        Lines are only split if they do not fit on a page of their own, a code block that does not fit is continued on
+        the next page.
+
+        :param title: Title of the message, put on every page together with a page number if there are several.
+        :param sections: List of (heading, lines) tuples. Lines are put in a code block under their (optional) heading.
+        :param limit: Maximum length of a page.
+        :return: List of pages.
+        """
+        # Leave room for the title and its page number on every page
+        budget = limit - len(f'{title} (999/999):\n')
+        pages = []
+        body = ''
+        for heading, lines in sections:
+            part = f'{heading}\n' if heading else ''
+            # Wrap lines that would not even fit on a page of their own, Discord refuses longer messages
+            width = budget - len(f'{heading} (continued)\n' if heading else '') - len('``````\n')
+            lines = [line[start:start + width] for line in lines for start in range(0, max(len(line), 1), width)]
+            block = []
+            # Length of the section so far: heading, opening and closing backticks and the lines with newlines between
+            size = len(part) + len('``````\n') - 1
+            for line in lines:
+                if len(body) + size + len(line) + 1 > budget and (block or body):
+                    # Finish what fits on this page and continue on a new one
+                    if block:
+                        body += part + '```' + '\n'.join(block) + '```\n'
+                        part = f'{heading} (continued)\n' if heading else ''
+                        block = []
+                        size = len(part) + len('``````\n') - 1
+                    pages.append(body)
+                    body = ''
+                block.append(line)
+                size += len(line) + 1
+            body += part + '```' + '\n'.join(block) + '```\n'
+        pages.append(body)
+
+        # Put the title, and page numbers if needed, on top of every page
+        if len(pages) == 1:
+            return [f'{title}:\n{pages[0]}'.rstrip('\n')]
+        return [f'{title} ({number}/{len(pages)}):\n{page}'.rstrip('\n') for number, page in enumerate(pages, 1)]
+
+    def render_cached(self, key, render):
+        """
+        Renders pages, unless pages have been rendered from exactly the same input before.
+
+        :param key: Everything the pages are rendered from (anything with a stable repr).
+        :param render: Function without arguments rendering the pages.
+        :return: List of pages.
+        """
+        with RENDERS.time(key[0], 'hit') as timer:
+            digest = hashlib.sha256(repr(key).encode()).hexdigest()
+            found, pages = self.render_cache.get(digest)
+            if not found:
+                timer.labels = (key[0], 'miss')
+                pages = render()
+                self.render_cache.put(digest, pages)
+        return pages
+
+    def format_roster(self, guild, members, sort=False, group_by_rank=False, limit=MESSAGE_LIMIT):
         """
-        Returns a printable roster.
+        Returns a printable roster, split into pages.
 
         :param guild: Guild name.
-        :param members: List of (name, fammily_page) tuples of all members in the guild.
-        :return: Printable roster of provided guild.
+        :param members: Roster of all members in the guild, or list of (name, family_page) tuples (optionally
+                        followed by rank).
+        :param sort: Whether to sort members by name rather than keep the order of the guild page.
+        :param group_by_rank: Whether to list members per rank, in order of first appearance of each rank.
+        :param limit: Maximum length of a page.
+        :return: List of pages of the roster of provided guild.
         """
-        # Members is a list of (name, family_page) tuples. We only print name on a roster.
-        names = [member[0] for member in members]
-        return f'Players currently in {guild}:\n{self.format_table(names, columns=6)}'
+        if isinstance(members, Roster):
+            # A roster is identified by its digest, names are only listed when the pages have to be rendered
+            return self.render_cached(('roster', guild, members.digest, sort, group_by_rank, limit),
+                                      lambda: self.render_roster(guild, members.listed(), sort, group_by_rank, limit))
+        # Members are (name, family_page) tuples, optionally with a rank. We only print name (and rank) on a roster.
+        names = [(member[0], member[2] if len(member) > 2 else None) for member in members]
+        return self.render_cached(('roster', guild, names, sort, group_by_rank, limit),
+                                  lambda: self.render_roster(guild, names, sort, group_by_rank, limit))
 
-    def format_roster_changes(self, guild, last_update, changes):
+    def render_roster(self, guild, names, sort, group_by_rank, limit):
         """
+        Renders the pages of a roster, see format_roster.
 
-        :param guild:
-        :param changes:
-        :return:
+        :param guild: Guild name.
+        :param names: List of (name, rank) tuples.
+        :param sort: Whether to sort members by name.
+        :param group_by_rank: Whether to list members per rank.
+        :param limit: Maximum length of a page.
+        :return: List of pages.
+        """
+        if sort:
+            names = sorted(names, key=lambda name: name[0].lower())
+        if group_by_rank:
+            groups = {}
+            for name, rank in names:
+                groups.setdefault(rank or 'Unknown rank', []).append(name)
+            sections = [(f'{rank} ({len(group)}):', self.table_lines(group, columns=6))
+                        for rank, group in groups.items()]
+        else:
+            sections = [(None, self.table_lines([name for name, _ in names], columns=6))]
+        return self.paginate(f'Players currently in {guild}', sections, limit)
+
+    def format_roster_changes(self, guild, last_update, changes, limit=MESSAGE_LIMIT, cut_off=None):
+        """
+        Returns printable roster changes, split into pages.
+
+        :param guild: Guild name.
+        :param last_update: Moment since which the changes happened.
+        :param changes: List of (joined/left/changed, family) tuples.
+        :param limit: Maximum length of a page.
+        :param cut_off: (Optional) Moment of the last change listed, if more changes followed that are not listed.
+        :return: List of pages describing the changes.
         """
         # If there are no changes, display so
         if not changes:
-            return f'No roster changes in {guild} since {last_update}.'
-
-        # Split changes into members who left and who joined
-        left = []
-        joined = []
-        [left.append(change[1]) if change[0] == 'left' else joined.append(change[1]) for change in changes]
-
-        # Construct message and give back
-        message = f'{guild} roster changes since {last_update}:\n'
-        if len(left) > 0:
-            if len(left) == 1:
-                message += f'{len(left)} family left:\n```{left[0]}```\n'
-            else:
-                message += f'{len(left)} families left:\n{self.format_table(left, columns=2)}\n'
-        if len(joined) > 0:
-            if len(joined) == 1:
-                message += f'{len(joined)} family joined:\n```{joined[0]}```\n'
+            return [f'No roster changes in {guild} since {last_update}.']
+        return self.render_cached(('changes', guild, str(last_update), changes, limit, str(cut_off)),
+                                  lambda: self.render_roster_changes(guild, last_update, changes, limit, cut_off))
+
+    def render_roster_changes(self, guild, last_update, changes, limit, cut_off=None):
+        """
+        Renders the pages of roster changes, see format_roster_changes.
+
+        :param guild: Guild name.
+        :param last_update: Moment since which the changes happened.
+        :param changes: List of (joined/left/changed, family) tuples.
+        :param limit: Maximum length of a page.
+        :param cut_off: (Optional) Moment of the last change listed, if more changes followed that are not listed.
+        :return: List of pages.
+        """
+        # Split changes into members who left, who joined and whose rank or page changed
+        left = [change[1] for change in changes if change[0] == 'left']
+        joined = [change[1] for change in changes if change[0] == 'joined']
+        changed = [change[1] for change in changes if change[0] == 'changed']
+
+        # Construct a section per kind of change, a single family needs no table
+        sections = []
+        for families, singular, plural in ((left, 'family left', 'families left'),
+                                           (joined, 'family joined', 'families joined'),
+                                           (changed, 'family changed rank or page', 'families changed rank or page')):
+            if len(families) == 1:
+                sections.append((f'{len(families)} {singular}:', families))
+            elif len(families) > 1:
+                sections.append((f'{len(families)} {plural}:', self.table_lines(families, columns=2)))
+        pages = self.paginate(f'{guild} roster changes since {last_update}', sections, limit)
+        if cut_off is not None:
+            # Tell where the list stops, so the rest can be asked for
+            note = f'Only the first {len(changes)} changes are listed, up to {cut_off}. Ask for the changes since ' \
+                   f'then to see more.'
+            if len(pages[-1]) + 1 + len(note) <= limit:
+                pages[-1] += f'\n{note}'
             else:
-                message += f'{len(joined)} families joined:\n{self.format_table(joined, columns=2)}\n'
-        return message
+                pages.append(note)
+        return pages
 
-    def format_alias(self, disc_name, family):
+    def format_family_history(self, family, events):
+        """
+        Turns the roster events of a family into a printable history.
+
+        :param family: Family name.
+        :param events: List of (family, event, timestamp, old_rank, new_rank) tuples, most recent first.
+        :return: List of pages of the history of the family.
+        """
+        if not events:
+            return [f'No roster history for family {family}.']
+        entries = []
+        for _, event, timestamp, old_rank, new_rank in events:
+            # Only mention ranks when they are known
+            ranks = ' -> '.join(rank for rank in (old_rank, new_rank) if rank) if old_rank != new_rank else ''
+            entries += [timestamp, event, ranks]
+        return self.paginate(f'Roster history of {family}', [(None, self.table_lines(entries, columns=3))])
+
+    def format_family_profile(self, family, profile, suggestions=None):
+        """
+        Turns the profile read from the family page of a family into a printable message.
+
+        :param family: Family name.
+        :param profile: Dictionary with the stored profile, None if it was never fetched.
+        :param suggestions: (Optional) Similar family names to suggest if no profile is found.
+        :return: List of pages of the profile.
+        """
+        if profile is None:
+            return [f'No profile known for family {family} yet!{self.format_suggestions(suggestions)}']
+        if not profile['found']:
+            return [f'The family page of {family} did not show a family when it was checked at {profile["fetched"]}.']
+        details = [f'Guild: {profile["guild"] or "none"}', f'Created: {profile["created"] or "unknown"}',
+                   f'Contribution points: {"private" if profile["contribution"] is None else profile["contribution"]}']
+        sections = [(None, details)]
+        if profile['characters']:
+            entries = []
+            for name, character_class, level in profile['characters']:
+                entries += [name, character_class or '?', 'private' if level is None else level]
+            sections.append((f'{len(profile["characters"])} characters:',
+                             self.table_lines(entries, columns=3, header=['Name', 'Class', 'Level'])))
+        return self.paginate(f'Profile of {family} (as of {profile["fetched"]})', sections)
+
+    def format_alias(self, disc_name, family, suggestions=None):
         """
         Turns provided alias into a readable message
         :param disc_name:
         :param family:
+        :param suggestions: (Optional) Similar family names to suggest if no alias is found.
         :return: Message about alias found.
         """
         # If an alias is found, print family and Discord name
         if disc_name:
             return f'Family {family} is known as {disc_name} on the Discord server.'
         else:
-            return f'Could not find an alias for family {family}!'
+            return f'Could not find an alias for family {family}!{self.format_suggestions(suggestions)}'
 
-    def format_family_page(self, family, page):
+    def format_family_page(self, family, page, suggestions=None):
         """
         Turns provided family page into a readable message
 
         :param family: Family name.
         :param page: Link to family page.
+        :param suggestions: (Optional) Similar family names to suggest if no page is found.
         :return: Message with link to requested family's page if available. Could not find if not.
         """
         # If an alias is found, print family and Discord name
         if page:
             return f"[{family}'s webpage]({page})"
         else:
-            return f'Could not find a page for family {family}!'
\ No newline at end of file
+            return f'Could not find a page for family {family}!{self.format_suggestions(suggestions)}'
+
+    def format_suggestions(self, suggestions):
+        """
+        Turns suggested family names into a question to append to a message.
+
+        :param suggestions: List of family names, may be empty.
+        :return: Question suggesting the families, empty if there are none.
+        """
+        if not suggestions:
+            return ''
+        return f" Did you mean {' or '.join(suggestions)}?"
+
+    def format_user_families(self, mention, families):
+        """
+        Turns the families of a Discord user into a readable message.
+
+        :param mention: Mention of the Discord user.
+        :param families: List of family names of the user.
+        :return: Message about the families found.
+        """
+        if not families:
+            return f'Could not find a family for {mention}!'
+        return f"{mention} is known as family {', '.join(families)}."
+
+    def format_family_pages(self, mention, pages):
+        """
+        Turns the family pages of a Discord user into a readable message.
+
+        :param mention: Mention of the Discord user.
+        :param pages: List of (family, page) tuples of the user.
+        :return: Message with links to the pages of all families found.
+        """
+        links = [self.format_family_page(family, page) for family, page in pages if page]
+        if not links:
+            return f'Could not find a page for {mention}!'
+        return '\n'.join(links)
+
+    def format_cache_stats(self, stats):
+        """
+        Turns cache statistics into a printable table.
+
+        :param stats: Dictionary with a dictionary of counters (size, maxsize, hits, misses, evictions) per cache.
+        :return: Table with a row per cache.
+        """
+        header = ['cache', 'size', 'max', 'hits', 'misses', 'evictions', 'hit rate']
+        entries = []
+        for cache, counters in stats.items():
+            lookups = counters['hits'] + counters['misses']
+            hit_rate = f"{counters['hits'] / lookups:.0%}" if lookups else '-'
+            entries += [cache, counters['size'], counters['maxsize'], counters['hits'], counters['misses'],
+                        counters['evictions'], hit_rate]
+        return self.format_table(entries, columns=len(header), header=header)
+
+    def format_stats(self, histograms):
+        """
+        Turns latency histograms into printable tables, split into pages.
+
+        :param histograms: Dictionary with per histogram name a dictionary of summaries (count, sum, p50, p95) per
+                           tuple of label values.
+        :return: List of pages with a table per histogram.
+        """
+        header = ['series', 'count', 'mean ms', 'p50 ms', 'p95 ms']
+        sections = []
+        for name, summaries in histograms.items():
+            entries = []
+            for labels, summary in summaries.items():
+                entries += ['/'.join(map(str, labels)) or '-', summary['count'],
+                            f"{summary['sum'] / summary['count'] * 1000:.2f}" if summary['count'] else '-',
+                            f"{summary['p50'] * 1000:.2f}" if summary['p50'] is not None else '-',
+                            f"{summary['p95'] * 1000:.2f}" if summary['p95'] is not None else '-']
+            if entries:
+                sections.append((f'{name}:', self.table_lines(entries, columns=len(header), header=header)))
+        if not sections:
+            return ['Nothing has been measured yet.']
+        return self.paginate('Latency statistics', sections)
+
+    def format_roster_stats(self, guild, stats):
+        """
+        Turns churn and tenure statistics of a roster into printable tables, split into pages.
+
+        :param guild: Guild name.
+        :param stats: Dictionary of statistics, as provided by Sage.roster_stats.
+        :return: List of pages.
+        """
+        def days(duration):
+            return 'unknown' if duration is None else f'{duration.total_seconds() / 86400:.1f} days'
+
+        details = [f'Members: {stats["members"]}, staying {days(stats["average_tenure"])} so far on average',
+                   f'Left: {stats["left"]}, after staying {days(stats["average_stint"])} on average']
+        sections = [(None, details)]
+        if stats['weeks']:
+            entries = []
+            for week, joins, leaves in stats['weeks']:
+                entries += [week.isoformat(), joins, leaves]
+            sections.append(('Joins and leaves per week:',
+                             self.table_lines(entries, columns=3, header=['Week of', 'Joined', 'Left'])))
+        if stats['longest']:
+            entries = []
+            for family, since in stats['longest']:
+                entries += [family, since.strftime('%Y-%m-%d')]
+            sections.append(('Longest serving members:',
+                             self.table_lines(entries, columns=2, header=['Family', 'Since'])))
+        return self.paginate(f'Roster statistics of {guild}', sections)
+
+    def format_profile(self, target, functions, allocations, width=60):
+        """
+        Turns the results of profiling an update into printable tables, split into pages.
+
+        :param target: What was profiled.
+        :param functions: List of (calls, cumulative seconds, own seconds, function) tuples.
+        :param allocations: List of (KiB, number of blocks, file:line) tuples.
+        :param width: Maximum width of function names and allocation sites, longer ones are cut at the front.
+        :return: List of pages.
+        """
+        def shorten(text):
+            return text if len(text) <= width else '...' + text[-width + 3:]
+
+        function_entries = []
+        for calls, cumulative, own, function in functions:
+            function_entries += [shorten(function), calls, f'{cumulative * 1000:.1f}', f'{own * 1000:.1f}']
+        allocation_entries = []
+        for size, count, site in allocations:
+            allocation_entries += [shorten(site), f'{size:.1f}', count]
+        sections = []
+        if function_entries:
+            sections.append(('Top functions by cumulative time:',
+                             self.table_lines(function_entries, columns=4,
+                                              header=['function', 'calls', 'cum ms', 'own ms'])))
+        if allocation_entries:
+            sections.append(('Top allocation sites:',
+                             self.table_lines(allocation_entries, columns=3, header=['site', 'KiB', 'blocks'])))
+        return self.paginate(f'Profile of {target}', sections)
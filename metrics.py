@@ -0,0 +1,327 @@
+"""
+Lightweight instrumentation of the bot: counters and latency histograms, exported in the Prometheus text format.
+
+Recording a value costs a lock and a bisect, so instrumentation stays on permanently. The metrics of the bot itself are
+defined at the bottom of this module, so every part of the bot records into the same registry.
+"""
+import bisect
+import functools
+import threading
+from time import perf_counter
+
+# Upper bounds (in seconds) of histogram buckets, from a fast cache hit to a slow scrape
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(names, values, extra=''):
+    """
+    :param names: Label names.
+    :param values: Label values, in the same order.
+    :param extra: (Optional) Already formatted label to append, e.g. le="0.5".
+    :return: Labels in the Prometheus text format, e.g. {command="update"}. Empty without any labels.
+    """
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    """ Escapes a label value for the Prometheus text format. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    """ Formats a number for the Prometheus text format. """
+    return '+Inf' if value == float('inf') else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonically increasing count, per combination of label values.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: Name of the metric, ending in _total by convention.
+        :param documentation: Description of the metric.
+        :param labelnames: Names of the labels distinguishing series.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        """
+        Increases the count of a series.
+
+        :param labels: Label values of the series, in the order of labelnames.
+        :param amount: Amount to increase by.
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self):
+        """
+        :return: Lines of samples in the Prometheus text format.
+        """
+        with self.lock:
+            values = list(self.values.items())
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}'
+                for labels, value in sorted(values)]
+
+
+class Gauge(Counter):
+    """
+    Value that may go up and down, per combination of label values.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        """
+        Sets the value of a series.
+
+        :param value: New value.
+        :param labels: Label values of the series, in the order of labelnames.
+        """
+        with self.lock:
+            self.values[labels] = value
+
+
+class Timer:
+    """
+    Context manager observing the time spent within it.
+    """
+
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+
+class Histogram:
+    """
+    Distribution of observed values (durations in seconds) over fixed buckets, per combination of label values.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        """
+        :param name: Name of the metric, ending in _seconds by convention.
+        :param documentation: Description of the metric.
+        :param labelnames: Names of the labels distinguishing series.
+        :param buckets: Sorted upper bounds of the buckets.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per series a list of counts per bucket (the last one being +Inf), followed by the sum of all values
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """
+        Records a value.
+
+        :param value: Observed value.
+        :param labels: Label values of the series, in the order of labelnames.
+        """
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[idx] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        """
+        :param labels: Label values of the series.
+        :return: Context manager observing the time spent within it.
+        """
+        return Timer(self, labels)
+
+    def summary(self):
+        """
+        :return: Dictionary with per series (tuple of label values) a dictionary with count, sum, p50 and p95.
+        """
+        with self.lock:
+            series = {labels: list(counts) for labels, counts in self.series.items()}
+        return {labels: {'count': sum(counts[:-1]), 'sum': counts[-1], 'p50': self.quantile(counts, 0.5),
+                         'p95': self.quantile(counts, 0.95)}
+                for labels, counts in sorted(series.items())}
+
+    def quantile(self, counts, q):
+        """
+        Estimates a quantile by interpolating within the bucket it falls in, as Prometheus' histogram_quantile does.
+
+        :param counts: Counts per bucket of a series.
+        :param q: Quantile between 0 and 1.
+        :return: Estimated value, None without observations.
+        """
+        total = sum(counts[:-1])
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for idx, count in enumerate(counts[:-1]):
+            if seen + count >= rank and count:
+                if idx == len(self.buckets):
+                    # Beyond the last bucket, nothing better than its bound can be said
+                    return self.buckets[-1]
+                lower = self.buckets[idx - 1] if idx else 0.0
+                return lower + (self.buckets[idx] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def expose(self):
+        """
+        :return: Lines of samples in the Prometheus text format.
+        """
+        with self.lock:
+            series = {labels: list(counts) for labels, counts in self.series.items()}
+        lines = []
+        for labels, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics exported together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        """ Creates and registers a counter, see Counter. """
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, labelnames=()):
+        """ Creates and registers a gauge, see Gauge. """
+        metric = Gauge(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        """ Creates and registers a histogram, see Histogram. """
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """
+        :return: All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+    def histograms(self):
+        """
+        :return: Dictionary with the summary (see Histogram.summary) of every histogram by name.
+        """
+        return {metric.name: metric.summary() for metric in self.metrics if metric.kind == 'histogram'}
+
+
+def timed(histogram, *labels):
+    """
+    Decorates a function to observe its duration.
+
+    :param histogram: Histogram to observe in.
+    :param labels: Label values of the series, defaults to the name of the function.
+    :return: Decorator.
+    """
+    def decorator(func):
+        series = labels or (func.__name__,)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start, *series)
+        return wrapper
+    return decorator
+
+
+class MetricsServer:
+    """
+    Serves the metrics of a registry over HTTP (GET /metrics), on the event loop of the bot.
+    """
+
+    def __init__(self, registry, host='127.0.0.1', port=9108):
+        """
+        :param registry: Registry to serve.
+        :param host: Address to listen on, only local by default.
+        :param port: Port to listen on.
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request):
+        from aiohttp import web
+        return web.Response(text=self.registry.expose(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self):
+        """ Starts listening, unless already listening. """
+        if self.runner is not None:
+            return
+        # The web server is only imported when metrics are actually served
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        """ Stops listening. """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# Metrics of the bot
+REGISTRY = Registry()
+COMMANDS = REGISTRY.histogram('roster_command_seconds', 'Duration of bot commands.', ('command', 'status'))
+SCRAPER = REGISTRY.histogram('roster_scraper_seconds', 'Duration of fetching and parsing the guild profile page.',
+                             ('stage', 'result'))
+DB_QUERIES = REGISTRY.histogram('roster_db_query_seconds', 'Duration of database operations.', ('operation',))
+RENDERS = REGISTRY.histogram('roster_render_seconds', 'Duration of rendering messages.', ('message', 'cache'))
+STARTUP = REGISTRY.gauge('roster_startup_seconds', 'Seconds from starting the bot until a phase of startup was reached.',
+                         ('phase',))
+SCRAPER_RESPONSES = REGISTRY.counter('roster_scraper_responses_total',
+                                     'Responses to requests for the guild profile page.', ('status',))
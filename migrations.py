@@ -0,0 +1,210 @@
+"""
+Ordered schema migrations of the roster database.
+
+Each migration is a (version, description, SQL script) tuple. Migrations are applied in order by
+DB_Handler.migrate, which records the version of the last applied migration as schema_version in roster_status.
+Never change a migration that has been released, add a new one instead.
+"""
+
+# Trigram index over the names of guild members, kept up to date by triggers. The index only stores trigrams and refers
+# to members by their ID, which (unlike an implicit row ID) is kept when a database is dumped and reloaded.
+SEARCH_INDEX = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS family_search
+        USING fts5(family, content='guild_members', content_rowid='id', tokenize='trigram');
+    INSERT INTO family_search(family_search) VALUES ('rebuild');
+    CREATE TRIGGER IF NOT EXISTS guild_members_search_insert AFTER INSERT ON guild_members BEGIN
+        INSERT INTO family_search(rowid, family) VALUES (new.id, new.family);
+    END;
+    CREATE TRIGGER IF NOT EXISTS guild_members_search_delete AFTER DELETE ON guild_members BEGIN
+        INSERT INTO family_search(family_search, rowid, family) VALUES ('delete', old.id, old.family);
+    END;
+    CREATE TRIGGER IF NOT EXISTS guild_members_search_update AFTER UPDATE OF id, family ON guild_members BEGIN
+        INSERT INTO family_search(family_search, rowid, family) VALUES ('delete', old.id, old.family);
+        INSERT INTO family_search(rowid, family) VALUES (new.id, new.family);
+    END;
+"""
+
+# Version of the migration that created the search index as SEARCH_INDEX creates it
+SEARCH_INDEX_VERSION = 9
+
+MIGRATIONS = [
+    (1, 'Base tables', """
+        CREATE TABLE IF NOT EXISTS roster_status(variable TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS guild_members(family TEXT PRIMARY KEY, rank TEXT, family_page TEXT);
+        CREATE TABLE IF NOT EXISTS family_to_discord(family TEXT PRIMARY KEY, discord_name TEXT);
+        INSERT INTO roster_status(variable, value)
+            SELECT 'last_update', datetime('now', 'localtime')
+            WHERE NOT EXISTS (SELECT 1 FROM roster_status WHERE variable = 'last_update');
+    """),
+    (2, 'Unique keys and lookup indexes', """
+        -- Databases created from older dumps may lack keys, keep the most recent row of any duplicates
+        DELETE FROM roster_status WHERE rowid NOT IN (SELECT MAX(rowid) FROM roster_status GROUP BY variable);
+        DELETE FROM guild_members WHERE rowid NOT IN (SELECT MAX(rowid) FROM guild_members GROUP BY family);
+        DELETE FROM family_to_discord WHERE rowid NOT IN (SELECT MAX(rowid) FROM family_to_discord GROUP BY family);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_roster_status_variable ON roster_status(variable);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_guild_members_family ON guild_members(family);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_family_to_discord_family ON family_to_discord(family);
+        CREATE INDEX IF NOT EXISTS idx_family_to_discord_discord_name ON family_to_discord(discord_name);
+    """),
+    (3, 'Discord user IDs and trigram search over family names', """
+        ALTER TABLE family_to_discord ADD COLUMN discord_id INTEGER;
+        CREATE INDEX IF NOT EXISTS idx_family_to_discord_discord_id ON family_to_discord(discord_id);
+        -- Full-text index over guild_members, storing trigrams only (the names themselves stay in guild_members)
+        CREATE VIRTUAL TABLE IF NOT EXISTS family_search
+            USING fts5(family, content='guild_members', content_rowid='rowid', tokenize='trigram');
+        INSERT INTO family_search(family_search) VALUES ('rebuild');
+        CREATE TRIGGER IF NOT EXISTS guild_members_search_insert AFTER INSERT ON guild_members BEGIN
+            INSERT INTO family_search(rowid, family) VALUES (new.rowid, new.family);
+        END;
+        CREATE TRIGGER IF NOT EXISTS guild_members_search_delete AFTER DELETE ON guild_members BEGIN
+            INSERT INTO family_search(family_search, rowid, family) VALUES ('delete', old.rowid, old.family);
+        END;
+        CREATE TRIGGER IF NOT EXISTS guild_members_search_update AFTER UPDATE OF family ON guild_members BEGIN
+            INSERT INTO family_search(family_search, rowid, family) VALUES ('delete', old.rowid, old.family);
+            INSERT INTO family_search(rowid, family) VALUES (new.rowid, new.family);
+        END;
+    """),
+    (4, 'Append-only log of roster events', """
+        CREATE TABLE IF NOT EXISTS roster_events(
+            id INTEGER PRIMARY KEY,
+            family TEXT NOT NULL,
+            event TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            old_rank TEXT,
+            new_rank TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_roster_events_timestamp ON roster_events(timestamp);
+        CREATE INDEX IF NOT EXISTS idx_roster_events_family ON roster_events(family, timestamp);
+        CREATE TRIGGER IF NOT EXISTS roster_events_no_update BEFORE UPDATE ON roster_events BEGIN
+            SELECT RAISE(ABORT, 'roster_events is append-only');
+        END;
+        CREATE TRIGGER IF NOT EXISTS roster_events_no_delete BEFORE DELETE ON roster_events BEGIN
+            SELECT RAISE(ABORT, 'roster_events is append-only');
+        END;
+    """),
+    (5, 'Posted roster messages', """
+        CREATE TABLE IF NOT EXISTS roster_messages(
+            channel_id INTEGER NOT NULL,
+            page INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            PRIMARY KEY (channel_id, page)
+        );
+    """),
+    (6, 'Tenants served by a multi-tenant bot', """
+        -- Configuration per Discord server, the rosters of tenants are kept in databases of their own
+        CREATE TABLE IF NOT EXISTS tenants(
+            server_id INTEGER PRIMARY KEY,
+            guild TEXT NOT NULL,
+            region TEXT NOT NULL,
+            roster_channel_id INTEGER NOT NULL DEFAULT 0,
+            serviced_channels TEXT NOT NULL DEFAULT '',
+            permitted_role_ids TEXT NOT NULL DEFAULT '',
+            roster_sort INTEGER NOT NULL DEFAULT 0,
+            roster_group_by_rank INTEGER NOT NULL DEFAULT 0
+        );
+    """),
+    (7, 'Family profiles read from family pages', """
+        -- Profiles are kept when families leave, fetched tells when a profile is due to be fetched again
+        CREATE TABLE IF NOT EXISTS family_profiles(
+            family TEXT PRIMARY KEY,
+            family_page TEXT,
+            fetched TEXT NOT NULL,
+            found INTEGER NOT NULL,
+            guild TEXT,
+            created TEXT,
+            contribution INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_family_profiles_fetched ON family_profiles(fetched);
+        CREATE TABLE IF NOT EXISTS family_characters(
+            family TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            class TEXT,
+            level INTEGER,
+            PRIMARY KEY (family, position)
+        );
+    """),
+    (8, 'Churn and tenure aggregates', """
+        -- Joins and leaves per week (starting on Monday), kept up to date as roster changes are applied
+        CREATE TABLE IF NOT EXISTS roster_churn(
+            week TEXT PRIMARY KEY,
+            joins INTEGER NOT NULL DEFAULT 0,
+            leaves INTEGER NOT NULL DEFAULT 0
+        );
+        -- Since when every current member is in the guild
+        CREATE TABLE IF NOT EXISTS member_tenure(
+            family TEXT PRIMARY KEY,
+            since TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_member_tenure_since ON member_tenure(since, family);
+        -- Running totals of member_tenure and of the stints of members who left, in seconds since the epoch
+        CREATE TABLE IF NOT EXISTS tenure_totals(
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            members INTEGER NOT NULL,
+            since_seconds INTEGER NOT NULL,
+            stints INTEGER NOT NULL,
+            stint_seconds INTEGER NOT NULL
+        );
+        -- Members who joined before roster events were logged are counted from the first logged update
+        INSERT OR IGNORE INTO roster_status(variable, value)
+            SELECT 'tenure_origin', COALESCE((SELECT MIN(timestamp) FROM roster_events),
+                                             (SELECT value FROM roster_status WHERE variable = 'last_update'));
+        -- Aggregate the history logged so far
+        INSERT OR REPLACE INTO roster_churn(week, joins, leaves)
+            SELECT date(timestamp, 'weekday 0', '-6 days'), SUM(event = 'joined'), SUM(event = 'left')
+            FROM roster_events WHERE event IN ('joined', 'left') GROUP BY 1;
+        INSERT OR REPLACE INTO member_tenure(family, since)
+            SELECT m.family, COALESCE((SELECT MAX(e.timestamp) FROM roster_events e
+                                       WHERE e.family = m.family AND e.event = 'joined'),
+                                      (SELECT value FROM roster_status WHERE variable = 'tenure_origin'))
+            FROM guild_members m;
+        -- Every leave ends a stint, which started at the join before it (or at the origin)
+        WITH stints AS (
+            SELECT event, timestamp,
+                   CASE WHEN LAG(event) OVER family_events = 'joined' THEN LAG(timestamp) OVER family_events
+                        ELSE (SELECT value FROM roster_status WHERE variable = 'tenure_origin') END AS started
+            FROM roster_events WHERE event IN ('joined', 'left')
+            WINDOW family_events AS (PARTITION BY family ORDER BY timestamp, id)
+        )
+        INSERT OR REPLACE INTO tenure_totals(id, members, since_seconds, stints, stint_seconds)
+            SELECT 1, (SELECT COUNT(*) FROM member_tenure),
+                   (SELECT COALESCE(SUM(CAST(strftime('%s', since) AS INTEGER)), 0) FROM member_tenure),
+                   COUNT(*), COALESCE(SUM(strftime('%s', timestamp) - strftime('%s', started)), 0)
+            FROM stints WHERE event = 'left';
+    """),
+    (9, 'Stable member IDs for the family search index', """
+        -- The search index referred to the implicit row IDs of guild_members, which a reload may renumber
+        DROP TRIGGER IF EXISTS guild_members_search_insert;
+        DROP TRIGGER IF EXISTS guild_members_search_delete;
+        DROP TRIGGER IF EXISTS guild_members_search_update;
+        DROP TABLE IF EXISTS family_search;
+        CREATE TABLE guild_members_with_id(id INTEGER PRIMARY KEY, family TEXT NOT NULL, rank TEXT, family_page TEXT);
+        INSERT INTO guild_members_with_id(id, family, rank, family_page)
+            SELECT rowid, family, rank, family_page FROM guild_members WHERE family IS NOT NULL;
+        DROP TABLE guild_members;
+        ALTER TABLE guild_members_with_id RENAME TO guild_members;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_guild_members_family ON guild_members(family);
+    """ + SEARCH_INDEX),
+]
+
+# Lookups on the hot path of bot commands, as (SQL, example values). Each of them should be answered from an index.
+HOT_LOOKUPS = [
+    ("SELECT value FROM roster_status WHERE variable = ?", ('last_update',)),
+    ("SELECT family, rank, family_page FROM guild_members WHERE family = ?", ('family',)),
+    ("SELECT family_page FROM guild_members WHERE family = ?", ('family',)),
+    ("SELECT discord_name FROM family_to_discord WHERE family = ?", ('family',)),
+    ("DELETE FROM guild_members WHERE family = ?", ('family',)),
+    ("DELETE FROM family_to_discord WHERE discord_name = ?", ('discord_name',)),
+    ("SELECT family FROM family_to_discord WHERE discord_id = ?", (0,)),
+    ("SELECT family, event, timestamp, old_rank, new_rank FROM roster_events WHERE timestamp >= ? "
+     "ORDER BY timestamp, id LIMIT ?", ('2000-01-01 00:00:00', 100)),
+    ("SELECT family, event, timestamp, old_rank, new_rank FROM roster_events WHERE family = ? "
+     "ORDER BY timestamp DESC, id DESC LIMIT ?", ('family', 100)),
+    ("SELECT page, message_id, content_hash FROM roster_messages WHERE channel_id = ? ORDER BY page", (0,)),
+    ("SELECT family_page, fetched, found, guild, created, contribution FROM family_profiles WHERE family = ?",
+     ('family',)),
+    ("SELECT name, class, level FROM family_characters WHERE family = ? ORDER BY position", ('family',)),
+    ("SELECT week, joins, leaves FROM roster_churn ORDER BY week DESC LIMIT ?", (8,)),
+    ("SELECT family, since FROM member_tenure ORDER BY since, family LIMIT ?", (5,)),
+]
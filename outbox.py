@@ -0,0 +1,338 @@
+import asyncio
+import time
+from collections import deque
+import discord
+
+# Priorities of outbound actions, lower goes first
+REPLY = 0
+POST = 1
+CLEANUP = 2
+
+# Discord refuses messages longer than this
+MESSAGE_LIMIT = 2000
+
+# Number of calls allowed per time window (in seconds) per kind of route, within a single channel
+ROUTE_BUDGETS = {
+    'send': (5, 5.0),
+    'edit': (5, 5.0),
+    'delete': (5, 5.0),
+    'purge': (1, 2.0),
+}
+
+# Discord only bulk deletes between 2 and 100 messages at once
+BULK_DELETE_LIMIT = 100
+
+
+class RouteBudget:
+    """
+    Sliding window of calls made on a single route.
+    """
+
+    def __init__(self, calls, window):
+        """
+        :param calls: Number of calls allowed per window.
+        :param window: Length of the window in seconds.
+        """
+        self.calls = calls
+        self.window = window
+        self.made = deque()
+        # Moment before which no calls may be made at all, after being rate limited anyway
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """
+        :param now: Current (monotonic) time.
+        :return: Seconds until a call may be made, 0 if it may be made right away.
+        """
+        while self.made and self.made[0] <= now - self.window:
+            self.made.popleft()
+        wait = self.blocked_until - now
+        if len(self.made) >= self.calls:
+            wait = max(wait, self.made[0] + self.window - now)
+        return max(wait, 0.0)
+
+    def spend(self, now):
+        """ Registers a call made. """
+        self.made.append(now)
+
+    def block(self, now, seconds):
+        """ Makes the route unavailable for some time, e.g. after Discord reported a rate limit. """
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class Action:
+    """
+    Outbound action waiting in the queue.
+    """
+
+    __slots__ = ('kind', 'channel', 'target', 'content', 'kwargs', 'merge', 'bulk', 'priority', 'future')
+
+    def __init__(self, kind, channel, target, content=None, kwargs=None, merge=False):
+        """
+        :param kind: send, edit, delete or purge.
+        :param channel: Channel the action takes place in.
+        :param target: What the action is performed on (channel to send in, message to edit or delete).
+        :param content: (Optional) Content of the message to send or edit.
+        :param kwargs: (Optional) Other arguments of the Discord call.
+        :param merge: Whether the content may be merged with other messages sent to the same channel.
+        """
+        self.kind = kind
+        self.channel = channel
+        self.target = target
+        self.content = content
+        self.kwargs = kwargs or {}
+        self.merge = merge
+        # Whether a deletion may be combined with others into a bulk deletion
+        self.bulk = kind == 'delete'
+        # Set when queued
+        self.priority = None
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def route(self):
+        return self.kind, self.channel.id
+
+
+class Outbox:
+    """
+    Central queue of all outbound Discord actions.
+    Replies go before posts, which go before cleanup. Consecutive sends to a channel are merged into a single message,
+    deletions in a channel are bulk deleted and every route (kind of action within a channel) keeps to its budget.
+    Actions on different routes are performed concurrently, actions on the same route in order.
+    """
+
+    def __init__(self, budgets=None):
+        """
+        :param budgets: (Optional) Dictionary with (calls, window) tuples per kind of route, see ROUTE_BUDGETS.
+        """
+        self.budget_settings = budgets or ROUTE_BUDGETS
+        self.budgets = {}
+        self.queues = {REPLY: deque(), POST: deque(), CLEANUP: deque()}
+        self.busy = set()
+        self.wakeup = None
+        self.worker = None
+        # Number of Discord calls made and actions saved by merging/bulk deleting, for the curious
+        self.calls = 0
+        self.saved = 0
+
+    def enqueue(self, priority, action):
+        """
+        Puts an action in the queue, starting the worker if it is not running.
+
+        :param priority: REPLY, POST or CLEANUP.
+        :param action: Action to perform.
+        :return: Future resolved with the result of the action.
+        """
+        action.priority = priority
+        self.queues[priority].append(action)
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.create_task(self.work())
+        self.wakeup.set()
+        return action.future
+
+    def send(self, channel, content, priority=POST, merge=True, **kwargs):
+        """
+        Queues a message to send.
+
+        :param channel: Channel (or anything else with a send method and a channel) to send to.
+        :param content: Content of the message.
+        :param priority: REPLY, POST or CLEANUP.
+        :param merge: Whether the message may be merged with adjacent ones. Never merged when kwargs are given.
+        :param kwargs: Other arguments of send, e.g. delete_after.
+        :return: Future resolved with the sent message.
+        """
+        target_channel = getattr(channel, 'channel', channel)
+        return self.enqueue(priority, Action('send', target_channel, target_channel, content, kwargs,
+                                             merge and not kwargs))
+
+    def reply(self, ctx, content, **kwargs):
+        """
+        Queues a reply to the message that invoked a command, ahead of everything else.
+
+        :param ctx: Command context.
+        :param content: Content of the reply.
+        :param kwargs: Other arguments of send.
+        :return: Future resolved with the sent message.
+        """
+        return self.enqueue(REPLY, Action('send', ctx.channel, ctx.channel, content,
+                                          {'reference': ctx.message, **kwargs}))
+
+    def edit(self, channel, message_id, content):
+        """
+        Queues an edit of a message.
+
+        :param channel: Channel the message is in.
+        :param message_id: ID of the message to edit.
+        :param content: New content of the message.
+        :return: Future resolved once the message has been edited.
+        """
+        return self.enqueue(POST, Action('edit', channel, channel.get_partial_message(message_id), content))
+
+    def delete(self, message, priority=CLEANUP):
+        """
+        Queues the deletion of a message. Messages that are already gone are ignored.
+
+        :param message: Message (or partial message) to delete.
+        :param priority: REPLY, POST or CLEANUP.
+        :return: Future resolved once the message has been deleted.
+        """
+        return self.enqueue(priority, Action('delete', message.channel, message))
+
+    def purge(self, channel, limit):
+        """
+        Queues deleting the latest messages of a channel.
+
+        :param channel: Channel to purge.
+        :param limit: Number of messages to delete.
+        :return: Future resolved with the deleted messages.
+        """
+        return self.enqueue(CLEANUP, Action('purge', channel, channel, kwargs={'limit': limit}))
+
+    def budget(self, route):
+        """
+        :param route: (kind, channel ID) tuple.
+        :return: Budget of the route.
+        """
+        if route not in self.budgets:
+            self.budgets[route] = RouteBudget(*self.budget_settings[route[0]])
+        return self.budgets[route]
+
+    def take_next(self):
+        """
+        Takes the first action (and the actions it can be combined with) from the queue whose route is available.
+
+        :return: Tuple of a list of actions and None, or of None and the time to wait before any action is available.
+        """
+        now = time.monotonic()
+        wait = None
+        skipped = set()
+        for priority in (REPLY, POST, CLEANUP):
+            queue = self.queues[priority]
+            for action in queue:
+                route = action.route
+                # Actions on a route keep their order, so only the first of each route is considered
+                if route in skipped or route in self.busy:
+                    skipped.add(route)
+                    continue
+                route_wait = self.budget(route).wait_time(now)
+                if route_wait > 0:
+                    skipped.add(route)
+                    wait = route_wait if wait is None else min(wait, route_wait)
+                    continue
+                batch = self.combine(queue, action)
+                for taken in batch:
+                    queue.remove(taken)
+                return batch, None
+        return None, wait
+
+    def combine(self, queue, first):
+        """
+        Collects the actions that can be performed in a single call together with the first one.
+
+        :param queue: Queue the first action is taken from.
+        :param first: First action.
+        :return: List of actions.
+        """
+        batch = [first]
+        if first.kind == 'send' and first.merge:
+            length = len(first.content)
+            for action in list(queue)[queue.index(first) + 1:]:
+                if action.route != first.route:
+                    continue
+                # Only consecutive messages are merged, so their order is kept
+                if not action.merge or length + 1 + len(action.content) > MESSAGE_LIMIT:
+                    break
+                batch.append(action)
+                length += 1 + len(action.content)
+        elif first.kind == 'delete' and first.bulk:
+            batch += [action for action in queue if action is not first and action.route == first.route and
+                      action.bulk][:BULK_DELETE_LIMIT - 1]
+        return batch
+
+    async def work(self):
+        """ Keeps performing queued actions while there are any. """
+        while True:
+            batch, wait = self.take_next()
+            if batch is None:
+                if wait is None and not self.busy and not any(self.queues.values()):
+                    # Nothing left to do, the next enqueued action starts a new worker
+                    self.worker = None
+                    return
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            route = batch[0].route
+            self.busy.add(route)
+            self.budget(route).spend(time.monotonic())
+            asyncio.create_task(self.perform(batch))
+
+    async def perform(self, batch):
+        """
+        Performs a batch of actions in a single Discord call, and resolves their futures.
+
+        :param batch: List of actions on the same route.
+        """
+        first = batch[0]
+        self.calls += 1
+        self.saved += len(batch) - 1
+        try:
+            if first.kind == 'send':
+                result = await first.target.send('\n'.join(action.content for action in batch), **first.kwargs)
+            elif first.kind == 'edit':
+                result = await first.target.edit(content=first.content)
+            elif first.kind == 'purge':
+                result = await first.target.purge(**first.kwargs)
+            elif len(batch) > 1:
+                result = await first.channel.delete_messages([action.target for action in batch])
+            else:
+                try:
+                    result = await first.target.delete()
+                except discord.NotFound:
+                    result = None
+            for action in batch:
+                if not action.future.done():
+                    action.future.set_result(result)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                # Rate limited after all, wait and try again
+                self.budget(first.route).block(time.monotonic(), getattr(e, 'retry_after', 1.0))
+                for action in reversed(batch):
+                    self.queues[action.priority].appendleft(action)
+            elif first.kind == 'delete' and len(batch) > 1:
+                # Bulk deletion is refused for messages older than two weeks, delete them one by one instead
+                for action in reversed(batch):
+                    action.bulk = False
+                    self.queues[action.priority].appendleft(action)
+            else:
+                self.fail(batch, e)
+        except Exception as e:
+            self.fail(batch, e)
+        finally:
+            self.busy.discard(first.route)
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    def fail(self, batch, error):
+        """
+        Passes an error on to everyone waiting for the actions, or reports it if nobody is waiting.
+
+        :param batch: List of actions that failed.
+        :param error: The exception.
+        """
+        for action in batch:
+            if action.kind in ('delete', 'purge'):
+                # Cleanup is fire and forget, so nobody would notice
+                print(f'Could not {action.kind} in channel {action.channel.id}: {error!r}')
+                if not action.future.done():
+                    action.future.set_result(None)
+            elif not action.future.done():
+                action.future.set_exception(error)
+
+    async def drain(self):
+        """ Waits until every queued action has been performed. """
+        while self.worker is not None and not self.worker.done():
+            await asyncio.sleep(0.05)
@@ -0,0 +1,144 @@
+from html.parser import HTMLParser
+from roster_parser import LXML_AVAILABLE, VOID_ELEMENTS, chunked, parse_selector, selector_matches, selector_to_xpath
+
+# Selectors of the details read from a family profile page. Every character on the page has a name, class and level,
+# in the same order.
+PROFILE_SELECTORS = {
+    'family': '.profile_detail .nick',
+    'guild': '.profile_detail .line_list .guild a',
+    'created': '.profile_detail .line_list .created .desc',
+    'contribution': '.profile_detail .line_list .contribution .desc',
+    'character_name': '.character_list li .character_title',
+    'character_class': '.character_list li .character_symbol em',
+    'character_level': '.character_list li .character_info .level',
+}
+
+
+def number(text):
+    """
+    :param text: Text holding a number, e.g. 'Lv. 61' or '1,250'.
+    :return: The number (int), None if the text holds no digits (e.g. details hidden as 'Private').
+    """
+    digits = ''.join(char for char in text or '' if char.isdigit())
+    return int(digits) if digits else None
+
+
+class ProfileParser(HTMLParser):
+    """
+    Event-driven parser collecting the text of every element matching one of several selectors.
+    Like RosterParser, it only keeps track of the open elements rather than building a tree.
+    """
+
+    def __init__(self, selectors=None):
+        """
+        :param selectors: (Optional) Dictionary of selectors by name, defaults to PROFILE_SELECTORS.
+        """
+        super().__init__(convert_charrefs=True)
+        self.selectors = {name: parse_selector(selector) for name, selector in (selectors or PROFILE_SELECTORS).items()}
+        self.stack = []
+        # Elements currently being read, as (name, depth, text fragments)
+        self.open = []
+        self.found = {name: [] for name in self.selectors}
+
+    def handle_starttag(self, tag, attrs):
+        classes = set((dict(attrs).get('class') or '').split())
+        for name, compounds in self.selectors.items():
+            if selector_matches(compounds, self.stack, tag, classes):
+                if tag in VOID_ELEMENTS:
+                    self.found[name].append('')
+                else:
+                    self.open.append((name, len(self.stack), []))
+        if tag not in VOID_ELEMENTS:
+            self.stack.append((tag, classes))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # Ignore stray end tags, otherwise close everything up to the matching start tag
+        for depth in range(len(self.stack) - 1, -1, -1):
+            if self.stack[depth][0] == tag:
+                break
+        else:
+            return
+        del self.stack[depth:]
+        while self.open and self.open[-1][1] >= depth:
+            name, _, fragments = self.open.pop()
+            self.found[name].append(' '.join(''.join(fragments).split()))
+
+    def handle_data(self, data):
+        for _, _, fragments in self.open:
+            fragments.append(data)
+
+
+def parse_profile_stream(chunks, selectors=None):
+    """
+    Streams HTML through a ProfileParser.
+
+    :param chunks: Iterable of HTML strings.
+    :param selectors: (Optional) Dictionary of selectors by name.
+    :return: Dictionary with the texts of the matching elements (in order) by name.
+    """
+    parser = ProfileParser(selectors)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return parser.found
+
+
+def parse_profile_lxml(html, selectors=None):
+    """
+    Collects the texts of the matching elements with lxml.
+
+    :param html: HTML string.
+    :param selectors: (Optional) Dictionary of selectors by name.
+    :return: Dictionary with the texts of the matching elements (in order) by name.
+    """
+    from lxml import html as lxml_html
+    tree = lxml_html.fromstring(html)
+    return {name: [' '.join(element.text_content().split()) for element in tree.xpath(selector_to_xpath(selector))]
+            for name, selector in (selectors or PROFILE_SELECTORS).items()}
+
+
+class ProfileExtractor:
+    """
+    Extracts the details of a family from its profile page.
+    """
+
+    # Available backends, in order of preference
+    BACKENDS = ('lxml', 'stream')
+
+    def __init__(self, backend=None, selectors=None):
+        """
+        :param backend: (Optional) 'stream' or 'lxml'. Defaults to the fastest backend that is installed.
+        :param selectors: (Optional) Dictionary of selectors by name, defaults to PROFILE_SELECTORS.
+        """
+        if backend is None:
+            backend = 'lxml' if LXML_AVAILABLE else 'stream'
+        if backend not in self.BACKENDS:
+            raise ValueError(f'Unknown profile parser backend {backend}!')
+        if backend == 'lxml' and not LXML_AVAILABLE:
+            raise ImportError('The lxml backend requires lxml to be installed.')
+        self.backend = backend
+        self.selectors = selectors or PROFILE_SELECTORS
+
+    def from_html(self, html):
+        """
+        :param html: HTML string of a family profile page.
+        :return: Dictionary with the guild, creation date and contribution points of the family (None if hidden or
+                 absent) and a list of (name, class, level) tuples of its characters. None if the page shows no family.
+        """
+        if self.backend == 'lxml':
+            found = parse_profile_lxml(html, self.selectors)
+        else:
+            found = parse_profile_stream(chunked(html), self.selectors)
+        if not found['family']:
+            return None
+        characters = [(name, character_class or None, number(level)) for name, character_class, level
+                      in zip(found['character_name'], found['character_class'], found['character_level'])]
+        return {'guild': found['guild'][0] if found['guild'] else None,
+                'created': found['created'][0] if found['created'] else None,
+                'contribution': number(found['contribution'][0]) if found['contribution'] else None,
+                'characters': characters}
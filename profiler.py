@@ -0,0 +1,142 @@
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from concurrent.futures import Executor
+
+# Frames of the event loop itself mostly measure waiting for I/O and timers, which says nothing about the work profiled
+LOOP_INTERNALS = (f'{os.sep}asyncio{os.sep}', f'{os.sep}selectors.py', "of 'select.")
+
+# From Python 3.12 cProfile is built on sys.monitoring, which allows a single profiler per interpreter. That profiler
+# sees every thread, so work on the workers is profiled by the profiler of the event loop rather than by its own.
+SHARED_PROFILER = sys.version_info >= (3, 12)
+
+class ProfilerBusy(RuntimeError):
+    """
+    Raised when profiling cannot start, because another profiler is active already.
+    """
+
+
+class ProfilingExecutor(Executor):
+    """
+    Executor handing work to another executor, profiling every function it runs.
+    """
+
+    def __init__(self, executor, profiler):
+        """
+        :param executor: Executor to run the work on.
+        :param profiler: Profiler collecting the profiles.
+        """
+        self.executor = executor
+        self.profiler = profiler
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self.executor.submit(self.profiler.wrap(fn), *args, **kwargs)
+
+    def shutdown(self, wait=True, **kwargs):
+        self.executor.shutdown(wait, **kwargs)
+
+
+class Profiler:
+    """
+    Profiles a single pass of (asynchronous) work: CPU time per function with cProfile and allocation sites with
+    tracemalloc. Work on the event loop is profiled as a whole. Every function run on the workers is profiled on its
+    own thread, or (from Python 3.12) by the same profiler as the event loop. Nothing is profiled outside of run, so
+    the bot pays nothing for it otherwise.
+    """
+
+    def __init__(self, nframes=1):
+        """
+        :param nframes: Number of frames recorded per allocation, more make allocation sites more precise but slower.
+        """
+        self.nframes = nframes
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+    def wrap(self, func):
+        """
+        :param func: Function to profile.
+        :return: Function running func under a profiler of its own, which is collected once it finishes.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.profiles.append(profile)
+        return wrapper
+
+    async def run(self, workers, factory):
+        """
+        Runs a coroutine under profiling. Whatever else runs on the event loop in the meantime is profiled as well.
+
+        :param workers: Workers whose work is profiled too.
+        :param factory: Function without arguments creating the coroutine to profile.
+        :return: Result of the coroutine.
+        :raises ProfilerBusy: If another profiler is active already.
+        """
+        loop_profile = cProfile.Profile()
+        try:
+            loop_profile.enable()
+        except ValueError as e:
+            # Only one profiler may be active at once, e.g. a debugger or coverage tool may already be profiling
+            raise ProfilerBusy(f'Cannot profile while another profiling tool is active: {e}') from e
+        executor = workers.executor
+        if not SHARED_PROFILER:
+            workers.executor = ProfilingExecutor(executor, self)
+        tracemalloc.start(self.nframes)
+        try:
+            return await factory()
+        finally:
+            loop_profile.disable()
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            workers.executor = executor
+            with self.lock:
+                self.profiles.append(loop_profile)
+
+    def stats(self):
+        """
+        :return: pstats.Stats combining the profiles of the event loop and all workers.
+        """
+        with self.lock:
+            return pstats.Stats(*self.profiles)
+
+    def top_functions(self, limit=15):
+        """
+        :param limit: Number of functions to list.
+        :return: List of (calls, cumulative seconds, own seconds, function) tuples, highest cumulative time first.
+                 The event loop itself is left out.
+        """
+        stats = self.stats().stats
+        rows = [(calls, cumulative, own, pstats.func_std_string(func))
+                for func, (_, calls, own, cumulative, _) in stats.items()]
+        rows = [row for row in rows if not any(internal in row[3] for internal in LOOP_INTERNALS)]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows[:limit]
+
+    def top_allocations(self, limit=10):
+        """
+        :param limit: Number of allocation sites to list.
+        :return: List of (KiB, number of blocks, file:line) tuples of memory still allocated at the end of the run,
+                 largest first.
+        """
+        return [(stat.size / 1024, stat.count, f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}')
+                for stat in self.snapshot.statistics('lineno')[:limit]]
+
+    def save(self, location):
+        """
+        Saves the raw profile (readable with pstats or snakeviz) and allocation snapshot to disk.
+
+        :param location: Location to save to, without extension.
+        :return: List of saved files.
+        """
+        self.stats().dump_stats(f'{location}.prof')
+        self.snapshot.dump(f'{location}.tracemalloc')
+        return [f'{location}.prof', f'{location}.tracemalloc']
@@ -0,0 +1,231 @@
+import hashlib
+import os
+import sys
+from array import array
+from bisect import bisect_left
+
+# Maximum number of members compared at once while diffing, so unchanged runs are skipped without looping over them
+RUN = 64
+
+
+class Roster:
+    """
+    Compact, immutable roster of a guild.
+
+    Members are kept sorted by name, in tuples of interned names, links to family pages without the prefix they all
+    share and (optionally) interned ranks. Rosters of the same guild thus share their strings, and two rosters are
+    compared by merging them rather than by building dictionaries. The order of the guild page is kept alongside.
+
+    Iterating a roster gives (name, link to family page) tuples in the order of the guild page, followed by rank if the
+    roster has ranks, just like the lists of tuples the roster is made from. Elsewhere members are referred to by index,
+    which is their position in the sorted roster.
+    """
+    __slots__ = ('names', 'prefix', 'links', 'ranks', 'order', 'positions', 'digest_cache')
+
+    def __init__(self, members=()):
+        """
+        :param members: Iterable of (name, link to family page) tuples in the order of the guild page, optionally
+                        followed by rank. A name listed twice keeps its first position and its last link and rank.
+        """
+        listed = list({member[0]: member for member in members}.values())
+        listed_names = [member[0] for member in listed]
+        by_name = sorted(range(len(listed)), key=listed_names.__getitem__)
+
+        links = [listed[position][1] for position in by_name]
+        # Only cut the shared prefix at a separator, so rosters of the same site share the same prefix
+        prefix = os.path.commonprefix([link for link in links if link is not None])
+        prefix = prefix[:max(prefix.rfind(separator) for separator in '/=?') + 1]
+        cut = len(prefix)
+
+        intern = sys.intern
+        self.names = tuple([intern(listed_names[position]) for position in by_name])
+        self.prefix = intern(prefix)
+        self.links = tuple([None if link is None else intern(link[cut:]) for link in links])
+        ranks = None
+        # Scraped rosters have no ranks at all, which is checked without looking at every member in Python
+        if max(map(len, listed), default=0) > 2:
+            ranks = [None if len(listed[position]) < 3 or listed[position][2] is None
+                     else intern(listed[position][2]) for position in by_name]
+        self.ranks = tuple(ranks) if ranks is not None and any(rank is not None for rank in ranks) else None
+        # Page position of every member, and the member at every page position
+        self.positions = array('I', by_name)
+        self.order = array('I', sorted(range(len(by_name)), key=by_name.__getitem__))
+        self.digest_cache = None
+
+    @classmethod
+    def from_stored(cls, members):
+        """
+        :param members: Dictionary with family names as keys and (rank, family_page) tuples as values, as stored.
+        :return: Roster of the stored members.
+        """
+        return cls((family, family_page, rank) for family, (rank, family_page) in members.items())
+
+    def link(self, index):
+        """
+        :param index: Index of a member.
+        :return: Link to the family page of the member, None if there is none.
+        """
+        link = self.links[index]
+        return None if link is None else self.prefix + link
+
+    def rank(self, index):
+        """
+        :param index: Index of a member.
+        :return: Rank of the member, None if it is not known.
+        """
+        return None if self.ranks is None else self.ranks[index]
+
+    def index(self, name):
+        """
+        :param name: Family name.
+        :return: Index of the member with that name, None if there is none.
+        """
+        index = bisect_left(self.names, name)
+        return index if index < len(self.names) and self.names[index] == name else None
+
+    def listed(self):
+        """
+        :return: List of (name, rank) tuples in the order of the guild page.
+        """
+        names, ranks = self.names, self.ranks
+        return [(names[index], None if ranks is None else ranks[index]) for index in self.order]
+
+    def with_ranks_of(self, old):
+        """
+        Fills in ranks this roster does not know from an older roster, as the database keeps them.
+
+        :param old: Older roster.
+        :return: Roster sharing everything but its ranks with this one, this roster itself if no rank is missing.
+        """
+        if old.ranks is None or (self.ranks is not None and None not in self.ranks):
+            return self
+        ranks = []
+        for index, name in enumerate(self.names):
+            rank = self.rank(index)
+            if rank is None:
+                old_index = old.index(name)
+                rank = None if old_index is None else old.ranks[old_index]
+            ranks.append(rank)
+        roster = object.__new__(Roster)
+        roster.names, roster.prefix, roster.links = self.names, self.prefix, self.links
+        roster.order, roster.positions, roster.digest_cache = self.order, self.positions, None
+        roster.ranks = tuple(ranks)
+        return roster
+
+    def diff(self, old):
+        """
+        Compares this roster to an older one by merging both.
+
+        :param old: Older roster.
+        :return: Tuple of the indices of joined members, the indices (in the old roster) of members who left, and
+                 (old index, index) tuples of members whose family page or rank changed. All in the order of the guild
+                 page. A missing rank is not a change.
+        """
+        old_names, names = old.names, self.names
+        if old.prefix == self.prefix:
+            old_links, links = old.links, self.links
+        else:
+            old_links = tuple(old.link(index) for index in range(len(old_names)))
+            links = tuple(self.link(index) for index in range(len(names)))
+        old_ranks, ranks = old.ranks, self.ranks
+        if ranks is not None and old_ranks is None:
+            old_ranks = (None,) * len(old_names)
+
+        joined, left, changed = [], [], []
+        old_index = index = 0
+        old_count, count = len(old_names), len(names)
+        # Length of the run of members compared at once, doubled while runs are unchanged and halved when they are not
+        step = RUN
+        while old_index < old_count and index < count:
+            old_name, name = old_names[old_index], names[index]
+            if old_name == name:
+                if step > 1:
+                    run = old_names[old_index:old_index + step]
+                    if run == names[index:index + step] and \
+                            old_links[old_index:old_index + step] == links[index:index + step] and \
+                            (ranks is None or old_ranks[old_index:old_index + step] == ranks[index:index + step]):
+                        old_index += len(run)
+                        index += len(run)
+                        step = min(step * 2, RUN)
+                    else:
+                        step //= 2
+                    continue
+                rank = None if ranks is None else ranks[index]
+                if old_links[old_index] != links[index] or (rank is not None and rank != old_ranks[old_index]):
+                    changed.append((old_index, index))
+                old_index += 1
+                index += 1
+                step = 2
+            elif old_name < name:
+                left.append(old_index)
+                old_index += 1
+            else:
+                joined.append(index)
+                index += 1
+        left.extend(range(old_index, old_count))
+        joined.extend(range(index, count))
+
+        # Report in the order of the guild page, as the members are listed
+        joined.sort(key=self.positions.__getitem__)
+        left.sort(key=old.positions.__getitem__)
+        changed.sort(key=lambda pair: self.positions[pair[1]])
+        return joined, left, changed
+
+    @property
+    def digest(self):
+        """ SHA-256 digest of the roster, computed once. Equal rosters have equal digests. """
+        if self.digest_cache is None:
+            state = (self.names, self.prefix, self.links, self.ranks, self.order.tobytes())
+            self.digest_cache = hashlib.sha256(repr(state).encode()).hexdigest()
+        return self.digest_cache
+
+    def __iter__(self):
+        names, links, ranks, prefix = self.names, self.links, self.ranks, self.prefix
+        for index in self.order:
+            link = links[index]
+            link = None if link is None else prefix + link
+            if ranks is None:
+                yield names[index], link
+            else:
+                yield names[index], link, ranks[index]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, position):
+        """ Member at a position of the guild page, as a tuple. """
+        index = self.order[position]
+        if self.ranks is None:
+            return self.names[index], self.link(index)
+        return self.names[index], self.link(index), self.ranks[index]
+
+    def __contains__(self, name):
+        return self.index(name) is not None
+
+    def __eq__(self, other):
+        if isinstance(other, Roster):
+            if self.names != other.names or self.ranks != other.ranks or self.order != other.order:
+                return False
+            if self.prefix == other.prefix:
+                return self.links == other.links
+            return all(self.link(index) == other.link(index) for index in range(len(self.names)))
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Roster({list(self)!r})'
+
+    def __getstate__(self):
+        return self.names, self.prefix, self.links, self.ranks, self.order, self.positions
+
+    def __setstate__(self, state):
+        # Unpickled strings are new copies, intern them again
+        names, prefix, links, ranks, self.order, self.positions = state
+        self.names = tuple(sys.intern(name) for name in names)
+        self.prefix = sys.intern(prefix)
+        self.links = tuple(None if link is None else sys.intern(link) for link in links)
+        self.ranks = None if ranks is None else tuple(None if rank is None else sys.intern(rank) for rank in ranks)
+        self.digest_cache = None
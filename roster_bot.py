@@ -1,42 +1,206 @@
 #!/usr/bin/env python
+from time import perf_counter
+# Moment the bot started, every phase of startup is timed from here
+started = perf_counter()
+
 from scraper import PA_Scraper
 from formatter import Formatter
 from sage import Sage
+from tenants import Tenant, Tenants
+from workers import Workers
+from outbox import Outbox
+from metrics import REGISTRY, COMMANDS, STARTUP, MetricsServer
 
 # Reading environment variables
 import os
-from dotenv import load_dotenv
+import asyncio
+import hashlib
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 # Discord stuff
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 # Configure intents
 intent_config = discord.Intents.default()
 intent_config.message_content = True
 
-# Load environment variables
-load_dotenv()
-TOKEN = os.getenv('DISCORD_TOKEN')
-admins = [int(id) for id in os.getenv('ADMIN_IDS').split(',')]
-permitted_roles = [int(id) for id in os.getenv('PERMITTED_ROLE_IDS').split(',')]
-serviced_channels = [ch for ch in os.getenv('SERVICED_CHANNELS').split(',')]
-guild = os.getenv('GUILD_NAME')
-region = os.getenv('REGION')
-db_loc = os.getenv('DB')
-roster_loc = f'{guild}_roster.html'
-
-# Prepare scraper, logic and formatter
-scraper = PA_Scraper(guild, region)
-sage = Sage(db_loc)
+# Scraper, logic and formatter. Importing this module neither reads the configuration nor opens anything,
+# the scraper is prepared by configure and the database is opened by setup.
+scraper = None
+archive = None
+backups = None
+crawler = None
+sage = None
+# Tenant configured by environment variables, and (in multi-tenant mode) the tenants configured in its database
+home = None
+tenants = None
 formatter = Formatter()
+workers = Workers()
+# All outbound Discord actions go through a single rate-limit-aware queue
+outbox = Outbox()
+metrics_server = None
+# Profiler of the update being profiled, None while not profiling
+profiler = None
+# Rosters are posted in a channel one at a time, so concurrent updates never post duplicate pages
+post_locks = defaultdict(asyncio.Lock)
 
 # Initialise bot
 bot = commands.Bot(command_prefix='!', intents=intent_config)
 
+def configure():
+    """
+    Reads the configuration from environment variables (or a .env file) and prepares the scraper.
+    Nothing is opened or connected yet.
+    """
+    global TOKEN, admins, permitted_roles, serviced_channels, guild, region, base_url, db_loc, roster_loc, profile_dir, \
+        roster_channel, refresh_min_minutes, refresh_max_minutes, roster_sort, roster_group_by_rank, scraper, \
+        metrics_server, archive_dir, backup_dir, backup_keep, tenant_dir, tenant_concurrency, home, profile_crawl, \
+        profile_concurrency, profile_rate, profile_ttl_hours
+    from dotenv import load_dotenv
+
+    # Load environment variables
+    load_dotenv()
+    TOKEN = os.getenv('DISCORD_TOKEN')
+    admins = [int(id) for id in os.getenv('ADMIN_IDS').split(',')]
+    permitted_roles = [int(id) for id in os.getenv('PERMITTED_ROLE_IDS').split(',')]
+    serviced_channels = [ch for ch in os.getenv('SERVICED_CHANNELS').split(',')]
+    guild = os.getenv('GUILD_NAME')
+    region = os.getenv('REGION')
+    base_url = os.getenv('PA_BASE_URL', 'https://www.naeu.playblackdesert.com')
+    db_loc = os.getenv('DB')
+    roster_loc = f'{guild}_roster.html'
+    # Raw profiles saved by !profile are put here
+    profile_dir = os.getenv('PROFILE_DIR', '.')
+    # Fetched pages and their rosters are archived here, only when a directory is configured
+    archive_dir = os.getenv('ARCHIVE_DIR')
+    # The database is backed up here on a schedule, only when a directory is configured
+    backup_dir = os.getenv('BACKUP_DIR')
+    backup_keep = int(os.getenv('BACKUP_KEEP', '7'))
+    auto_backup.change_interval(hours=float(os.getenv('BACKUP_HOURS', '24')))
+    # Other Discord servers are served as tenants, with their databases in this directory, only when it is configured
+    tenant_dir = os.getenv('TENANT_DIR')
+    # Maximum number of requests to Pearl Abyss in flight at once, over all tenants
+    tenant_concurrency = int(os.getenv('TENANT_CONCURRENCY', '8'))
+    # Family pages of members are crawled for their profiles, only when enabled
+    profile_crawl = os.getenv('PROFILE_CRAWL', '0') == '1'
+    profile_concurrency = int(os.getenv('PROFILE_CONCURRENCY', '4'))
+    # Requests per second to a single host, and hours after which a profile is fetched again
+    profile_rate = float(os.getenv('PROFILE_RATE', '10'))
+    profile_ttl_hours = float(os.getenv('PROFILE_TTL_HOURS', '168'))
+    crawl_profiles.change_interval(minutes=float(os.getenv('PROFILE_CRAWL_MINUTES', '60')))
+    # Automatic refreshes are only enabled when a channel to post the roster in is configured
+    roster_channel = int(os.getenv('ROSTER_CHANNEL_ID', '0'))
+    refresh_min_minutes = float(os.getenv('REFRESH_MIN_MINUTES', '15'))
+    refresh_max_minutes = float(os.getenv('REFRESH_MAX_MINUTES', '240'))
+    auto_refresh.change_interval(minutes=refresh_min_minutes)
+    # Roster layout
+    roster_sort = os.getenv('ROSTER_SORT', '0') == '1'
+    roster_group_by_rank = os.getenv('ROSTER_GROUP_BY_RANK', '0') == '1'
+    # Metrics are served on a local port in the Prometheus text format, only when a port is configured
+    metrics_port = int(os.getenv('METRICS_PORT', '0'))
+    if metrics_port:
+        metrics_server = MetricsServer(REGISTRY, os.getenv('METRICS_HOST', '127.0.0.1'), metrics_port)
+
+    scraper = PA_Scraper(guild, region, base_url)
+    home = Tenant(None, guild, region, roster_channel, serviced_channels, (), roster_sort, roster_group_by_rank)
+    home.scraper = scraper
+    STARTUP.set(perf_counter() - started, 'configured')
+
+async def setup():
+    """
+    Opens (and migrates) the database on a worker thread, before connecting to Discord.
+    """
+    global sage, archive, backups, tenants, crawler
+    sage = home.sage = await workers.run(Sage, db_loc)
+    # Continue conditional requests where the previous run left off
+    scraper.validators = await workers.run(sage.load_page_validators)
+    if archive_dir:
+        from archive import SnapshotArchive
+        archive = scraper.archive = await workers.run(SnapshotArchive, archive_dir)
+    if backup_dir:
+        from backups import Backups
+        backups = Backups(sage.db, backup_dir, backup_keep)
+    if tenant_dir:
+        # Tenants are only opened once they are used
+        tenants = Tenants(sage.db, tenant_dir, workers, base_url, tenant_concurrency,
+                          refresh_min_minutes=refresh_min_minutes, refresh_max_minutes=refresh_max_minutes)
+        await workers.run(tenants.load)
+    if profile_crawl:
+        from crawler import ProfileCrawler
+        # Profile requests count towards the limit on requests to Pearl Abyss shared by all tenants
+        crawler = ProfileCrawler(profile_concurrency, profile_rate, timedelta(hours=profile_ttl_hours),
+                                 base_url, limiter=tenants.limiter if tenants is not None else None)
+    STARTUP.set(perf_counter() - started, 'database')
+
+async def shutdown():
+    """
+    Stops refreshing and closes the scraper sessions, metrics server, worker threads, archive and databases, in that
+    order.
+    """
+    for loop in (auto_refresh, auto_backup, refresh_tenants, crawl_profiles):
+        if loop.is_running():
+            loop.cancel()
+    if scraper is not None:
+        await scraper.close()
+    if crawler is not None:
+        await crawler.close()
+    if tenants is not None:
+        await tenants.close_session()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    # Let running work finish before the database is closed underneath it
+    await asyncio.get_running_loop().run_in_executor(None, workers.shutdown)
+    if archive is not None:
+        archive.close()
+    if tenants is not None:
+        tenants.close()
+    if sage is not None:
+        sage.close()
+
+async def run_bot():
+    """ Runs the bot until it is stopped, cleaning up after itself. """
+    async with bot:
+        try:
+            await setup()
+            await bot.start(TOKEN)
+        finally:
+            await shutdown()
+
+def main():
+    configure()
+    discord.utils.setup_logging()
+    try:
+        asyncio.run(run_bot())
+    except KeyboardInterrupt:
+        # Cleaning up already happened while the bot was stopped
+        pass
+
 @bot.event
 async def on_ready():
-    print(f'{bot.user.name} is alive!')
+    ready = perf_counter() - started
+    STARTUP.set(ready, 'ready')
+    print(f'{bot.user.name} is alive! (ready {ready:.2f} seconds after starting)')
+    if metrics_server is not None:
+        await metrics_server.start()
+    # Start refreshing the roster in the background (on_ready may fire again after reconnecting)
+    if roster_channel and not auto_refresh.is_running():
+        auto_refresh.start()
+    if backups is not None and not auto_backup.is_running():
+        auto_backup.start()
+    if tenants is not None and not refresh_tenants.is_running():
+        refresh_tenants.start()
+    if crawler is not None and not crawl_profiles.is_running():
+        crawl_profiles.start()
+
+@bot.before_invoke
+async def start_timer(ctx):
+    ctx.started = perf_counter()
+
+@bot.after_invoke
+async def record_duration(ctx):
+    COMMANDS.observe(perf_counter() - ctx.started, ctx.command.qualified_name, 'failed' if ctx.command_failed else 'ok')
 
 def is_admin(user):
     """
@@ -55,53 +219,237 @@ def is_permitted(user):
     :return: Whether or not a user is permitted to command the bot.
     """
     user_role_ids = [role.id for role in user.roles]
-    return any(id in permitted_roles for id in user_role_ids)
+    tenant = tenant_of(getattr(user, 'guild', None))
+    return any(id in permitted_roles or id in tenant.permitted_roles for id in user_role_ids)
 
 def is_serviced_channel(channel):
     """
     Checks if provided channel is serviced by bot.
+    Tenants without serviced channels of their own are serviced in the channels serviced everywhere.
     :param channel: A Discord channel.
     :return: Whether or not the channel is serviced by the bot.
     """
-    return channel.name in serviced_channels
+    return channel.name in (tenant_of(getattr(channel, 'guild', None)).serviced_channels or serviced_channels)
+
+def tenant_of(server):
+    """
+    Finds the tenant a Discord server is served as.
+    :param server: A Discord server, None for direct messages.
+    :return: Tenant of the server, or the tenant configured by environment variables if the server is no tenant.
+    """
+    tenant = tenants.get(server.id) if tenants is not None and server is not None else None
+    return tenant or home
+
+async def open_tenant(ctx):
+    """
+    Provides the tenant a command was given for, opening its database if it was not opened yet.
+    :param ctx: Command context.
+    :return: Opened tenant.
+    """
+    tenant = tenant_of(ctx.guild)
+    return home if tenant is home else await tenants.open(tenant)
 
 async def remove_previous_roster(channel):
     """
-    Deletes a previously posted roster from the provided channel
+    Deletes all pages of a previously posted roster from the provided channel
     :param channel: A Discord channel.
     """
-    # Loop through last five messages and delete a message if it starts with the roster line
-    async for message in channel.history(limit=5):
+    # Loop through the last messages and delete those starting with the roster line
+    async for message in channel.history(limit=25):
         if message.content.startswith('Players currently in'):
-            await message.delete()
-            return  # No need to loop further
+            outbox.delete(message)
+
+async def publish_roster(tenant, channel, pages):
+    """
+    Brings the roster posted in a channel up to date, editing only the pages whose content changed.
+    Pages that are no longer needed are deleted, missing ones are posted.
+    :param tenant: Opened tenant the roster belongs to.
+    :param channel: A Discord channel.
+    :param pages: List of pages of the current roster.
+    """
+    posted = await workers.run(tenant.sage.get_roster_messages, channel.id)
+    if not posted:
+        # Roster may have been posted before its messages were tracked
+        await remove_previous_roster(channel)
+
+    messages = []
+    for number, page in enumerate(pages):
+        content_hash = hashlib.sha256(page.encode()).hexdigest()
+        message_id, posted_hash = posted.get(number, (None, None))
+        if message_id is not None and posted_hash != content_hash:
+            try:
+                await outbox.edit(channel, message_id, page)
+            except discord.NotFound:
+                # Somebody deleted the page, post it again
+                message_id = None
+        if message_id is None:
+            message_id = (await outbox.send(channel, page, merge=False)).id
+        messages.append((number, message_id, content_hash))
+    for number, (message_id, _) in posted.items():
+        if number >= len(pages):
+            outbox.delete(channel.get_partial_message(message_id))
+    await workers.run(tenant.sage.store_roster_messages, channel.id, messages)
+
+async def send_pages(destination, pages):
+    """
+    Sends every page of a message.
+    :param destination: A Discord channel or command context.
+    :param pages: List of pages.
+    """
+    await asyncio.gather(*[outbox.send(destination, page) for page in pages])
+
+async def reply_pages(ctx, pages):
+    """
+    Replies with the first page of a message, and sends the other pages after it.
+    :param ctx: Command context.
+    :param pages: List of pages.
+    """
+    await asyncio.gather(outbox.reply(ctx, pages[0]), send_pages(ctx, pages[1:]))
+
+async def post_roster(tenant, channel, cur_members, changes, last_update):
+    """
+    Updates the roster posted in a channel and posts the roster changes.
+    :param tenant: Opened tenant the roster belongs to.
+    :param channel: A Discord channel.
+    :param cur_members: Roster of all members.
+    :param changes: List of roster changes.
+    :param last_update: Time of the update before these changes.
+    """
+    roster = await workers.run(formatter.format_roster, tenant.guild, cur_members, tenant.roster_sort,
+                               tenant.roster_group_by_rank)
+    roster_changes = await workers.run(formatter.format_roster_changes, tenant.guild, last_update, changes)
+    async with post_locks[channel.id]:
+        await publish_roster(tenant, channel, roster)
+        await send_pages(channel, roster_changes)
+
+async def update_roster(tenant, channel, announce_unchanged=True):
+    """
+    Runs the scrape, diff and post pipeline for a channel.
+    Concurrent updates share a single scrape and diff per tenant, and a single post of changes per channel.
+    Whether nothing changed is announced by every update asking for it, once the shared update finished.
+    :param tenant: Opened tenant whose roster to update.
+    :param channel: A Discord channel to post the roster and its changes in.
+    :param announce_unchanged: Whether to post even if the roster did not change.
+    :return: List of roster changes, None if the guild page did not change at all.
+    """
+    async def run():
+        refreshed = await workers.single_flight(tenant.refresh_key, lambda: tenant.refresh(workers))
+        if refreshed is not None and refreshed[1]:
+            await post_roster(tenant, channel, *refreshed)
+        return refreshed
+
+    refreshed = await workers.single_flight(('update', channel.id), run)
+    if refreshed is None:
+        # Guild page did not change, so neither did the roster
+        if announce_unchanged:
+            last_update = await workers.run(tenant.sage.latest_update)
+            await send_pages(channel, formatter.format_roster_changes(tenant.guild, last_update, []))
+        return None
+    if not refreshed[1] and announce_unchanged:
+        await post_roster(tenant, channel, *refreshed)
+    return refreshed[1]
+
+async def disk_update_roster(tenant, channel):
+    """
+    Runs the parse, diff and post pipeline for a channel, reading the guild page from disk.
+    Concurrent updates of the same channel share a single run.
+    :param tenant: Opened tenant whose roster to update.
+    :param channel: A Discord channel to post the roster and its changes in.
+    """
+    async def run():
+        # Read the roster from disk and apply it on worker threads
+        cur_members = await workers.run(tenant.scraper.parse_roster, tenant.roster_loc)
+        changes = await workers.run(tenant.sage.compare_guild_members, cur_members)
+        last_update = tenant.sage.last_update
+        # The database no longer reflects the last scraped page
+        tenant.scraper.reset_validators()
+        await workers.run(tenant.sage.store_page_validators, tenant.scraper.validators)
+        await post_roster(tenant, channel, cur_members, changes, last_update)
+    await workers.single_flight(('disk_update', channel.id), run)
+
+@tasks.loop(minutes=15)
+async def auto_refresh():
+    """
+    Periodically updates the roster, only posting when it changed.
+    The interval is doubled (up to a maximum) whenever nothing changed or the update failed,
+    and reset to the minimum as soon as changes are detected.
+    """
+    try:
+        changes = await update_roster(home, bot.get_channel(roster_channel), announce_unchanged=False)
+    except Exception as e:
+        print(f'Automatic roster update failed: {e!r}')
+        changes = None
+    if changes:
+        interval = refresh_min_minutes
+    else:
+        interval = min(auto_refresh.minutes * 2, refresh_max_minutes)
+    if interval != auto_refresh.minutes:
+        auto_refresh.change_interval(minutes=interval)
+
+@tasks.loop(minutes=1)
+async def refresh_tenants():
+    """
+    Updates the rosters of all tenants whose automatic refresh is due, only posting when they changed.
+    Tenants refresh concurrently, the number of requests to Pearl Abyss in flight is limited over all of them.
+    """
+    async def refresh(tenant):
+        return await update_roster(tenant, bot.get_channel(tenant.roster_channel), announce_unchanged=False)
+    await tenants.refresh_due(refresh)
+
+@tasks.loop(hours=1)
+async def crawl_profiles():
+    """
+    Periodically fetches the profiles of members who joined since the last crawl, or whose profile is outdated.
+    The rosters of all opened tenants are crawled at the same time, keeping to the budget of requests per host.
+    """
+    opened = [home] + ([tenant for tenant in tenants.tenants.values() if tenant.sage is not None] if tenants else [])
+    crawled = await asyncio.gather(*[crawler.crawl(tenant.sage, workers.executor) for tenant in opened],
+                                   return_exceptions=True)
+    for tenant, stats in zip(opened, crawled):
+        if isinstance(stats, Exception):
+            print(f'Crawling the family pages of {tenant.guild} failed: {stats!r}')
+        elif stats['due']:
+            print(f"Crawled {stats['due']} family pages of {tenant.guild} ({stats['fetched']} profiles, "
+                  f"{stats['missing']} missing, {stats['failed']} failed) in {stats['seconds']:.2f} seconds")
+
+@tasks.loop(hours=24)
+async def auto_backup():
+    """
+    Periodically backs up the database, keeping a number of the most recent backups.
+    """
+    try:
+        backup = await workers.run(backups.create)
+        print(f"Backed up database to {backup['backup']} ({'unchanged' if backup['skipped'] else 'new'}, "
+              f"{backup['bytes'] / 1024 / 1024:.1f} MiB in {backup['seconds']:.2f} seconds)")
+    except Exception as e:
+        print(f'Automatic backup failed: {e!r}')
 
 # Define commands
 @bot.command(name='permit?')
 async def permission(ctx):
     # Check if user has any of the permitted roles (intersection of both lists)
     if is_permitted(ctx.message.author):
-        await ctx.reply('At your service.')
+        await outbox.reply(ctx, 'At your service.')
     else:
-        await ctx.reply('I will not obey you.')
+        await outbox.reply(ctx, 'I will not obey you.')
 
 @bot.command(name='admin?')
 async def admin(ctx):
     # Check if user has any of the permitted roles (intersection of both lists)
     if is_admin(ctx.message.author):
-        await ctx.reply('Yes master.')
+        await outbox.reply(ctx, 'Yes master.')
     else:
-        await ctx.reply('Who are you?.')
+        await outbox.reply(ctx, 'Who are you?.')
 
 @bot.command()
 async def greet(ctx):
-    await ctx.send(f'Hi {ctx.message.author.mention}!')
+    await outbox.send(ctx.channel, f'Hi {ctx.message.author.mention}!')
 
 @bot.command()
 async def name(ctx):
     if is_serviced_channel(ctx.channel):
-        await ctx.send(f'Your name is {ctx.message.author.display_name} (message deleted after 3 seconds)', delete_after=3.0)
-        await ctx.message.delete()
+        await outbox.send(ctx.channel, f'Your name is {ctx.message.author.display_name} (message deleted after 3 seconds)', delete_after=3.0)
+        outbox.delete(ctx.message)
 
 @bot.command()
 async def delete(ctx):
@@ -110,8 +458,8 @@ async def delete(ctx):
     :param ctx: Command context.
     """
     if is_serviced_channel(ctx.channel) and is_permitted(ctx.message.author):
-        await ctx.message.delete()
-        await ctx.send(f'{ctx.message.author.mention} Your message has been deleted!')
+        outbox.delete(ctx.message)
+        await outbox.send(ctx.channel, f'{ctx.message.author.mention} Your message has been deleted!')
 
 @bot.command()
 async def purge(ctx, n: int = 0):
@@ -121,7 +469,7 @@ async def purge(ctx, n: int = 0):
     :param n: Number of messages to be purged (1 - 50).
     """
     # Only permitted users are allowed to delete multiple messages
-    if is_permitted(ctx.author) and is_serviced_channel(ctx.channel) and 0 < n < 50: await ctx.channel.purge(limit=n+1)
+    if is_permitted(ctx.author) and is_serviced_channel(ctx.channel) and 0 < n < 50: outbox.purge(ctx.channel, n+1)
 
 @bot.command()
 async def dummy(ctx, entity):
@@ -132,11 +480,11 @@ async def dummy(ctx, entity):
     """
     # Delete user message and print dummy table
     if is_serviced_channel(ctx.channel) and is_permitted(ctx.message.author):
-        await ctx.message.delete()
+        outbox.delete(ctx.message)
         if entity == 'roster':
-            await ctx.send(formatter.format_roster('dummy_guild', scraper.dummy_roster()))
+            await send_pages(ctx, formatter.format_roster('dummy_guild', scraper.dummy_roster()))
         if entity == 'changes':
-            await ctx.send(formatter.format_roster_changes('dummy_guild', '0000-00-00 00:00:00', sage.dummy_roster_change()))
+            await send_pages(ctx, formatter.format_roster_changes('dummy_guild', '0000-00-00 00:00:00', sage.dummy_roster_change()))
 
 @bot.command()
 async def update(ctx):
@@ -145,21 +493,20 @@ async def update(ctx):
     :param ctx: Command context.
     """
     # Remove !update message
-    await ctx.message.delete()
+    outbox.delete(ctx.message)
 
     # Check if user is allowed to update the roster
     if is_permitted(ctx.message.author) and is_serviced_channel(ctx.channel):
-        # Remove the previous roster
-        await remove_previous_roster(ctx.channel)
-        # Post an updated roster
-        cur_members = scraper.parse_roster()
-        await ctx.send(formatter.format_roster(guild, cur_members))
-        # Post roster changes
-        changes = sage.compare_guild_members(cur_members)
-        await ctx.send(formatter.format_roster_changes(guild, sage.last_update, changes))
+        tenant = await open_tenant(ctx)
+        changes = await update_roster(tenant, ctx.channel)
+        # Automatic refreshes pick up the pace again after a manual update found changes
+        if changes and tenant is not home:
+            tenants.hasten(tenant)
+        elif changes and auto_refresh.is_running() and auto_refresh.minutes != refresh_min_minutes:
+            auto_refresh.change_interval(minutes=refresh_min_minutes)
     else:
         # Tell user they do not have a required role
-        await ctx.send(f'{ctx.message.author.mention} you do not have permission to update the roster!')
+        await outbox.send(ctx.channel, f'{ctx.message.author.mention} you do not have permission to update the roster!')
 
 @bot.command()
 async def disk_update(ctx):
@@ -169,16 +516,52 @@ async def disk_update(ctx):
     """
     # Only admins may execute this command
     if is_admin(ctx.message.author) and is_serviced_channel(ctx.channel):
-        # Remove the previous roster
-        await remove_previous_roster(ctx.channel)
-        # Post an updated roster read from disk
-        cur_members = scraper.parse_roster(roster_loc)
-        await ctx.send(formatter.format_roster(guild, cur_members))
-        # Post roster changes
-        changes = sage.compare_guild_members(cur_members)
-        await ctx.send(formatter.format_roster_changes(guild, sage.last_update, changes))
+        await disk_update_roster(await open_tenant(ctx), ctx.channel)
     # Remove !update message
-    await ctx.message.delete()
+    outbox.delete(ctx.message)
+
+@bot.command(name='profile')
+async def profile_update(ctx, target='update', save=None):
+    """
+    Runs a single update under CPU profiling and allocation tracing, and posts where the time and memory went.
+    E.g. !profile, !profile disk_update or !profile update save to also save the raw profile to disk.
+    :param ctx: Command context.
+    :param target: Pipeline to profile, update or disk_update.
+    :param save: (Optional) The keyword save, to save the raw profile to disk.
+    """
+    global profiler
+    from profiler import Profiler, ProfilerBusy
+    if not (is_admin(ctx.message.author) and is_serviced_channel(ctx.channel)):
+        return
+    if target not in ('update', 'disk_update') or save not in (None, 'save'):
+        await outbox.reply(ctx, 'Usage: !profile [update|disk_update] [save]')
+        return
+    if profiler is not None:
+        await outbox.reply(ctx, 'Already profiling, please wait for it to finish.')
+        return
+
+    profiler = Profiler()
+    try:
+        tenant = await open_tenant(ctx)
+        try:
+            if target == 'update':
+                # Profile the full pipeline, rather than a page that turns out to be unchanged
+                tenant.scraper.reset_validators()
+                await profiler.run(workers, lambda: update_roster(tenant, ctx.channel))
+            else:
+                await profiler.run(workers, lambda: disk_update_roster(tenant, ctx.channel))
+        except ProfilerBusy as e:
+            await outbox.reply(ctx, f'Could not profile: {e}')
+            return
+        pages = await workers.run(formatter.format_profile, target, profiler.top_functions(),
+                                  profiler.top_allocations())
+        if save:
+            location = os.path.join(profile_dir, f'profile_{target}_{datetime.now():%Y%m%d_%H%M%S}')
+            saved = await workers.run(profiler.save, location)
+            pages[-1] += '\nSaved ' + ' and '.join(saved)
+        await reply_pages(ctx, pages)
+    finally:
+        profiler = None
 
 @bot.command()
 async def alias(ctx, *args):
@@ -189,25 +572,41 @@ async def alias(ctx, *args):
     """
     # Only perform operation in serviced channels
     if is_serviced_channel(ctx.channel):
+        sage = (await open_tenant(ctx)).sage
         # Anybody is allowed to add or remove their own alias
         if len(args) == 1:
             # If only one argument is provided, the user wishes to either add or remove their own alias
             if args[0] == 'remove':
-                sage.remove_alias(ctx.message.author.display_name)
+                await workers.run(sage.remove_alias, ctx.message.author.display_name)
             else:
-                sage.replace_alias(args[0], ctx.message.author.display_name)
+                await workers.run(sage.replace_alias, args[0], ctx.message.author.display_name, ctx.message.author.id)
         # Adding/removing aliases for others is only allowed for permitted roles
         elif is_permitted(ctx.message.author):
             if len(args) == 2:
+                # Others may be mentioned rather than named, which also allows finding them by mention later on
+                user = mentioned_user(ctx, args[1] if args[0] == 'remove' else args[0])
                 if args[0] == 'remove':
                     # Remove alias(es) of provided Discord user
-                    sage.remove_alias(args[1])
+                    await workers.run(sage.remove_alias, user.display_name if user else args[1])
                 else:
                     # Add/replace alias of provided Discord user
-                    sage.replace_alias(args[1], args[0])
+                    await workers.run(sage.replace_alias, args[1], user.display_name if user else args[0],
+                                      user.id if user else None)
 
     # Delete message from user
-    await ctx.message.delete()
+    outbox.delete(ctx.message)
+
+def mentioned_user(ctx, argument):
+    """
+    Resolves a command argument mentioning a Discord user.
+    :param ctx: Command context.
+    :param argument: Command argument, e.g. <@1234>.
+    :return: The mentioned Discord user, None if the argument is no mention.
+    """
+    if not argument.startswith('<@'):
+        return None
+    user_id = argument.strip('<@!>')
+    return next((user for user in ctx.message.mentions if str(user.id) == user_id), None)
 
 @bot.command()
 async def whois(ctx, alias):
@@ -217,11 +616,16 @@ async def whois(ctx, alias):
     :param alias: Name to look for.
     """
     if is_serviced_channel(ctx.channel):
-        if alias.startswith('<@'):
-            # Search by mention implies somebody is looking for an alias by Discord name
-            await ctx.reply('I do not support searching by Discord name yet. :(')
+        sage = (await open_tenant(ctx)).sage
+        user = mentioned_user(ctx, alias)
+        if user:
+            # Search by mention implies somebody is looking for a family by Discord user
+            families = await workers.run(sage.find_families, user.id)
+            await outbox.reply(ctx, formatter.format_user_families(user.mention, families))
         else:
-            await ctx.reply(formatter.format_alias(sage.find_alias(alias), alias))
+            disc_name = await workers.run(sage.find_alias, alias)
+            suggestions = None if disc_name else await workers.run(sage.suggest_families, alias)
+            await outbox.reply(ctx, formatter.format_alias(disc_name, alias, suggestions))
 
 @bot.command()
 async def page(ctx, family):
@@ -231,11 +635,157 @@ async def page(ctx, family):
     :param family: Family name to find webpage for.
     """
     if is_serviced_channel(ctx.channel):
-        if family.startswith('<@'):
-            # Search by mention implies somebody is looking for a family by Discord name
-            await ctx.reply('I do not support searching by Discord name yet. :(')
+        sage = (await open_tenant(ctx)).sage
+        user = mentioned_user(ctx, family)
+        if user:
+            # Search by mention implies somebody is looking for the families of a Discord user
+            pages = await workers.run(lambda: [(family, sage.find_page(family))
+                                               for family in sage.find_families(user.id)])
+            await outbox.reply(ctx, formatter.format_family_pages(user.mention, pages))
         else:
-            await ctx.reply(formatter.format_family_page(family, sage.find_page(family)))
+            family_page = await workers.run(sage.find_page, family)
+            suggestions = None if family_page else await workers.run(sage.suggest_families, family)
+            await outbox.reply(ctx, formatter.format_family_page(family, family_page, suggestions))
+
+@bot.command()
+async def family(ctx, family):
+    """
+    Shows the profile of a family as read from its family page, e.g. its guild and characters.
+    :param ctx: Command context.
+    :param family: Family name to show the profile of.
+    """
+    if is_serviced_channel(ctx.channel):
+        sage = (await open_tenant(ctx)).sage
+        profile = await workers.run(sage.family_profile, family)
+        suggestions = None
+        # Members whose page was not crawled yet need no suggestions
+        if profile is None and not await workers.run(sage.find_page, family):
+            suggestions = await workers.run(sage.suggest_families, family)
+        await reply_pages(ctx, formatter.format_family_profile(family, profile, suggestions))
+
+@bot.command()
+async def changes(ctx, *args):
+    """
+    Lists roster changes since a given date, e.g. !changes since 2024-01-31 or !changes since 2024-01-31 18:00.
+    :param ctx: Command context.
+    :param args: Optionally the keyword since, followed by a date and optionally a time.
+    """
+    if is_serviced_channel(ctx.channel):
+        moment = ' '.join(arg for arg in args if arg != 'since')
+        for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                since = datetime.strptime(moment, date_format)
+                break
+            except ValueError:
+                continue
+        else:
+            await outbox.reply(ctx, 'Please provide a date as YYYY-MM-DD, optionally followed by a time as HH:MM.')
+            return
+        tenant = await open_tenant(ctx)
+        roster_changes, cut_off = await workers.run(tenant.sage.changes_since, since)
+        await reply_pages(ctx, await workers.run(formatter.format_roster_changes, tenant.guild, since, roster_changes,
+                                                 cut_off=cut_off))
+
+@bot.command()
+async def history(ctx, family):
+    """
+    Shows when a family joined, left or changed rank.
+    :param ctx: Command context.
+    :param family: Family name to show history of.
+    """
+    if is_serviced_channel(ctx.channel):
+        sage = (await open_tenant(ctx)).sage
+        events = await workers.run(sage.family_history, family)
+        await reply_pages(ctx, await workers.run(formatter.format_family_history, family, events))
+
+@bot.command()
+async def cache(ctx):
+    """
+    Shows how well lookups are served from memory.
+    :param ctx: Command context.
+    """
+    if is_admin(ctx.message.author):
+        sage = (await open_tenant(ctx)).sage
+        await outbox.reply(ctx, formatter.format_cache_stats({**sage.cache_stats(), 'render': formatter.render_cache.stats()}))
+
+@bot.command()
+async def stats(ctx, subject=None):
+    """
+    Shows latency statistics of commands, scraping, database operations and rendering, or with !stats roster the
+    churn per week and tenure of the guild's members.
+    :param ctx: Command context.
+    :param subject: (Optional) What to show statistics of (latency or roster), defaults to latencies.
+    """
+    if subject == 'roster':
+        if is_serviced_channel(ctx.channel) and is_permitted(ctx.message.author):
+            tenant = await open_tenant(ctx)
+            roster_stats = await workers.run(tenant.sage.roster_stats)
+            await reply_pages(ctx, formatter.format_roster_stats(tenant.guild, roster_stats))
+    elif is_admin(ctx.message.author):
+        if subject is None or subject == 'latency':
+            await reply_pages(ctx, formatter.format_stats(REGISTRY.histograms()))
+        else:
+            await outbox.reply(ctx, f'Unknown statistics {subject}, try !stats latency or !stats roster.')
+
+@bot.command()
+async def backup(ctx):
+    """
+    Backs up the database right away, next to the scheduled backups.
+    :param ctx: Command context.
+    """
+    if is_admin(ctx.message.author):
+        if backups is None:
+            await outbox.reply(ctx, 'Backups are not configured, set BACKUP_DIR.')
+            return
+        made = await workers.run(backups.create)
+        state = 'Database unchanged since' if made['skipped'] else 'Backed up database to'
+        await outbox.reply(ctx, f"{state} {os.path.basename(made['backup'])} "
+                                f"({made['bytes'] / 1024 / 1024:.1f} MiB, {made['seconds']:.2f} seconds).")
+
+@bot.command()
+async def tenant(ctx, action=None, *args):
+    """
+    Shows or changes the guild this Discord server follows as a tenant, e.g. !tenant, !tenant remove or
+    !tenant set GuildName EU #roster-channel general,roster to follow a guild, post its roster in #roster-channel and
+    answer commands in the channels named general and roster.
+    :param ctx: Command context.
+    :param action: (Optional) set or remove, shows the configuration of this server if omitted.
+    :param args: Guild name, region and optionally the channel to post the roster in and names of serviced channels.
+    """
+    # Bot admins, and those managing the server itself, may configure a server
+    if ctx.guild is None or not (is_admin(ctx.author) or ctx.author.guild_permissions.manage_guild):
+        return
+    if tenants is None:
+        await outbox.reply(ctx, 'Multi-tenant mode is not configured, set TENANT_DIR.')
+        return
+    current = tenants.get(ctx.guild.id)
+    if action is None:
+        if current is None:
+            await outbox.reply(ctx, 'This server is no tenant, try !tenant set GuildName REGION.')
+        else:
+            channel = f'<#{current.roster_channel}>' if current.roster_channel else 'no channel'
+            await outbox.reply(ctx, f'This server follows {current.guild} ({current.region}), posting its roster in '
+                                    f'{channel}. {tenants.stats()["tenants"]} servers are tenants.')
+    elif action == 'set' and 2 <= len(args) <= 4:
+        try:
+            roster_channel = int(args[2].strip('<#>')) if len(args) > 2 else 0
+        except ValueError:
+            await outbox.reply(ctx, f'{args[2]} is no channel, please mention it as #roster-channel or give its ID.')
+            return
+        configured = Tenant(ctx.guild.id, args[0], args[1], roster_channel,
+                            args[3].split(',') if len(args) > 3 else (), current.permitted_roles if current else (),
+                            current.roster_sort if current else roster_sort,
+                            current.roster_group_by_rank if current else roster_group_by_rank)
+        await tenants.configure(configured)
+        await outbox.reply(ctx, f'This server now follows {configured.guild} ({configured.region}).')
+    elif action == 'remove' and current is not None:
+        await tenants.remove(ctx.guild.id)
+        await outbox.reply(ctx, f'This server no longer follows {current.guild}.')
+    else:
+        await outbox.reply(ctx, 'Usage: !tenant [set GuildName REGION [#roster-channel] [channel,names] | remove]')
+
+STARTUP.set(perf_counter() - started, 'imported')
 
 # Let it rip!
-bot.run(TOKEN)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+"""
+Runs the roster pipeline without Discord, printing JSON.
+
+    python roster_cli.py parse guild.html
+    python roster_cli.py update [--html guild.html] [--dry-run] [--force]
+    python roster_cli.py report --since 2024-01-31
+    python roster_cli.py backfill snapshots/ [--workers 8]
+    python roster_cli.py replay archive/ [--since 2024-01-31] [--until 2024-02-29]
+    python roster_cli.py backup backups/ [--keep 7]
+    python roster_cli.py restore backups/ [--file backups/roster-20240131-180000.db.gz]
+    python roster_cli.py profiles [--concurrency 4] [--rate 10] [--ttl-hours 168]
+    python roster_cli.py stats [--weeks 8] [--verify] [--repair]
+
+The database, guild, region and host default to the DB, GUILD_NAME, REGION and PA_BASE_URL environment variables
+(or .env), as for the bot. Progress and warnings go to stderr, so stdout is always valid JSON.
+"""
+import argparse
+import asyncio
+import contextlib
+import fnmatch
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from roster import Roster
+from roster_parser import RosterExtractor
+
+# Timestamps in snapshot file names, e.g. guild_2024-01-31_18-00-00.html, 20240131T1800.html or 2024-01-31.html
+SNAPSHOT_TIMESTAMP = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})(?:[T_ -]?(\d{2})[-:h]?(\d{2})(?:[-:m]?(\d{2}))?)?')
+
+
+def snapshot_time(path):
+    """
+    Determines when a snapshot was taken, from its file name or otherwise from when the file was last modified.
+
+    :param path: Location of the snapshot.
+    :return: Datetime.
+    """
+    match = SNAPSHOT_TIMESTAMP.search(os.path.basename(path))
+    if match:
+        try:
+            return datetime(*(int(part or 0) for part in match.groups()))
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(os.path.getmtime(path)).replace(microsecond=0)
+
+
+def find_snapshots(directory, pattern):
+    """
+    Lists the snapshots in a directory (and its subdirectories), oldest first.
+
+    :param directory: Directory holding saved guild profile pages.
+    :param pattern: Pattern of the file names of snapshots, e.g. *.html.
+    :return: List of (datetime, location) tuples.
+    """
+    snapshots = []
+    for root, _, files in os.walk(directory):
+        for name in fnmatch.filter(files, pattern):
+            path = os.path.join(root, name)
+            snapshots.append((snapshot_time(path), path))
+    snapshots.sort()
+    return snapshots
+
+
+def parse_snapshot(path, backend=None):
+    """
+    Extracts the roster from a snapshot. Runs in worker processes, hence a plain function.
+
+    :param path: Location of the snapshot.
+    :param backend: (Optional) Roster parser backend.
+    :return: Roster, empty if the page holds no members.
+    """
+    return Roster(RosterExtractor(backend).from_file(path))
+
+
+def parse_in_order(snapshots, workers, backend=None):
+    """
+    Parses snapshots in parallel, while handing out the results in order. Only a bounded number of snapshots is
+    parsed ahead, so memory use does not depend on the number of snapshots.
+
+    :param snapshots: List of (datetime, location) tuples, in the order to hand them out.
+    :param workers: Number of processes to parse with.
+    :param backend: (Optional) Roster parser backend.
+    :return: Generator of (datetime, location, roster) tuples.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        upcoming = iter(snapshots)
+        for timestamp, path in upcoming:
+            pending.append((timestamp, path, executor.submit(parse_snapshot, path, backend)))
+            if len(pending) >= workers * 4:
+                break
+        while pending:
+            timestamp, path, future = pending.popleft()
+            # Keep the workers busy while this result is applied
+            for next_timestamp, next_path in upcoming:
+                pending.append((next_timestamp, next_path, executor.submit(parse_snapshot, next_path, backend)))
+                break
+            yield timestamp, path, future.result()
+
+
+def describe(changes):
+    """
+    :param changes: List of (joined/left/changed, family) tuples.
+    :return: Dictionary with the families that joined, left and changed.
+    """
+    described = {'joined': [], 'left': [], 'changed': []}
+    for change, family in changes:
+        described[change].append(family)
+    return described
+
+
+def open_sage(db_file):
+    """ Opens the database, keeping stdout clean for JSON. """
+    from sage import Sage
+    with contextlib.redirect_stdout(sys.stderr):
+        return Sage(db_file)
+
+
+def parse_command(args):
+    roster = RosterExtractor(args.parser).from_file(args.html)
+    return {'members': len(roster), 'roster': [{'family': name, 'page': page} for name, page in roster]}
+
+
+def update_command(args):
+    sage = open_sage(args.db)
+    try:
+        validators = None
+        if args.html:
+            timestamp = snapshot_time(args.html) if args.snapshot_time else None
+            roster = parse_snapshot(args.html, args.parser)
+        else:
+            from scraper import PA_Scraper
+            archive = None
+            if args.archive:
+                from archive import SnapshotArchive
+                archive = SnapshotArchive(args.archive)
+            scraper = PA_Scraper(args.guild, args.region, args.base_url, parser=args.parser, archive=archive)
+            if not args.force:
+                scraper.validators = sage.load_page_validators()
+
+            async def scrape():
+                try:
+                    return await scraper.scrape_roster()
+                finally:
+                    await scraper.close()
+                    if archive is not None:
+                        archive.close()
+            timestamp = None
+            roster = asyncio.run(scrape())
+            if roster is None:
+                return {'updated': False, 'reason': 'guild page did not change', 'since': str(sage.latest_update())}
+            validators = scraper.validators
+        if not roster:
+            raise SystemExit(f'No members found in {args.html or "guild page"}!')
+
+        if args.dry_run:
+            changes = sage.changes_of(sage.diff_roster(sage.stored_members(), roster))
+            since = sage.latest_update()
+        else:
+            changes = sage.compare_guild_members(roster, timestamp)
+            since = sage.last_update
+            if validators is not None:
+                sage.store_page_validators(validators)
+            elif args.html:
+                # The database no longer reflects the last scraped page
+                sage.store_page_validators({})
+        return {'updated': not args.dry_run, 'since': str(since), 'members': len(roster), 'changes': describe(changes)}
+    finally:
+        sage.close()
+
+
+def report_command(args):
+    sage = open_sage(args.db)
+    try:
+        since = datetime.fromisoformat(args.since)
+        events = sage.db.get_events_since(since, args.limit)
+        return {'since': str(since), 'events': [{'family': family, 'event': event, 'timestamp': timestamp,
+                                                  'old_rank': old_rank, 'new_rank': new_rank}
+                                                 for family, event, timestamp, old_rank, new_rank in events]}
+    finally:
+        sage.close()
+
+
+def backfill_command(args):
+    started = time.perf_counter()
+    snapshots = find_snapshots(args.directory, args.pattern)
+    sage = open_sage(args.db)
+    try:
+        # History can only be added after what is already known, which also makes an interrupted backfill resumable.
+        # A database without any events has no history yet, whatever its time of last update.
+        latest = sage.latest_update() if sage.latest_event() is not None else None
+        todo = [(timestamp, path) for timestamp, path in snapshots if latest is None or timestamp > latest]
+        skipped = []
+        current = {}
+
+        def rosters():
+            for number, (timestamp, path, roster) in enumerate(parse_in_order(todo, args.workers, args.parser), 1):
+                if number % 100 == 0:
+                    print(f'Backfilled {number}/{len(todo)} snapshots', file=sys.stderr)
+                # A page without members is an error page rather than an empty guild, it would make everybody leave
+                if not roster:
+                    skipped.append(path)
+                    continue
+                current['file'] = path
+                yield timestamp, roster
+
+        applied = 0
+        events = 0
+        changes_per_snapshot = []
+        for timestamp, changes in sage.replay_rosters(rosters()):
+            applied += 1
+            events += len(changes)
+            if changes:
+                described = describe(changes) if args.changes else {'changes': len(changes)}
+                changes_per_snapshot.append({'timestamp': str(timestamp), 'file': current['file'], **described})
+        seconds = time.perf_counter() - started
+        return {'snapshots': len(snapshots), 'already_known': len(snapshots) - len(todo), 'applied': applied,
+                'without_members': skipped, 'events': events, 'seconds': round(seconds, 3),
+                'snapshots_per_second': round(applied / seconds, 1) if seconds else None,
+                'changes': changes_per_snapshot}
+    finally:
+        sage.close()
+
+
+def replay_command(args):
+    from archive import SnapshotArchive
+    started = time.perf_counter()
+    archive = SnapshotArchive(args.archive)
+    sage = open_sage(args.db)
+    try:
+        # As for backfill, only what happened after the latest known update can be added
+        latest = sage.latest_update() if sage.latest_event() is not None else None
+        since = datetime.fromisoformat(args.since) if args.since else None
+        until = datetime.fromisoformat(args.until) if args.until else None
+        rosters = ((timestamp, roster) for timestamp, roster in archive.replay(since, until)
+                   if latest is None or timestamp > latest)
+
+        applied = 0
+        events = 0
+        changes_per_snapshot = []
+        for timestamp, changes in sage.replay_rosters(rosters):
+            applied += 1
+            events += len(changes)
+            if changes:
+                described = describe(changes) if args.changes else {'changes': len(changes)}
+                changes_per_snapshot.append({'timestamp': str(timestamp), **described})
+        seconds = time.perf_counter() - started
+        return {'archive': archive.stats(), 'applied': applied, 'events': events, 'seconds': round(seconds, 3),
+                'changes': changes_per_snapshot}
+    finally:
+        sage.close()
+        archive.close()
+
+
+def backup_command(args):
+    from backups import Backups
+    sage = open_sage(args.db)
+    try:
+        return Backups(sage.db, args.directory, args.keep, pages=args.pages).create()
+    finally:
+        sage.close()
+
+
+def restore_command(args):
+    from backups import Backups
+    sage = open_sage(args.db)
+    try:
+        return sage.restore_backup(Backups(sage.db, args.directory, pages=args.pages), args.file)
+    finally:
+        sage.close()
+
+
+def profiles_command(args):
+    from crawler import ProfileCrawler
+    from datetime import timedelta
+    sage = open_sage(args.db)
+    crawler = ProfileCrawler(args.concurrency, args.rate, timedelta(hours=args.ttl_hours), args.base_url,
+                             parser=args.parser)
+
+    async def crawl():
+        try:
+            return await crawler.crawl(sage, limit=args.limit)
+        finally:
+            await crawler.close()
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            return asyncio.run(crawl())
+    finally:
+        sage.close()
+
+
+def stats_command(args):
+    sage = open_sage(args.db)
+    try:
+        stats = sage.roster_stats(weeks=args.weeks, longest=args.longest)
+        if args.verify or args.repair:
+            stats['differences'] = sage.verify_tenure_aggregates(repair=args.repair)
+        return stats
+    finally:
+        sage.close()
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    arg_parser = argparse.ArgumentParser(description='Run the roster pipeline without Discord, printing JSON.')
+    arg_parser.add_argument('--db', default=os.getenv('DB'), help='Database file (default: $DB)')
+    arg_parser.add_argument('--parser', choices=RosterExtractor.BACKENDS, help='Roster parser backend')
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    parse = subparsers.add_parser('parse', help='Extract the roster from a saved guild profile page')
+    parse.add_argument('html', help='Saved guild profile page')
+    parse.set_defaults(run=parse_command)
+
+    update = subparsers.add_parser('update', help='Scrape (or read) the roster and apply its changes')
+    update.add_argument('--html', help='Read the guild profile page from disk rather than scraping it')
+    update.add_argument('--snapshot-time', action='store_true',
+                        help='Date the changes at the time in the name (or modification time) of the --html file')
+    update.add_argument('--guild', default=os.getenv('GUILD_NAME'), help='Guild name (default: $GUILD_NAME)')
+    update.add_argument('--region', default=os.getenv('REGION'), help='Region (default: $REGION)')
+    update.add_argument('--base-url', default=os.getenv('PA_BASE_URL', 'https://www.naeu.playblackdesert.com'),
+                        help='Host to scrape (default: $PA_BASE_URL)')
+    update.add_argument('--archive', default=os.getenv('ARCHIVE_DIR'),
+                        help='Archive the scraped page and its roster in this directory (default: $ARCHIVE_DIR)')
+    update.add_argument('--force', action='store_true', help='Fetch the page even if it did not change')
+    update.add_argument('--dry-run', action='store_true', help='Only report changes, do not apply them')
+    update.set_defaults(run=update_command)
+
+    report = subparsers.add_parser('report', help='List roster events since a moment')
+    report.add_argument('--since', required=True, help='Date (and time), e.g. 2024-01-31 or "2024-01-31 18:00"')
+    report.add_argument('--limit', type=int, default=1000, help='Maximum number of events (default: %(default)s)')
+    report.set_defaults(run=report_command)
+
+    backfill = subparsers.add_parser('backfill', help='Apply a directory of timestamped snapshots in order')
+    backfill.add_argument('directory', help='Directory holding saved guild profile pages')
+    backfill.add_argument('--pattern', default='*.htm*', help='File names of snapshots (default: %(default)s)')
+    backfill.add_argument('--workers', type=int, default=os.cpu_count(),
+                          help='Processes parsing snapshots (default: number of CPUs)')
+    backfill.add_argument('--changes', action='store_true', help='List the families involved in every change')
+    backfill.set_defaults(run=backfill_command)
+
+    replay = subparsers.add_parser('replay', help='Apply the rosters in a snapshot archive in order')
+    replay.add_argument('archive', help='Directory of the snapshot archive')
+    replay.add_argument('--since', help='Only replay snapshots from this date (and time)')
+    replay.add_argument('--until', help='Only replay snapshots up to this date (and time)')
+    replay.add_argument('--changes', action='store_true', help='List the families involved in every change')
+    replay.set_defaults(run=replay_command)
+
+    backup = subparsers.add_parser('backup', help='Back up the database, keeping a number of recent backups')
+    backup.add_argument('directory', help='Directory to keep backups in')
+    backup.add_argument('--keep', type=int, default=7, help='Number of backups to keep (default: %(default)s)')
+    backup.add_argument('--pages', type=int, default=1024,
+                        help='Database pages copied per step (default: %(default)s)')
+    backup.set_defaults(run=backup_command)
+
+    restore = subparsers.add_parser('restore', help='Replace the database by a backup')
+    restore.add_argument('directory', help='Directory backups are kept in')
+    restore.add_argument('--file', help='Backup to restore (default: the latest)')
+    restore.add_argument('--pages', type=int, default=1024,
+                         help='Database pages copied per step (default: %(default)s)')
+    restore.set_defaults(run=restore_command)
+
+    profiles = subparsers.add_parser('profiles', help='Fetch the profiles of members that are new or outdated')
+    profiles.add_argument('--concurrency', type=int, default=4,
+                          help='Family pages fetched at once (default: %(default)s)')
+    profiles.add_argument('--rate', type=float, default=10.0,
+                          help='Requests per second to a single host (default: %(default)s)')
+    profiles.add_argument('--ttl-hours', type=float, default=168.0,
+                          help='Fetch profiles older than this again (default: %(default)s)')
+    profiles.add_argument('--limit', type=int, help='Maximum number of family pages to fetch')
+    profiles.add_argument('--base-url', help='Host to fetch family pages from instead of the one they link to')
+    profiles.set_defaults(run=profiles_command)
+
+    stats = subparsers.add_parser('stats', help='Show churn and tenure statistics of the roster')
+    stats.add_argument('--weeks', type=int, default=8, help='Most recent weeks to list (default: %(default)s)')
+    stats.add_argument('--longest', type=int, default=5,
+                       help='Longest serving members to list (default: %(default)s)')
+    stats.add_argument('--verify', action='store_true',
+                       help='Compare the statistics to a recomputation from the full roster history')
+    stats.add_argument('--repair', action='store_true', help='Verify, and replace the statistics if they differ')
+    stats.set_defaults(run=stats_command)
+
+    args = arg_parser.parse_args(argv)
+    if args.command != 'parse' and not args.db:
+        arg_parser.error('no database given, use --db or set DB')
+    json.dump(args.run(args), sys.stdout, indent=2, default=str)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
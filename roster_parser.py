@@ -0,0 +1,240 @@
+from html.parser import HTMLParser
+from importlib.util import find_spec
+
+# lxml is optional, it is only used as a faster backend when installed (and only imported once it is used)
+LXML_AVAILABLE = find_spec('lxml') is not None
+
+# Selector of the anchors holding family names (and links to family pages) on the guild profile page
+ROSTER_SELECTOR = '.adventure_list_table li div span .text a'
+
+# Elements that never have an end tag and thus never enclose anything
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source',
+                 'track', 'wbr'}
+
+# Size of the pieces HTML is fed to the streaming parser in
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_selector(selector):
+    """
+    Splits a selector of descendant combinators into (tag, classes) compounds.
+
+    :param selector: Selector such as '.adventure_list_table li a'. Only tags and classes are supported.
+    :return: List of (tag or None, set of classes) tuples, outermost first.
+    """
+    compounds = []
+    for part in selector.split():
+        tag, *classes = part.split('.')
+        compounds.append((tag.lower() or None, set(classes)))
+    return compounds
+
+
+def matches(compound, tag, classes):
+    """
+    Checks whether an element satisfies a single compound of a selector.
+
+    :param compound: (tag or None, set of classes) tuple.
+    :param tag: Tag of the element.
+    :param classes: Set of classes of the element.
+    :return: Whether or not the element matches.
+    """
+    return (compound[0] is None or compound[0] == tag) and compound[1] <= classes
+
+
+def selector_matches(compounds, stack, tag, classes):
+    """
+    Checks whether an element about to be opened is matched by a full selector.
+    Descendant combinators are matched greedily from the innermost ancestor outward.
+
+    :param compounds: Compounds of the selector, as returned by parse_selector.
+    :param stack: Open ancestors of the element as (tag, set of classes) tuples, outermost first.
+    :param tag: Tag of the element.
+    :param classes: Set of classes of the element.
+    :return: Whether or not the element is matched.
+    """
+    if not matches(compounds[-1], tag, classes):
+        return False
+    remaining = len(compounds) - 2
+    for ancestor_tag, ancestor_classes in reversed(stack):
+        if remaining < 0:
+            break
+        if matches(compounds[remaining], ancestor_tag, ancestor_classes):
+            remaining -= 1
+    return remaining < 0
+
+
+class _ListEnded(Exception):
+    """ Raised from within the parser to stop reading once the member list has been read. """
+
+
+class RosterParser(HTMLParser):
+    """
+    Event-driven parser that only keeps track of the open elements and collects the anchors matching a selector.
+    No tree is built, and parsing stops as soon as the element holding the member list is closed.
+    """
+
+    def __init__(self, selector=ROSTER_SELECTOR):
+        """
+        :param selector: Selector of the anchors to collect, consisting of descendant combinators only.
+        """
+        super().__init__(convert_charrefs=True)
+        self.compounds = parse_selector(selector)
+        # Open elements as (tag, set of classes) tuples, outermost first
+        self.stack = []
+        # Depth of the element holding the member list, None while outside of it
+        self.list_depth = None
+        # Anchor currently being read as [text fragments, href], None while outside of one
+        self.anchor = None
+        self.anchor_depth = None
+        self.members = []
+
+    def selector_matches(self, tag, classes):
+        """
+        Checks whether the element about to be opened is matched by the full selector.
+        Descendant combinators are matched greedily from the innermost ancestor outward.
+
+        :param tag: Tag of the element.
+        :param classes: Set of classes of the element.
+        :return: Whether or not the element is matched.
+        """
+        return selector_matches(self.compounds, self.stack, tag, classes)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = set((attrs.get('class') or '').split())
+        if self.anchor is None and self.selector_matches(tag, classes):
+            self.anchor = [[], attrs.get('href')]
+            self.anchor_depth = len(self.stack)
+        if tag in VOID_ELEMENTS:
+            return
+        # Remember where the member list starts, so we know when to stop
+        if self.list_depth is None and matches(self.compounds[0], tag, classes):
+            self.list_depth = len(self.stack)
+        self.stack.append((tag, classes))
+
+    def handle_startendtag(self, tag, attrs):
+        # Self-closing elements cannot contain members, only record a match
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # Ignore stray end tags, otherwise close everything up to the matching start tag
+        for depth in range(len(self.stack) - 1, -1, -1):
+            if self.stack[depth][0] == tag:
+                break
+        else:
+            return
+        del self.stack[depth:]
+
+        if self.anchor is not None and depth <= self.anchor_depth:
+            self.members.append((''.join(self.anchor[0]).strip(), self.anchor[1]))
+            self.anchor = None
+        if self.list_depth is not None and depth <= self.list_depth:
+            self.list_depth = None
+            if self.members:
+                raise _ListEnded
+
+    def handle_data(self, data):
+        if self.anchor is not None:
+            self.anchor[0].append(data)
+
+
+def parse_stream(chunks, selector=ROSTER_SELECTOR):
+    """
+    Streams HTML through a RosterParser, reading no further than the end of the member list.
+
+    :param chunks: Iterable of HTML strings.
+    :param selector: Selector of the anchors to collect.
+    :return: List of (name, link to family page) tuples.
+    """
+    parser = RosterParser(selector)
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+    except _ListEnded:
+        pass
+    return parser.members
+
+
+def selector_to_xpath(selector):
+    """
+    Translates a selector of descendant combinators into an equivalent XPath expression.
+    Ancestors are matched in nested predicates of a single step, a chain of descendant steps (//a//b//c) makes libxml2
+    merge node sets for every context node, which takes quadratic time on long lists.
+
+    :param selector: Selector consisting of tags and classes.
+    :return: XPath expression.
+    """
+    steps = []
+    for tag, classes in parse_selector(selector):
+        step = tag or '*'
+        for cls in sorted(classes):
+            step += f"[contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')]"
+        steps.append(step)
+    expression = steps[0]
+    for step in steps[1:]:
+        expression = f'{step}[ancestor::{expression}]'
+    return '//' + expression
+
+
+def parse_lxml(html, selector=ROSTER_SELECTOR):
+    """
+    Extracts the members with lxml, which builds a tree but does so in C.
+
+    :param html: HTML string.
+    :param selector: Selector of the anchors to collect.
+    :return: List of (name, link to family page) tuples.
+    """
+    from lxml import html as lxml_html
+    tree = lxml_html.fromstring(html)
+    return [(anchor.text_content().strip(), anchor.get('href')) for anchor in tree.xpath(selector_to_xpath(selector))]
+
+
+def chunked(text, size=CHUNK_SIZE):
+    """ Splits a string into pieces of at most size characters. """
+    return (text[idx:idx + size] for idx in range(0, len(text), size))
+
+
+class RosterExtractor:
+    """
+    Extracts (name, link to family page) tuples of guild members from guild profile HTML.
+    """
+
+    # Available backends, in order of preference
+    BACKENDS = ('lxml', 'stream')
+
+    def __init__(self, backend=None, selector=ROSTER_SELECTOR):
+        """
+        :param backend: (Optional) 'stream' or 'lxml'. Defaults to the fastest backend that is installed.
+        :param selector: Selector of the anchors to collect.
+        """
+        if backend is None:
+            backend = 'lxml' if LXML_AVAILABLE else 'stream'
+        if backend not in self.BACKENDS:
+            raise ValueError(f'Unknown roster parser backend {backend}!')
+        if backend == 'lxml' and not LXML_AVAILABLE:
+            raise ImportError('The lxml backend requires lxml to be installed.')
+        self.backend = backend
+        self.selector = selector
+
+    def from_html(self, html):
+        """
+        :param html: HTML string.
+        :return: List of (name, link to family page) tuples.
+        """
+        if self.backend == 'lxml':
+            return parse_lxml(html, self.selector)
+        return parse_stream(chunked(html), self.selector)
+
+    def from_file(self, html_loc):
+        """
+        :param html_loc: Location of HTML stored on disk.
+        :return: List of (name, link to family page) tuples.
+        """
+        with open(html_loc) as html_file:
+            if self.backend == 'lxml':
+                return parse_lxml(html_file.read(), self.selector)
+            # Read from disk piece by piece, leaving the rest of the file unread once the list has ended
+            return parse_stream(iter(lambda: html_file.read(CHUNK_SIZE), ''), self.selector)
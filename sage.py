@@ -1,65 +1,208 @@
-from db_handler import DB_Handler
+import threading
+from datetime import datetime, timedelta
+from db_handler import DB_Handler, epoch_seconds, week_of
+from cache import LRUCache
+from roster import Roster
+
+# Validators of the guild profile page, stored as page_<key> variables
+PAGE_VALIDATORS = ('etag', 'last_modified', 'body_hash')
 
 class Sage:
     """
     Takes care of the complex logic of what to do with retrieved information and what is stored in the database.
     """
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, cache_size=1024, thread_readers=True):
         """
         Make sure database is ready.
 
         Args:
             db_file (str): Name (and location) of the database file
+            cache_size (int): Maximum number of aliases and of pages kept in memory
+            thread_readers (bool): Whether every worker thread reads through a database connection of its own
         """
-        self.db = DB_Handler(db_file)
-        # Connect to the database and store last update datetime
+        self.db = DB_Handler(db_file, thread_readers)
+        # Frequently requested aliases and pages are answered from memory, including those that do not exist
+        self.alias_cache = LRUCache(cache_size)
+        self.page_cache = LRUCache(cache_size)
+        # Serialises roster diffs, which may run on worker threads
+        self.roster_lock = threading.Lock()
+        # Stored roster of the last diff, kept together with the time of last update it belongs to
+        self.stored_roster = None
+        # Connect to the database for the lifetime of the bot, bring its schema up to date and store last update datetime
         self.db.create_connection()
+        self.db.migrate()
         self.last_update = self.db.get_last_update()
-        self.db.close_connection()
 
-    def compare_guild_members(self, new_roster):
+    def compare_guild_members(self, new_roster, timestamp=None):
         """
-        Checks if there are changes to the roster since last update.
+        Checks if there are changes to the roster since last update and applies them to the database.
+        Joins, leaves and changes of rank or family page are applied together in a single transaction.
 
-        :param new_roster: List of all families (in name, page tuples) currently in the guild.
-        :return: List of all changes to the roster since last update.
+        :param new_roster: Roster of all families currently in the guild, or list of (name, page) tuples optionally
+                           followed by rank.
+        :param timestamp: (Optional) Datetime the roster was seen at, defaults to now.
+        :return: List of all changes to the roster since last update, as (joined/left/changed, family) tuples.
         """
-        # Extract names from (name, family_page) tuples for comparison
-        new_names = [family[0] for family in new_roster]
+        # Diffs read the stored roster before writing the new one, so only one may run at a time
+        with self.roster_lock:
+            # Retrieve the old roster and when it was last updated from the database
+            self.last_update = self.db.get_last_update()
+            old = self.stored_members()
+            new = new_roster if isinstance(new_roster, Roster) else Roster(new_roster)
+            changes = self.apply_diff(self.diff_roster(old, new), timestamp)
+            # Keep what is stored now for the next diff, ranks the page does not show included
+            self.remember_members(new.with_ranks_of(old))
+            return changes
 
-        # Connect to the database and update
-        self.db.create_connection()
-        self.last_update = self.db.get_last_update()
-        self.db.update_last_update()
-
-        # Initialise list of changes and retrieve old roster from database
-        roster_changes = []
-        old_names = self.db.get_all_guild_members()
-        # Add new members to the database and change list
-        for new_member in [family for family in new_roster if family[0] not in old_names]:
-            self.db.add_guild_member(new_member[0], family_page=new_member[1])
-            roster_changes.append(('joined', new_member[0]))
-        # Delete old members from the database and add to change list
-        for old_member in [family for family in old_names if family not in new_names]:
-            self.db.remove_guild_member(old_member)
-            roster_changes.append(('left', old_member))
-
-        # Close connection to the database and provide list of roster changes
-        self.db.close_connection()
-        return roster_changes
+    def replay_rosters(self, rosters):
+        """
+        Applies a series of rosters in order, e.g. to backfill the roster history from saved pages.
+        The stored roster is kept in memory in between, rather than read back from the database for every roster.
+        Nothing else may change the roster meanwhile.
+
+        :param rosters: Iterable of (datetime, roster) tuples, oldest first. Rosters are as in compare_guild_members.
+        :return: Generator of (datetime, list of changes) tuples, one per applied roster.
+        """
+        with self.roster_lock:
+            members = self.stored_members()
+            for timestamp, roster in rosters:
+                roster = roster if isinstance(roster, Roster) else Roster(roster)
+                self.last_update = self.db.get_last_update()
+                diff = self.diff_roster(members, roster)
+                changes = self.apply_diff(diff, timestamp)
+                # The database keeps ranks the scraped page does not show
+                members = roster.with_ranks_of(members)
+                self.remember_members(members)
+                yield timestamp, changes
 
-    def replace_alias(self, family, disc_name):
+    def stored_members(self):
+        """
+        Provides the stored roster. It is only read from the database if another connection (e.g. of another process)
+        has written to it since the last diff, which the data version of the database tells, however soon after.
+
+        :return: Roster of the stored members, with their ranks.
+        """
+        if self.stored_roster is not None and self.stored_roster[0] == self.db.get_data_version():
+            return self.stored_roster[1]
+        return Roster.from_stored(self.db.get_guild_members())
+
+    def remember_members(self, roster):
+        """
+        Keeps the roster that has just been stored, so the next diff does not have to read it back.
+
+        :param roster: Roster of the stored members, with their ranks.
+        """
+        self.stored_roster = (self.db.get_data_version(), roster)
+
+    def diff_roster(self, old_members, new_roster):
+        """
+        Compares a new roster to the stored one, without touching the database.
+
+        :param old_members: Roster of the stored members, or dictionary with family names as keys and
+                            (rank, family_page) values.
+        :param new_roster: Roster of all families currently in the guild, or list of (name, page) tuples optionally
+                           followed by rank.
+        :return: Tuple of joined and changed (family, rank, family_page) tuples, left family names and
+                 (family, event, old_rank, new_rank) events.
+        """
+        old = old_members if isinstance(old_members, Roster) else Roster.from_stored(old_members)
+        new = new_roster if isinstance(new_roster, Roster) else Roster(new_roster)
+
+        # Both rosters are sorted by name, so they are compared in a single pass
+        joined_members, left_members, changed_members = new.diff(old)
+        joined = [(new.names[index], new.rank(index), new.link(index)) for index in joined_members]
+        left = [old.names[old_index] for old_index in left_members]
+        # A missing rank means the scraped page does not show it, which is no reason to forget the stored one
+        changed = [(new.names[index], new.rank(index) if new.rank(index) is not None else old.rank(old_index),
+                    new.link(index)) for old_index, index in changed_members]
+
+        # Describe every change as an event, keeping track of ranks
+        events = [(family, 'joined', None, rank) for family, rank, _ in joined] + \
+                 [(old.names[old_index], 'left', old.rank(old_index), None) for old_index in left_members] + \
+                 [(family, 'changed', old.rank(old_index), rank)
+                  for (old_index, _), (family, rank, _) in zip(changed_members, changed)]
+        return joined, left, changed, events
+
+    def apply_diff(self, diff, timestamp=None):
+        """
+        Stores a roster diff and its events at once, and forgets cached pages of all families involved.
+
+        :param diff: Tuple of joined, left, changed and events as provided by diff_roster.
+        :param timestamp: (Optional) Datetime of the changes, defaults to now.
+        :return: List of all changes, as (joined/left/changed, family) tuples.
+        """
+        joined, left, changed, events = diff
+        self.db.apply_roster_changes(joined, left, changed, events, timestamp)
+        changes = self.changes_of(diff)
+        for _, family in changes:
+            self.page_cache.invalidate(family)
+        return changes
+
+    def changes_of(self, diff):
+        """
+        Lists the changes a roster diff consists of.
+
+        :param diff: Tuple of joined, left, changed and events as provided by diff_roster.
+        :return: List of (joined/left/changed, family) tuples.
+        """
+        joined, left, changed, _ = diff
+        return [('joined', family[0]) for family in joined] + [('left', family) for family in left] + \
+               [('changed', family[0]) for family in changed]
+
+    def latest_update(self):
+        """
+        Retrieves when the roster was last updated.
+
+        :return: Date and time of the latest update.
+        """
+        return self.db.get_last_update()
+
+    def load_page_validators(self):
+        """
+        Retrieves the validators of the last guild profile page that was applied to the database.
+
+        :return: Dictionary with etag, last_modified and body_hash (None if unknown).
+        """
+        return {key: self.db.get_variable(f'page_{key}') or None for key in PAGE_VALIDATORS}
+
+    def store_page_validators(self, validators):
+        """
+        Stores the validators of the guild profile page the database now reflects.
+
+        :param validators: Dictionary with etag, last_modified and body_hash. Missing values clear the stored ones.
+        """
+        for key in PAGE_VALIDATORS:
+            self.db.replace_variable(f'page_{key}', validators.get(key) or '')
+
+    def get_roster_messages(self, channel_id):
+        """
+        Retrieves which messages the roster is posted as in a channel.
+
+        :param channel_id: Discord channel ID.
+        :return: Dictionary with page numbers as keys and (message ID, content hash) tuples as values.
+        """
+        return self.db.get_roster_messages(channel_id)
+
+    def store_roster_messages(self, channel_id, messages):
+        """
+        Stores which messages the roster is posted as in a channel.
+
+        :param channel_id: Discord channel ID.
+        :param messages: List of (page number, message ID, content hash) tuples of all pages.
+        """
+        self.db.replace_roster_messages(channel_id, messages)
+
+    def replace_alias(self, family, disc_name, disc_id=None):
         """
         Replaces or adds alias to the database.
 
         :param family: In-game family name.
         :param disc_name: Discord name.
+        :param disc_id: (Optional) Discord user ID, allowing the family to be found by mentioning the user.
         """
-        # Connect to the database and replace/add alias
-        self.db.create_connection()
-        self.db.replace_alias(family, disc_name)
-        self.db.close_connection()
+        self.db.replace_alias(family, disc_name, disc_id)
+        self.alias_cache.invalidate(family)
 
     def remove_alias(self, disc_name):
         """
@@ -67,10 +210,8 @@ class Sage:
 
         :param disc_name: Discord name.
         """
-        # Connect to the database and replace/add alias
-        self.db.create_connection()
         self.db.remove_alias(disc_name)
-        self.db.close_connection()
+        self.alias_cache.invalidate_value(disc_name)
 
     def find_alias(self, family):
         """
@@ -78,12 +219,14 @@ class Sage:
 
         :param family: In-game family name.
         """
-        # Connect to the database and search for alias
-        self.db.create_connection()
-        alias = self.db.find_alias(family)
-        self.db.close_connection()
-        if alias:
-            return alias[0]
+        found, alias = self.alias_cache.get(family)
+        if not found:
+            # An alias changed while reading forgets cached aliases, the alias read here is then not kept
+            generation = self.alias_cache.generation
+            row = self.db.find_alias(family)
+            alias = row[0] if row else None
+            self.alias_cache.put(family, alias, generation)
+        return alias
 
     def find_page(self, family):
         """
@@ -91,12 +234,200 @@ class Sage:
 
         :param family: In-game family name.
         """
-        # Connect to the database and search for page
-        self.db.create_connection()
-        page = self.db.find_page(family)
+        found, page = self.page_cache.get(family)
+        if not found:
+            # A roster change stored while reading forgets cached pages, the page read here is then not kept
+            generation = self.page_cache.generation
+            row = self.db.find_page(family)
+            page = row[0] if row else None
+            self.page_cache.put(family, page, generation)
+        return page
+
+    def changes_since(self, since, limit=1000):
+        """
+        Retrieves the roster changes from a moment onward, up to a maximum number of changes.
+
+        :param since: Datetime from which to retrieve changes.
+        :param limit: Maximum number of changes to retrieve.
+        :return: Tuple of a list of (joined/left/changed, family) tuples, oldest first, and the datetime of the last
+                 change listed if more changes followed it (None if the list is complete).
+        """
+        # Retrieve one more than asked for, to know whether the list is complete
+        events = self.db.get_events_since(since, limit + 1)
+        cut_off = datetime.strptime(events[limit - 1][2], '%Y-%m-%d %H:%M:%S') if len(events) > limit else None
+        return [(event, family) for family, event, *_ in events[:limit]], cut_off
+
+    def latest_event(self):
+        """
+        Retrieves when the roster last changed.
+
+        :return: Datetime of the most recent roster event, None if none have been recorded.
+        """
+        return self.db.get_latest_event_time()
+
+    def family_history(self, family):
+        """
+        Retrieves all roster events of a family.
+
+        :param family: In-game family name.
+        :return: List of (family, event, timestamp, old_rank, new_rank) tuples, most recent first.
+        """
+        return self.db.get_family_events(family)
+
+    def roster_stats(self, now=None, weeks=8, longest=5):
+        """
+        Provides churn and tenure statistics of the roster from the aggregates kept up to date by every diff, so the
+        time taken does not grow with the roster history.
+
+        :param now: (Optional) Datetime to measure tenure up to, defaults to now.
+        :param weeks: Number of most recent weeks to list joins and leaves of.
+        :param longest: Number of longest serving members to list.
+        :return: Dictionary with the number of members, their average tenure, the number of members who left and the
+                 average length of their stints (timedeltas, None if there are none), (week, joins, leaves) tuples
+                 of the most recent weeks first and (family, since) tuples of the longest serving members.
+        """
+        stats = self.db.get_roster_stats(weeks, longest)
+        members, stints = stats['members'], stats['stints']
+        return {'members': members,
+                'average_tenure': timedelta(seconds=epoch_seconds(now or datetime.now()) -
+                                            stats['since_seconds'] / members) if members else None,
+                'left': stints,
+                'average_stint': timedelta(seconds=stats['stint_seconds'] / stints) if stints else None,
+                'weeks': [(datetime.strptime(week, '%Y-%m-%d').date(), joins, leaves)
+                          for week, joins, leaves in stats['weeks']],
+                'longest': [(family, datetime.strptime(since, '%Y-%m-%d %H:%M:%S'))
+                            for family, since in stats['longest']]}
+
+    def recompute_tenure_aggregates(self):
+        """
+        Computes the churn and tenure aggregates from the full roster history, as the incremental updates should
+        have kept them. Every leave ends a stint started by the join before it, members who joined before roster
+        events were logged count from the tenure origin.
+
+        :return: Aggregates, as returned by DB_Handler.get_tenure_aggregates.
+        """
+        origin = self.db.get_variable('tenure_origin')
+        weeks, last_joined, previous = {}, {}, {}
+        stints = stint_seconds = 0
+        for family, event, timestamp in self.db.get_membership_events():
+            moment = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+            joins, leaves = weeks.get(week_of(moment), (0, 0))
+            if event == 'joined':
+                weeks[week_of(moment)] = (joins + 1, leaves)
+                last_joined[family] = timestamp
+            else:
+                weeks[week_of(moment)] = (joins, leaves + 1)
+                started = previous[family][1] if previous.get(family, (None,))[0] == 'joined' else origin
+                stints += 1
+                stint_seconds += epoch_seconds(moment) - \
+                    epoch_seconds(datetime.strptime(started, '%Y-%m-%d %H:%M:%S'))
+            previous[family] = (event, timestamp)
+        tenure = {family: last_joined.get(family, origin) for family in self.db.get_all_guild_members()}
+        since_seconds = sum(epoch_seconds(datetime.strptime(since, '%Y-%m-%d %H:%M:%S')) for since in tenure.values())
+        return {'weeks': weeks, 'tenure': tenure, 'totals': (len(tenure), since_seconds, stints, stint_seconds)}
+
+    def verify_tenure_aggregates(self, repair=False):
+        """
+        Compares the churn and tenure aggregates to a recomputation from the full roster history.
+
+        :param repair: Whether to replace the aggregates by the recomputation if they differ.
+        :return: List of descriptions of differences, empty if the aggregates are correct.
+        """
+        with self.roster_lock:
+            stored = self.db.get_tenure_aggregates()
+            expected = self.recompute_tenure_aggregates()
+            differences = []
+            for week in sorted(set(stored['weeks']) | set(expected['weeks'])):
+                if stored['weeks'].get(week) != expected['weeks'].get(week):
+                    differences.append(f"week {week}: (joins, leaves) {stored['weeks'].get(week)} "
+                                       f"instead of {expected['weeks'].get(week)}")
+            for family in sorted(set(stored['tenure']) | set(expected['tenure'])):
+                if stored['tenure'].get(family) != expected['tenure'].get(family):
+                    differences.append(f"tenure of {family}: {stored['tenure'].get(family)} "
+                                       f"instead of {expected['tenure'].get(family)}")
+            if stored['totals'] != expected['totals']:
+                differences.append(f"totals (members, since_seconds, stints, stint_seconds): {stored['totals']} "
+                                   f"instead of {expected['totals']}")
+            if differences and repair:
+                self.db.replace_tenure_aggregates(expected)
+            return differences
+
+    def stale_profiles(self, ttl, limit=None):
+        """
+        Retrieves the guild members whose profile is due to be fetched.
+
+        :param ttl: Timedelta after which a fetched profile is stale.
+        :param limit: (Optional) Maximum number of members.
+        :return: List of (family, family_page) tuples, members without a profile first.
+        """
+        return self.db.get_stale_profiles(datetime.now() - ttl, limit)
+
+    def store_profiles(self, profiles):
+        """
+        Stores fetched profiles.
+
+        :param profiles: List of (family, family_page, profile) tuples, profile being None if the page showed no family.
+        """
+        self.db.replace_profiles(profiles)
+
+    def family_profile(self, family):
+        """
+        Retrieves the profile of a family, as read from its family page.
+
+        :param family: In-game family name.
+        :return: Dictionary with the profile, None if it was never fetched.
+        """
+        return self.db.get_profile(family)
+
+    def find_families(self, disc_id):
+        """
+        Finds all families of a Discord user.
+
+        :param disc_id: Discord user ID.
+        :return: List of family names.
+        """
+        return self.db.find_families_by_discord_id(disc_id)
+
+    def suggest_families(self, family, limit=3):
+        """
+        Suggests guild members with a name resembling a family that could not be found.
+
+        :param family: (Misspelled) family name.
+        :param limit: Maximum number of suggestions.
+        :return: List of family names, most similar first.
+        """
+        return self.db.search_families(family, limit)
+
+    def cache_stats(self):
+        """
+        Provides counters of the alias and page caches.
+
+        :return: Dictionary with statistics per cache.
+        """
+        return {'alias': self.alias_cache.stats(), 'page': self.page_cache.stats()}
+
+    def restore_backup(self, backups, location=None):
+        """
+        Replaces the database by a backup, bringing its schema up to date and forgetting everything cached.
+
+        :param backups: Backups to restore from.
+        :param location: (Optional) Location of the backup, defaults to the latest.
+        :return: Dictionary describing the restore, as returned by Backups.restore.
+        """
+        with self.roster_lock:
+            restored = backups.restore(location)
+            self.db.migrate()
+            self.alias_cache.clear()
+            self.page_cache.clear()
+            self.stored_roster = None
+            self.last_update = self.db.get_last_update()
+        return restored
+
+    def close(self):
+        """
+        Closes the connection to the database.
+        """
         self.db.close_connection()
-        if page:
-            return page[0]
 
     def dummy_roster_change(self):
-        return [('left', 'old_member'), ('left', 'kicked'), ('joined', 'nice_person')]
+        return [('left', 'old_member'), ('left', 'kicked'), ('joined', 'nice_person'), ('changed', 'promoted')]
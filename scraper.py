@@ -1,44 +1,182 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import hashlib
+from contextlib import nullcontext
+from datetime import datetime
+from time import perf_counter
+import aiohttp
+from metrics import SCRAPER, SCRAPER_RESPONSES
+from roster import Roster
+from roster_parser import RosterExtractor
 
 class PA_Scraper:
     """
     Scraper of the Black Desert Online website hosted by Pearl Abyss.
     """
 
-    def __init__(self, guild, region):
+    def __init__(self, guild, region, base_url='https://www.naeu.playblackdesert.com', connect_timeout=5.0,
+                 read_timeout=15.0, retries=3, backoff=0.5, pool_size=4, parser=None,
+                 archive=None, session=None, limiter=None):
         """
         Initialise with components and urls
+
+        :param guild: Name of the guild to scrape.
+        :param region: Region the guild resides in.
+        :param base_url: (Optional) Host to scrape, can be pointed at a local stand-in server.
+        :param connect_timeout: Seconds to wait for a connection to be established.
+        :param read_timeout: Seconds to wait for data between reads.
+        :param retries: Number of additional attempts after a failed request.
+        :param backoff: Initial delay in seconds between attempts, doubled after every attempt.
+        :param pool_size: Maximum number of pooled (keep-alive) connections.
+        :param parser: (Optional) Roster parser backend ('stream' or 'lxml'), defaults to the fastest available.
+        :param archive: (Optional) SnapshotArchive to keep every fetched page and its roster in.
+        :param session: (Optional) Client session shared with other scrapers, which is left open by close.
+        :param limiter: (Optional) Semaphore shared with other scrapers, limiting how many requests are in flight.
         """
-        # Listener preparation
-        self.sessy = requests.Session()  # Initialise session
         # URL of the webpage to scrape
-        self.url = f'https://www.naeu.playblackdesert.com/en-US/Adventure/Guild/GuildProfile?guildName={guild}&region={region}'
-        # Holder for response
-        self.response = None
-
-    def parse_roster(self, html_loc=None):
-        # Differentiate between reading html from disk or actually scraping it from the website
-        if html_loc:
-            # Read HTML from disk
-            with open(html_loc) as html_file:
-                soup = BeautifulSoup(html_file, 'html.parser')
-        else:
-            # Send a GET request to the URL
-            self.response = requests.get(self.url)
+        self.url = f'{base_url}/en-US/Adventure/Guild/GuildProfile?guildName={guild}&region={region}'
+        # Request behaviour
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        # Shared client session, created lazily since it has to live on the running event loop (unless given)
+        self.session = session
+        self.owns_session = session is None
+        # Many scrapers together should not flood the server, so they may take turns on a shared semaphore
+        self.limiter = limiter
+        # Extracts the member list without building a tree of the whole page
+        self.extractor = RosterExtractor(parser)
+        # Fetched pages and their rosters are archived for auditing and replay, when an archive is given
+        self.archive = archive
+        # Validators of the last parsed page, used to skip pages that did not change
+        self.reset_validators()
+
+    async def get_session(self):
+        """
+        Provides the shared client session, (re)creating it when there is none.
+
+        :return: Pooled aiohttp client session.
+        """
+        if self.owns_session and (self.session is None or self.session.closed):
+            # Connections are kept alive and reused between updates
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def fetch(self):
+        """
+        Retrieves the guild profile page without blocking the event loop.
+        The request is conditional on the stored validators, so an unchanged page is not sent again.
+        Failed attempts (connection errors, timeouts, server errors) are retried with exponential backoff.
+
+        :return: Tuple of the HTML of the guild profile page and its validators, or None if the page is unchanged.
+        """
+        start = perf_counter()
+        result = 'failed'
+        try:
+            session = await self.get_session()
+            # Ask the server to only send the page if it changed since the last update
+            headers = {}
+            if self.validators['etag']:
+                headers['If-None-Match'] = self.validators['etag']
+            if self.validators['last_modified']:
+                headers['If-Modified-Since'] = self.validators['last_modified']
 
-            # Create a BeautifulSoup object and specify the parser
-            soup = BeautifulSoup(self.response.text, 'html.parser')
+            delay = self.backoff
+            for attempt in range(self.retries + 1):
+                try:
+                    # The timeout is given per request, as a session shared with other scrapers may lack it
+                    async with self.limiter or nullcontext(), \
+                            session.get(self.url, headers=headers, timeout=self.timeout) as response:
+                        SCRAPER_RESPONSES.inc(str(response.status))
+                        # Rate limits and server errors are worth another try, other errors are not
+                        if response.status == 429 or response.status >= 500:
+                            raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                              status=response.status, message=response.reason)
+                        response.raise_for_status()
+                        if response.status == 304:
+                            result = 'not_modified'
+                            return None
+                        body = await response.read()
+                        break
+                except aiohttp.ClientResponseError as e:
+                    if (e.status != 429 and e.status < 500) or attempt == self.retries:
+                        raise
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    SCRAPER_RESPONSES.inc(type(e).__name__)
+                    if attempt == self.retries:
+                        raise
+                # Wait before trying again
+                await asyncio.sleep(delay)
+                delay *= 2
 
-        # Find the table (ul) of members by selecting it by class (adventure_list_table)
-        members = soup.select('.adventure_list_table li div span .text a')
+            # Servers without validator support still send the same body when nothing changed
+            body_hash = hashlib.sha256(body).hexdigest()
+            if body_hash == self.validators['body_hash']:
+                result = 'unchanged'
+                return None
+            validators = {'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified'),
+                          'body_hash': body_hash}
+            result = 'fetched'
+            return body.decode(response.get_encoding(), errors='replace'), validators
+        finally:
+            SCRAPER.observe(perf_counter() - start, 'fetch', result)
 
-        # Check if the table was found
+    async def scrape_roster(self, executor=None):
+        """
+        Fetches the guild profile page and parses the roster from it.
+        Parsing happens on a worker thread, so the event loop stays responsive.
+        Validators are only taken over once the page has been parsed successfully.
+        The page and its roster are archived, if there is an archive.
+
+        :param executor: (Optional) Executor to parse on, defaults to the event loop's default executor.
+        :return: Roster, or None if the page did not change since the last update.
+        """
+        fetched = await self.fetch()
+        if fetched is None:
+            return None
+        html, validators = fetched
+        loop = asyncio.get_running_loop()
+        roster = await loop.run_in_executor(executor, self.parse_roster, None, html)
+        if self.archive is not None:
+            # A failing archive should not hold up roster updates
+            try:
+                await loop.run_in_executor(executor, self.archive.store, datetime.now(), html, roster)
+            except Exception as e:
+                print(f'Could not archive the guild profile page: {e}')
+        self.validators = validators
+        return roster
+
+    def parse_roster(self, html_loc=None, html=None):
+        """
+        Extracts the roster from guild profile HTML.
+
+        :param html_loc: (Optional) Location of HTML stored on disk.
+        :param html: (Optional) HTML that has already been retrieved.
+        :return: Roster.
+        """
+        # Differentiate between reading html from disk or parsing what has been scraped from the website
+        with SCRAPER.time('parse', 'disk' if html_loc else 'page'):
+            if html_loc:
+                members = self.extractor.from_file(html_loc)
+            else:
+                members = self.extractor.from_html(html)
+
+        # Check if the table was found, members are (name, link to family page) tuples
         if members:
-            # Extract (name, link to family page) tuples and return those
-            return [(member.text.strip(), member['href']) for member in members]
+            return Roster(members)
         else:
             raise Exception(f'Cannot find any members on {self.url}!')
 
+    def reset_validators(self):
+        """ Forgets the validators of the last parsed page, so the next update fetches and parses it in full. """
+        self.validators = {'etag': None, 'last_modified': None, 'body_hash': None}
+
+    async def close(self):
+        """ Closes the client session and its pooled connections, unless it was given by somebody else. """
+        if self.owns_session and self.session is not None and not self.session.closed:
+            await self.session.close()
+
     def dummy_roster(self):
-        return ['Adventurer', 'Master', 'Member', 'Apprentice', 'Staff']
\ No newline at end of file
+        return ['Adventurer', 'Master', 'Member', 'Apprentice', 'Staff']
@@ -0,0 +1,308 @@
+"""
+Multi-tenant mode: a single bot serving the rosters of many guilds, each for a Discord server of its own.
+
+Tenants are configured in the tenants table of the main database. Every tenant keeps its roster in a database file of its
+own in the tenant directory, and gets its own scraper and Sage (with their caches), opened the first time the tenant is
+used. The scrapers of all tenants share one client session, and a single semaphore limits how many requests to Pearl
+Abyss are in flight at once, however many tenants refresh at the same time.
+"""
+import asyncio
+import os
+import re
+from time import monotonic
+import aiohttp
+from sage import Sage
+from scraper import PA_Scraper
+
+
+def split_setting(value):
+    """
+    :param value: Comma separated setting, as stored.
+    :return: List of its non-empty parts.
+    """
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+class Tenant:
+    """
+    A Discord server served by the bot, with the guild whose roster it follows, and the scraper and Sage following it.
+    The scraper and Sage are None until the tenant is opened.
+    """
+
+    def __init__(self, server_id, guild, region, roster_channel=0, serviced_channels=(), permitted_roles=(),
+                 roster_sort=False, roster_group_by_rank=False):
+        """
+        :param server_id: ID of the Discord server, None for the tenant configured by environment variables.
+        :param guild: Name of the guild.
+        :param region: Region the guild resides in.
+        :param roster_channel: ID of the channel to post the roster in automatically, 0 to not refresh automatically.
+        :param serviced_channels: Names of the channels commands are answered in.
+        :param permitted_roles: IDs of the roles allowed to command the bot, next to those permitted everywhere.
+        :param roster_sort: Whether to sort the roster by name.
+        :param roster_group_by_rank: Whether to list the roster per rank.
+        """
+        self.server_id = server_id
+        self.guild = guild
+        self.region = region
+        self.roster_channel = roster_channel
+        self.serviced_channels = list(serviced_channels)
+        self.permitted_roles = list(permitted_roles)
+        self.roster_sort = roster_sort
+        self.roster_group_by_rank = roster_group_by_rank
+        self.roster_loc = f'{guild}_roster.html'
+        self.scraper = None
+        self.sage = None
+        # Minutes between automatic refreshes, and the (monotonic) moment the next one is due
+        self.interval = None
+        self.due = 0.0
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :param row: Row of the tenants table, as returned by DB_Handler.get_tenants.
+        :return: Tenant, not opened yet.
+        """
+        server_id, guild, region, roster_channel, serviced_channels, permitted_roles, sort, group_by_rank = row
+        return cls(server_id, guild, region, roster_channel, split_setting(serviced_channels),
+                   [int(role) for role in split_setting(permitted_roles)], bool(sort), bool(group_by_rank))
+
+    def to_row(self):
+        """
+        :return: Row of the tenants table, as taken by DB_Handler.replace_tenant.
+        """
+        return (self.server_id, self.guild, self.region, self.roster_channel, ','.join(self.serviced_channels),
+                ','.join(map(str, self.permitted_roles)), int(self.roster_sort), int(self.roster_group_by_rank))
+
+    @property
+    def refresh_key(self):
+        """ Key of the single flight refreshing the roster of this tenant, see Workers.single_flight. """
+        return 'roster', self.server_id
+
+    async def refresh(self, workers):
+        """
+        Scrapes the roster and applies it to the database, with all blocking work done on worker threads.
+
+        :param workers: Workers to run blocking work on.
+        :return: Tuple of the current members, their changes and the time of the previous update,
+                 None if the guild page did not change at all.
+        """
+        cur_members = await self.scraper.scrape_roster(workers.executor)
+        if cur_members is None:
+            return None
+        # Apply roster changes and remember which page the database now reflects
+        changes = await workers.run(self.sage.compare_guild_members, cur_members)
+        last_update = self.sage.last_update
+        await workers.run(self.sage.store_page_validators, self.scraper.validators)
+        return cur_members, changes, last_update
+
+    def close(self):
+        """ Closes the database of the tenant, its scraper is closed together with the shared session. """
+        if self.sage is not None:
+            self.sage.close()
+            self.sage = None
+
+    def __repr__(self):
+        return f'Tenant({self.server_id!r}, {self.guild!r}, {self.region!r})'
+
+
+class Tenants:
+    """
+    Registry of the tenants of a multi-tenant bot, keyed by Discord server ID.
+    """
+
+    def __init__(self, db, directory, workers, base_url='https://www.naeu.playblackdesert.com', concurrency=8,
+                 cache_size=128, refresh_min_minutes=15, refresh_max_minutes=240):
+        """
+        :param db: DB_Handler of the main database, holding the configuration of tenants.
+        :param directory: Directory to keep the databases of tenants in, created if it does not exist.
+        :param workers: Workers to open databases and run blocking work on.
+        :param base_url: (Optional) Host to scrape, can be pointed at a local stand-in server.
+        :param concurrency: Maximum number of requests to the host in flight at once, over all tenants.
+        :param cache_size: Maximum number of aliases and of pages every tenant keeps in memory.
+        :param refresh_min_minutes: Minutes between automatic refreshes of a tenant whose roster keeps changing.
+        :param refresh_max_minutes: Maximum minutes between automatic refreshes of a tenant whose roster does not.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.db = db
+        self.directory = directory
+        self.workers = workers
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.limiter = asyncio.Semaphore(concurrency)
+        self.cache_size = cache_size
+        self.refresh_min_minutes = refresh_min_minutes
+        self.refresh_max_minutes = refresh_max_minutes
+        # Client session shared by the scrapers of all tenants, created lazily on the running event loop
+        self.session = None
+        self.tenants = {}
+
+    def load(self):
+        """
+        Reads the configuration of all tenants from the database, replacing what was loaded before.
+        Tenants that were opened already stay open if their guild did not change.
+        """
+        loaded = {}
+        for row in self.db.get_tenants():
+            tenant = self.carry_over(Tenant.from_row(row))
+            loaded[tenant.server_id] = tenant
+        for server_id, previous in self.tenants.items():
+            if server_id not in loaded or loaded[server_id].sage is not previous.sage:
+                previous.close()
+        self.tenants = loaded
+
+    def carry_over(self, tenant):
+        """
+        Takes over the scraper, Sage and schedule of the tenant that was loaded before, if it follows the same guild.
+
+        :param tenant: Newly configured tenant.
+        :return: The tenant.
+        """
+        previous = self.tenants.get(tenant.server_id)
+        if previous is not None and self.database(previous) == self.database(tenant):
+            tenant.scraper, tenant.sage = previous.scraper, previous.sage
+            tenant.interval, tenant.due = previous.interval, previous.due
+        return tenant
+
+    def get(self, server_id):
+        """
+        :param server_id: ID of a Discord server.
+        :return: Tenant of the server, None if the server is no tenant.
+        """
+        return self.tenants.get(server_id)
+
+    async def configure(self, tenant):
+        """
+        Stores the configuration of a tenant, replacing its previous configuration.
+        A tenant that now follows another guild gets a fresh database, the old one is kept in case it returns.
+        Only the database is written on a worker thread, the registry is changed on the event loop.
+
+        :param tenant: Tenant to store.
+        :return: The tenant, which takes over what was opened of its previous configuration.
+        """
+        await self.workers.run(self.db.replace_tenant, tenant.to_row())
+        previous = self.tenants.get(tenant.server_id)
+        self.tenants[tenant.server_id] = self.carry_over(tenant)
+        if previous is not None and previous.sage is not tenant.sage:
+            await self.retire(previous)
+        return tenant
+
+    async def remove(self, server_id):
+        """
+        Removes the configuration of a tenant and closes its database, which is kept on disk.
+
+        :param server_id: ID of the Discord server of the tenant.
+        :return: The removed tenant, None if the server was no tenant.
+        """
+        await self.workers.run(self.db.remove_tenant, server_id)
+        tenant = self.tenants.pop(server_id, None)
+        if tenant is not None:
+            await self.retire(tenant)
+        return tenant
+
+    async def retire(self, tenant):
+        """
+        Closes the database of a tenant that is no longer in the registry, once a refresh of it in flight is done.
+
+        :param tenant: Tenant to close.
+        """
+        flight = self.workers.flights.get(tenant.refresh_key)
+        if flight is not None:
+            await asyncio.wait([flight])
+        # Closing waits for the database lock, which a transaction on a worker thread may hold
+        await self.workers.run(tenant.close)
+
+    def database(self, tenant):
+        """
+        :param tenant: A tenant.
+        :return: Location of the database of the tenant, one per server and guild.
+        """
+        guild = re.sub(r'[^\w-]', '_', f'{tenant.guild}-{tenant.region}')
+        return os.path.join(self.directory, f'{tenant.server_id}-{guild}.db')
+
+    async def get_session(self):
+        """
+        Provides the client session shared by all tenants, (re)creating it when there is none.
+
+        :return: Pooled aiohttp client session.
+        """
+        if self.session is None or self.session.closed:
+            # As many pooled (keep-alive) connections as there may be requests in flight
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def open(self, tenant):
+        """
+        Opens (and migrates) the database of a tenant on a worker thread and prepares its scraper, unless it is open.
+        Concurrent calls for the same tenant share a single opening.
+
+        :param tenant: Tenant to open.
+        :return: The tenant.
+        """
+        async def run():
+            session = await self.get_session()
+            # Every tenant reads through a single connection, keeping file handles to a few per tenant
+            sage = await self.workers.run(Sage, self.database(tenant), self.cache_size, thread_readers=False)
+            scraper = PA_Scraper(tenant.guild, tenant.region, self.base_url, session=session, limiter=self.limiter)
+            # Continue conditional requests where the previous run left off
+            scraper.validators = await self.workers.run(sage.load_page_validators)
+            tenant.scraper, tenant.sage = scraper, sage
+        if tenant.sage is None:
+            await self.workers.single_flight(('open', tenant.server_id, self.database(tenant)), run)
+        return tenant
+
+    def hasten(self, tenant):
+        """
+        Brings automatic refreshes of a tenant back to the minimum interval, e.g. after a manual update found changes.
+
+        :param tenant: A tenant.
+        """
+        tenant.interval = self.refresh_min_minutes
+        tenant.due = min(tenant.due, monotonic() + self.refresh_min_minutes * 60)
+
+    async def refresh_due(self, refresh, now=None):
+        """
+        Refreshes every tenant with a roster channel whose automatic refresh is due, all at the same time.
+        The interval of a tenant is doubled (up to a maximum) whenever nothing changed or the refresh failed,
+        and reset to the minimum as soon as changes are detected.
+
+        :param refresh: Coroutine function taking an opened tenant, returning its list of roster changes (None if the
+                        guild page did not change).
+        :param now: (Optional) Monotonic moment to schedule from, defaults to now.
+        :return: Dictionary with the server IDs of refreshed tenants as keys and their changes as values.
+        """
+        now = monotonic() if now is None else now
+        due = [tenant for tenant in self.tenants.values() if tenant.roster_channel and tenant.due <= now]
+
+        async def run(tenant):
+            return await refresh(await self.open(tenant))
+        results = await asyncio.gather(*[run(tenant) for tenant in due], return_exceptions=True)
+
+        refreshed = {}
+        for tenant, changes in zip(due, results):
+            if isinstance(changes, Exception):
+                print(f'Automatic roster update of {tenant.guild} failed: {changes!r}')
+                changes = None
+            if changes:
+                tenant.interval = self.refresh_min_minutes
+            else:
+                tenant.interval = min((tenant.interval or self.refresh_min_minutes) * 2, self.refresh_max_minutes)
+            tenant.due = now + tenant.interval * 60
+            refreshed[tenant.server_id] = changes
+        return refreshed
+
+    def stats(self):
+        """
+        :return: Dictionary with the number of tenants, and of those that are opened.
+        """
+        return {'tenants': len(self.tenants), 'open': sum(tenant.sage is not None for tenant in self.tenants.values())}
+
+    async def close_session(self):
+        """ Closes the client session shared by the scrapers of all tenants. """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def close(self):
+        """ Closes the databases of all tenants. """
+        for tenant in self.tenants.values():
+            tenant.close()
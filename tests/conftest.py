@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the bot live in the root of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+"""
+Tests of the content-addressed archive of guild pages and rosters.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from archive import SnapshotArchive
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = SnapshotArchive(str(tmp_path / 'archive'))
+    yield archive
+    archive.close()
+
+
+def roster(names):
+    return [(name, f'https://example.com/{name}') for name in names]
+
+
+def page(names):
+    return '<html><ul>\n' + ''.join(f'<li><a href="https://example.com/{name}">{name}</a></li>\n'
+                                    for name in names) + '</ul></html>'
+
+
+def test_round_trip(archive):
+    data = ''.join(f'line {i}\n' for i in range(5000)).encode() + bytes(range(256)) * 300
+    assert archive.get(archive.put(data)) == data
+    assert archive.get(b'\0' * 32) is None
+
+
+def test_replay(archive):
+    start = datetime(2026, 1, 1)
+    history = [roster(f'Family{i}' for i in range(j, j + 50)) for j in (0, 0, 1, 3)]
+    for idx, members in enumerate(history):
+        archive.store(start + timedelta(hours=idx), page(name for name, _ in members), members)
+    assert list(archive.replay()) == [(start + timedelta(hours=idx), members) for idx, members in enumerate(history)]
+    # Identical snapshots share their objects, and snapshots differing in a few members most of their chunks
+    stats = archive.stats()
+    assert (stats['snapshots'], stats['objects']) == (4, 6)
+    assert stats['pack_bytes'] < stats['archived_bytes'] / 2
+
+
+def test_empty(archive):
+    # An empty roster is stored as an object without chunks, possibly before the pack file holds anything
+    archive.store(datetime(2026, 1, 1), '<html></html>', [])
+    assert archive.get(archive.put(b'')) == b''
+    assert list(archive.replay()) == [(datetime(2026, 1, 1), [])]
+
+
+def test_empty_before_anything_else(archive):
+    assert archive.get(archive.put(b'')) == b''
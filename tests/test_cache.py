@@ -0,0 +1,77 @@
+"""
+Tests of the caches of aliases and pages when lookups and changes run on different threads.
+"""
+
+import threading
+from datetime import datetime
+
+import pytest
+
+from cache import LRUCache
+from sage import Sage
+
+
+@pytest.fixture
+def sage(tmp_path):
+    sage = Sage(str(tmp_path / 'roster.db'))
+    yield sage
+    sage.close()
+
+
+def interleave(sage, lookup, change):
+    """
+    Runs a change on another thread right after a lookup has read the database, but before it caches what it read.
+
+    :param sage: Sage to look up in.
+    :param lookup: Name of the DB_Handler method read by the lookup.
+    :param change: Function making the change.
+    :return: The original method, to restore once the race has been run.
+    """
+    read = getattr(sage.db, lookup)
+
+    def read_then_change(*args):
+        row = read(*args)
+        writer = threading.Thread(target=change)
+        writer.start()
+        writer.join()
+        return row
+
+    setattr(sage.db, lookup, read_then_change)
+    return read
+
+
+def test_put_skipped_after_invalidation():
+    cache = LRUCache()
+    generation = cache.generation
+    cache.invalidate('Alpha')
+    cache.put('Alpha', 'old', generation)
+    assert cache.get('Alpha') == (False, None)
+    cache.put('Alpha', 'new', cache.generation)
+    assert cache.get('Alpha') == (True, 'new')
+
+
+def test_replaced_alias_not_cached(sage):
+    sage.replace_alias('Alpha', 'old_name')
+    read = interleave(sage, 'find_alias', lambda: sage.replace_alias('Alpha', 'new_name'))
+    # The lookup raced the change, so it may answer with the old alias once, but must not keep it
+    assert sage.find_alias('Alpha') == 'old_name'
+    sage.db.find_alias = read
+    assert sage.find_alias('Alpha') == 'new_name'
+
+
+def test_removed_alias_not_cached(sage):
+    sage.replace_alias('Alpha', 'old_name')
+    read = interleave(sage, 'find_alias', lambda: sage.remove_alias('old_name'))
+    sage.find_alias('Alpha')
+    sage.db.find_alias = read
+    assert sage.find_alias('Alpha') is None
+
+
+def test_changed_page_not_cached(sage):
+    sage.compare_guild_members([('Alpha', 'https://example.com/old')], datetime(2026, 1, 1))
+    read = interleave(sage, 'find_page', lambda: sage.compare_guild_members(
+        [('Alpha', 'https://example.com/new')], datetime(2026, 1, 2)))
+    sage.find_page('Alpha')
+    sage.db.find_page = read
+    assert sage.find_page('Alpha') == 'https://example.com/new'
+
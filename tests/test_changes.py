@@ -0,0 +1,41 @@
+"""
+Tests of listing roster changes since a moment, which is cut off rather than silently truncated.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from formatter import Formatter
+from sage import Sage
+
+
+@pytest.fixture
+def sage(tmp_path):
+    sage = Sage(str(tmp_path / 'roster.db'))
+    # Ten families join one per hour
+    start = datetime(2026, 1, 1)
+    for hour in range(10):
+        sage.compare_guild_members([(f'Family{idx}', f'https://example.com/{idx}') for idx in range(hour + 1)],
+                                   start + timedelta(hours=hour))
+    yield sage
+    sage.close()
+
+
+def test_complete(sage):
+    changes, cut_off = sage.changes_since(datetime(2026, 1, 1), limit=10)
+    assert changes == [('joined', f'Family{idx}') for idx in range(10)]
+    assert cut_off is None
+
+
+def test_cut_off(sage):
+    changes, cut_off = sage.changes_since(datetime(2026, 1, 1), limit=4)
+    assert changes == [('joined', f'Family{idx}') for idx in range(4)]
+    assert cut_off == datetime(2026, 1, 1, 3)
+    # Asking for the changes since the cut off continues the list
+    rest, _ = sage.changes_since(cut_off, limit=10)
+    assert rest == [('joined', f'Family{idx}') for idx in range(3, 10)]
+
+    pages = Formatter().format_roster_changes('Guild', datetime(2026, 1, 1), changes, cut_off=cut_off)
+    assert pages[-1].endswith('Only the first 4 changes are listed, up to 2026-01-01 03:00:00. Ask for the changes '
+                              'since then to see more.')
@@ -0,0 +1,25 @@
+"""
+Tests of splitting messages into pages that fit in a Discord message.
+"""
+
+import pytest
+
+from formatter import Formatter, MESSAGE_LIMIT
+
+
+@pytest.mark.parametrize('heading', [None, 'Heading'])
+@pytest.mark.parametrize('lengths', [[10] * 500, [5000], [30, MESSAGE_LIMIT, 30], [MESSAGE_LIMIT - 40] * 3],
+                         ids=['short', 'very long', 'long between short', 'nearly full'])
+def test_pages_fit(heading, lengths):
+    lines = [chr(ord('a') + idx % 26) * length for idx, length in enumerate(lengths)]
+    pages = Formatter().paginate('Title', [(heading, lines)])
+    assert all(len(page) <= MESSAGE_LIMIT for page in pages)
+    # Nothing is lost, long lines are only wrapped
+    assert ''.join(''.join(page.split('```')[1::2]).replace('\n', '') for page in pages) == ''.join(lines)
+
+
+def test_short_lines_kept_whole():
+    lines = [f'line {idx}' for idx in range(400)]
+    pages = Formatter().paginate('Title', [('Heading', lines)])
+    assert len(pages) > 1
+    assert [line for page in pages for line in ''.join(page.split('```')[1::2]).split('\n')] == lines
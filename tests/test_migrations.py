@@ -0,0 +1,34 @@
+"""
+Tests of the schema migrations and the indexes they provide for hot lookups.
+"""
+
+import pytest
+
+from db_handler import DB_Handler
+from migrations import HOT_LOOKUPS, MIGRATIONS
+
+
+@pytest.fixture
+def db(tmp_path):
+    # Fresh database migrated to the latest version
+    handler = DB_Handler(str(tmp_path / 'roster.db'))
+    handler.create_connection()
+    handler.migrate()
+    yield handler
+    handler.close_connection()
+
+
+def test_migrate_to_latest_version(db):
+    assert db.get_schema_version() == MIGRATIONS[-1][0]
+    # Migrating an up to date database is a no-op
+    assert db.migrate() == MIGRATIONS[-1][0]
+
+
+@pytest.mark.parametrize('sql, values', HOT_LOOKUPS, ids=[sql for sql, _ in HOT_LOOKUPS])
+def test_hot_lookup_uses_index(db, sql, values):
+    plan = db.explain(sql, values)
+    assert not any(step.startswith('SCAN') and 'USING' not in step for step in plan), plan
+
+
+def test_no_unindexed_lookups(db):
+    assert db.unindexed_lookups() == {}
@@ -0,0 +1,159 @@
+"""
+Tests of the outbound queue against a fake channel that enforces Discord's rate limits.
+"""
+
+import asyncio
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import discord
+
+from outbox import Outbox, POST
+
+
+def http_exception(status, retry_after=None):
+    """
+    :param status: HTTP status of the failed request.
+    :param retry_after: (Optional) Seconds Discord asks to wait, for 429 responses.
+    :return: Exception as raised by discord.py.
+    """
+    e = discord.HTTPException(SimpleNamespace(status=status, reason='Fake'), 'Refused by the fake channel')
+    if retry_after is not None:
+        e.retry_after = retry_after
+    return e
+
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.deleted = False
+
+    async def delete(self):
+        self.channel.spend('delete')
+        self.deleted = True
+
+
+class FakeChannel:
+    """
+    Channel recording every call made on it, which responds with a 429 when a route exceeds its rate limit.
+    """
+
+    def __init__(self, calls=5, window=1.0, refuse_bulk=False):
+        """
+        :param calls: Number of calls allowed per window on each route.
+        :param window: Length of the window in seconds.
+        :param refuse_bulk: Whether bulk deletions are refused, like for messages older than two weeks.
+        """
+        self.id = 1
+        self.calls = calls
+        self.window = window
+        self.refuse_bulk = refuse_bulk
+        self.made = {}
+        self.log = []
+        self.rate_limited = 0
+
+    def spend(self, route):
+        now = time.monotonic()
+        made = self.made.setdefault(route, deque())
+        while made and made[0] <= now - self.window:
+            made.popleft()
+        if len(made) >= self.calls:
+            self.rate_limited += 1
+            raise http_exception(429, made[0] + self.window - now)
+        made.append(now)
+
+    async def send(self, content, **kwargs):
+        self.spend('send')
+        self.log.append(('send', content))
+        return FakeMessage(self, content)
+
+    async def delete_messages(self, messages):
+        self.spend('delete')
+        if self.refuse_bulk:
+            raise http_exception(400)
+        self.log.append(('bulk delete', len(messages)))
+        for message in messages:
+            message.deleted = True
+
+
+def test_replies_go_before_posts():
+    channel = FakeChannel()
+    ctx = SimpleNamespace(channel=channel, message=None)
+
+    async def run():
+        outbox = Outbox()
+        outbox.send(channel, 'post', merge=False)
+        outbox.reply(ctx, 'reply')
+        await outbox.drain()
+
+    asyncio.run(run())
+    assert channel.log == [('send', 'reply'), ('send', 'post')]
+
+
+def test_consecutive_sends_are_merged():
+    channel = FakeChannel()
+
+    async def run():
+        outbox = Outbox()
+        sent = [outbox.send(channel, f'line {i}') for i in range(3)]
+        # Sends with other arguments are never merged
+        sent.append(outbox.send(channel, 'expiring', delete_after=10))
+        await asyncio.gather(*sent)
+        return outbox
+
+    outbox = asyncio.run(run())
+    assert channel.log == [('send', 'line 0\nline 1\nline 2'), ('send', 'expiring')]
+    assert (outbox.calls, outbox.saved) == (2, 2)
+
+
+def test_refused_bulk_delete_falls_back_to_single_deletes():
+    channel = FakeChannel(refuse_bulk=True)
+    messages = [FakeMessage(channel, f'old {i}') for i in range(3)]
+
+    async def run():
+        outbox = Outbox()
+        await asyncio.gather(*(outbox.delete(message) for message in messages))
+
+    asyncio.run(run())
+    assert all(message.deleted for message in messages)
+
+
+def test_requeued_after_rate_limit():
+    # Discord allows fewer sends than the budget of the outbox
+    channel = FakeChannel(calls=1, window=0.2)
+
+    async def run():
+        outbox = Outbox(budgets={'send': (5, 1.0)})
+        start = time.monotonic()
+        await asyncio.gather(*(outbox.send(channel, f'message {i}', merge=False) for i in range(3)))
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(run())
+    assert channel.rate_limited > 0
+    # Nothing is lost or reordered, and retry_after was respected
+    assert channel.log == [('send', f'message {i}') for i in range(3)]
+    assert elapsed >= 0.35
+
+
+def test_burst_keeps_to_budget():
+    channel = FakeChannel(calls=3, window=0.3)
+    ctx = SimpleNamespace(channel=channel, message=None)
+
+    async def run():
+        # Budget a little stricter than the fake channel, as Discord's clock is not ours
+        outbox = Outbox(budgets={'send': (3, 0.35), 'delete': (3, 0.35)})
+        commands = [FakeMessage(channel, f'!command {i}') for i in range(6)]
+        futures = [outbox.delete(message) for message in commands]
+        futures += [outbox.reply(ctx, f'reply {i}') for i in range(4)]
+        futures += [outbox.send(channel, f'post {i}', priority=POST, merge=False) for i in range(4)]
+        await asyncio.gather(*futures)
+        return commands
+
+    commands = asyncio.run(run())
+    assert channel.rate_limited == 0
+    assert all(message.deleted for message in commands)
+    sent = [content for kind, content in channel.log if kind == 'send']
+    assert sent == [f'reply {i}' for i in range(4)] + [f'post {i}' for i in range(4)]
+    assert ('bulk delete', 6) in channel.log
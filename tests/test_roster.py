@@ -0,0 +1,81 @@
+"""
+Tests that diffing rosters by merging them gives the same changes as a naive diff of dictionaries.
+"""
+
+import random
+
+import pytest
+
+from roster import Roster
+
+RANKS = ('Master', 'Officer', 'Member', 'Apprentice', None)
+
+
+def random_rosters(seed):
+    """
+    Makes an old roster and a newer one with some members joined, left and changed, in a shuffled page order.
+    Long runs of unchanged members alternate with bursts of changes, as in real rosters.
+
+    :param seed: Seed of the random generator, so a failing pair can be reproduced.
+    :return: Tuple of the old and new lists of (name, link, rank) tuples, ranks left out of both half of the time.
+    """
+    rng = random.Random(seed)
+    site = rng.choice(['https://example.com/Profile?profileTarget=', 'https://example.org/family/'])
+    names = rng.sample([f'Family{idx:04}' for idx in range(2000)], rng.randint(0, 400))
+    old = [(name, f'{site}{name}' if rng.random() > 0.05 else None, rng.choice(RANKS)) for name in names]
+    new = []
+    churn = rng.choice([0.0, 0.01, 0.1, 0.5])
+    for name, link, rank in old:
+        if rng.random() < churn:
+            kind = rng.choice(['left', 'link', 'rank'])
+            if kind == 'link':
+                link = f'{site}{name}/{rng.randint(0, 9)}'
+            elif kind == 'rank':
+                rank = rng.choice(RANKS)
+            if kind != 'left':
+                new.append((name, link, rank))
+        else:
+            new.append((name, link, rank))
+    new += [(f'Joined{seed}_{idx}', f'{site}Joined{idx}', rng.choice(RANKS)) for idx in range(rng.randint(0, 20))]
+    rng.shuffle(new)
+    if rng.random() < 0.5:
+        old, new = [member[:2] for member in old], [member[:2] for member in new]
+    return old, new
+
+
+def naive_diff(old, new):
+    """
+    :param old: List of (name, link, optionally rank) tuples.
+    :param new: List of (name, link, optionally rank) tuples.
+    :return: Tuple of the joined names in the order of the new roster, the left names in the order of the old roster
+             and the changed names in the order of the new roster. A missing rank is not a change.
+    """
+    old_members = {member[0]: member for member in old}
+    new_names = {member[0] for member in new}
+    joined = [member[0] for member in new if member[0] not in old_members]
+    left = [member[0] for member in old if member[0] not in new_names]
+    changed = []
+    for name, link, *rank in new:
+        if name in old_members:
+            _, old_link, *old_rank = old_members[name]
+            if link != old_link or (rank and rank[0] is not None and rank[0] != (old_rank or [None])[0]):
+                changed.append(name)
+    return joined, left, changed
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_merge_diff_matches_naive_diff(seed):
+    old, new = random_rosters(seed)
+    old_roster, new_roster = Roster(old), Roster(new)
+    joined, left, changed = new_roster.diff(old_roster)
+    assert ([new_roster.names[index] for index in joined], [old_roster.names[index] for index in left],
+            [new_roster.names[index] for _, index in changed]) == naive_diff(old, new)
+    # Changed members are paired with themselves in the old roster
+    assert all(old_roster.names[old_index] == new_roster.names[index] for old_index, index in changed)
+
+
+def test_unranked_page_keeps_stored_ranks():
+    # A scraped page shows no ranks, which is no change of the ranks stored
+    old = Roster([('Alpha', 'https://example.com/a', 'Master'), ('Beta', 'https://example.com/b', 'Member')])
+    new = Roster([('Alpha', 'https://example.com/a'), ('Beta', 'https://example.com/b2')])
+    assert new.diff(old) == ([], [], [(1, 1)])
@@ -0,0 +1,51 @@
+"""
+Tests that every parser backend extracts the same members from a saved guild profile page as BeautifulSoup did.
+"""
+
+import os
+
+import pytest
+
+from roster_parser import LXML_AVAILABLE, ROSTER_SELECTOR, RosterExtractor, chunked, parse_stream
+
+PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'guild_profile.html')
+
+PROFILE = 'https://www.naeu.playblackdesert.com/en-US/Adventure/Profile?profileTarget='
+
+# Members on the page, in its order: no script, comment, header, footer or anchor outside the selector is included
+MEMBERS = [('Alpha', f'{PROFILE}AbC123%2Bq%3D%3D'), ('Bravo_Two', f'{PROFILE}Zx9%2F%2Bw%3D%3D&region=EU'),
+           ('Charlie', f'{PROFILE}Q1w2e3%3D%3D'), ('Delta', None), ('Écho', f'{PROFILE}Rr7%3D'),
+           ('Foxtrot', f'{PROFILE}Ff6%3D'), ('Golf&Co', f'{PROFILE}Gg5%3D'), ('Hotel', f'{PROFILE}Hh4%3D'),
+           ('india', f'{PROFILE}Ii3%3D'), ('Juliett1', f'{PROFILE}Jj2%3D')]
+
+BACKENDS = [pytest.param('lxml', marks=pytest.mark.skipif(not LXML_AVAILABLE, reason='lxml is not installed')),
+            'stream']
+
+
+@pytest.fixture(scope='module')
+def html():
+    with open(PAGE, encoding='utf-8') as page:
+        return page.read()
+
+
+def test_same_as_beautifulsoup(html):
+    # The original parser, kept as reference
+    bs4 = pytest.importorskip('bs4')
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    assert [(member.text.strip(), member.get('href')) for member in soup.select(ROSTER_SELECTOR)] == MEMBERS
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_from_html(backend, html):
+    assert RosterExtractor(backend).from_html(html) == MEMBERS
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_from_file(backend):
+    assert RosterExtractor(backend).from_file(PAGE) == MEMBERS
+
+
+@pytest.mark.parametrize('size', [1, 7, 64, 1000])
+def test_stream_chunk_boundaries(size, html):
+    # Tags, entities and names cut in two by a chunk boundary are read as if they were not
+    assert parse_stream(chunked(html, size)) == MEMBERS
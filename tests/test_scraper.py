@@ -0,0 +1,107 @@
+"""
+Tests of fetching the guild profile page from a local stand-in server for Pearl Abyss.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from scraper import PA_Scraper
+
+PAGE = '<html><body><p>Guild roster</p></body></html>'
+BACKOFF = 0.05
+
+
+@asynccontextmanager
+async def stand_in(statuses):
+    """
+    Serves the guild profile page on a free local port, answering with the given statuses in turn.
+    Requests carrying the ETag of the page are answered with 304 Not Modified once the statuses run out.
+
+    :param statuses: List of HTTP statuses to answer the first requests with.
+    :return: Context manager yielding a scraper pointed at the server, and the list of (moment, headers) of every
+             request received.
+    """
+    statuses = list(statuses)
+    requests = []
+
+    async def guild_profile(request):
+        requests.append((time.monotonic(), request.headers))
+        status = statuses.pop(0) if statuses else 200
+        if status == 200 and request.headers.get('If-None-Match') == '"v1"':
+            status = 304
+        if status != 200:
+            return web.Response(status=status)
+        return web.Response(text=PAGE, content_type='text/html', headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/en-US/Adventure/Guild/GuildProfile', guild_profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    scraper = PA_Scraper('Guild', 'EU', f'http://127.0.0.1:{runner.addresses[0][1]}', retries=2, backoff=BACKOFF)
+    try:
+        yield scraper, requests
+    finally:
+        await scraper.close()
+        await runner.cleanup()
+
+
+def test_server_errors_retried_with_backoff():
+    async def run():
+        async with stand_in([500, 500, 200]) as (scraper, requests):
+            html, validators = await scraper.fetch()
+            return html, validators, [moment for moment, _ in requests]
+
+    html, validators, moments = asyncio.run(run())
+    assert html == PAGE
+    assert validators['etag'] == '"v1"'
+    assert len(moments) == 3
+    # The delay doubles after every attempt
+    assert moments[1] - moments[0] >= BACKOFF
+    assert moments[2] - moments[1] >= 2 * BACKOFF
+
+
+def test_rate_limit_retried():
+    async def run():
+        async with stand_in([429]) as (scraper, requests):
+            return await scraper.fetch(), len(requests)
+
+    (html, _), attempts = asyncio.run(run())
+    assert (html, attempts) == (PAGE, 2)
+
+
+@pytest.mark.parametrize('statuses, status, attempts', [([404], 404, 1), ([500, 502, 503], 503, 3)],
+                         ids=['not found', 'retries exhausted'])
+def test_failures_raised(statuses, status, attempts):
+    async def run():
+        async with stand_in(statuses) as (scraper, requests):
+            with pytest.raises(aiohttp.ClientResponseError) as raised:
+                await scraper.fetch()
+            return raised.value.status, len(requests)
+
+    assert asyncio.run(run()) == (status, attempts)
+
+
+def test_not_modified():
+    async def run():
+        async with stand_in([]) as (scraper, requests):
+            _, scraper.validators = await scraper.fetch()
+            return await scraper.fetch(), requests[-1][1].get('If-None-Match')
+
+    assert asyncio.run(run()) == (None, '"v1"')
+
+
+def test_same_body_without_validators():
+    async def run():
+        async with stand_in([]) as (scraper, _):
+            _, validators = await scraper.fetch()
+            # Only the hash of the body is known, as for a server without validator support
+            scraper.validators = {'etag': None, 'last_modified': None, 'body_hash': validators['body_hash']}
+            return await scraper.fetch()
+
+    assert asyncio.run(run()) is None
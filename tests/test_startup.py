@@ -0,0 +1,48 @@
+"""
+Tests that importing the bot stays cheap and free of side effects, as measured by the startup benchmark.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# Seconds importing the bot may take in a fresh interpreter, generous to keep slow machines from failing
+IMPORT_BUDGET = 10.0
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import json
+from time import perf_counter
+import discord
+
+# Record any attempt to connect instead of connecting
+runs = []
+discord.Client.run = lambda self, *args, **kwargs: runs.append('run')
+discord.Client.start = lambda self, *args, **kwargs: runs.append('start')
+
+started = perf_counter()
+import roster_bot
+imported = perf_counter() - started
+print(json.dumps({'import': imported, 'runs': runs, 'sage': roster_bot.sage is not None,
+                  'scraper': roster_bot.scraper is not None}))
+"""
+
+
+def test_import_has_no_side_effects(tmp_path):
+    db_file = tmp_path / 'roster.db'
+    env = {**os.environ, 'DISCORD_TOKEN': 'test', 'ADMIN_IDS': '0', 'PERMITTED_ROLE_IDS': '0',
+           'SERVICED_CHANNELS': 'roster', 'GUILD_NAME': 'Test', 'REGION': 'EU', 'DB': str(db_file),
+           'PYTHONPATH': os.pathsep.join(filter(None, [REPO, os.environ.get('PYTHONPATH')]))}
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], env=env, cwd=tmp_path, capture_output=True,
+                            text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+
+    # Nothing is configured, opened or connected until main is called
+    assert result['runs'] == []
+    assert not result['sage']
+    assert not result['scraper']
+    assert not db_file.exists()
+    assert list(tmp_path.iterdir()) == []
+    assert result['import'] < IMPORT_BUDGET
@@ -0,0 +1,36 @@
+"""
+Tests that the roster remembered between diffs is read again once another connection changed the database.
+"""
+
+from datetime import datetime
+
+from db_handler import DB_Handler
+from sage import Sage
+
+
+def test_write_by_other_connection_seen(tmp_path):
+    db_file = str(tmp_path / 'roster.db')
+    sage = Sage(db_file)
+    moment = datetime(2026, 1, 1)
+    sage.compare_guild_members([('Alpha', 'https://example.com/a')], moment)
+
+    # Another process adds a member within the same second as the last update
+    other = DB_Handler(db_file)
+    other.create_connection()
+    other.apply_roster_changes([('Beta', None, 'https://example.com/b')], [], [], [('Beta', 'joined', None, None)],
+                               moment)
+    other.close_connection()
+
+    # The remembered roster is outdated, so Beta is not reported to join again
+    assert sage.compare_guild_members([('Alpha', 'https://example.com/a'), ('Beta', 'https://example.com/b')],
+                                      moment) == []
+    sage.close()
+
+
+def test_own_writes_keep_roster(tmp_path):
+    sage = Sage(str(tmp_path / 'roster.db'))
+    sage.compare_guild_members([('Alpha', 'https://example.com/a')], datetime(2026, 1, 1))
+    remembered = sage.stored_roster[1]
+    sage.replace_alias('Alpha', 'alpha')
+    assert sage.stored_members() is remembered
+    sage.close()
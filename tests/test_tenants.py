@@ -0,0 +1,56 @@
+"""
+Tests of the registry of tenants, changed on the event loop while refreshes run on worker threads.
+"""
+
+import asyncio
+
+import pytest
+
+from sage import Sage
+from tenants import Tenant, Tenants
+from workers import Workers
+
+
+@pytest.fixture
+def registry(tmp_path):
+    sage = Sage(str(tmp_path / 'registry.db'))
+    workers = Workers()
+    yield sage.db, tmp_path / 'tenants', workers
+    workers.shutdown()
+    sage.close()
+
+
+def test_retired_tenant_closed_after_refresh_in_flight(registry):
+    db, directory, workers = registry
+
+    async def run():
+        tenants = Tenants(db, str(directory), workers)
+        tenant = await tenants.configure(Tenant(1, 'Old', 'EU', roster_channel=1))
+        await tenants.open(tenant)
+        refreshing = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def refresh():
+            refreshing.set()
+            await finish.wait()
+            # Still open while the refresh is in flight
+            return await workers.run(tenant.sage.latest_update)
+        flight = asyncio.ensure_future(workers.single_flight(tenant.refresh_key, refresh))
+        await refreshing.wait()
+
+        # Following another guild replaces the tenant in the registry at once, but closes it only after the refresh
+        configuring = asyncio.ensure_future(tenants.configure(Tenant(1, 'New', 'EU', roster_channel=1)))
+        await asyncio.sleep(0.05)
+        assert tenants.get(1).guild == 'New'
+        assert tenant.sage is not None
+        finish.set()
+        await flight
+        await configuring
+        assert tenant.sage is None
+
+        assert (await tenants.remove(1)).guild == 'New'
+        assert tenants.get(1) is None
+        assert db.get_tenants() == []
+        await tenants.close_session()
+
+    asyncio.run(run())
@@ -0,0 +1,96 @@
+"""
+Tests that the incrementally maintained tenure aggregates always match a full recomputation from the log.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from sage import Sage
+
+SEEDS = range(30)
+
+
+def history(seed, steps=40):
+    """
+    Generates a random history of rosters, with families joining and leaving at irregular intervals.
+
+    :param seed: Seed of the random generator, so a failing history can be reproduced.
+    :param steps: Number of rosters in the history.
+    :return: Generator of (timestamp, roster) tuples, roster being a list of (family, page) tuples.
+    """
+    rng = random.Random(seed)
+    pool = [f'Family{i}' for i in range(60)]
+    members = set(rng.sample(pool, 20))
+    timestamp = datetime(2026, 1, 1, 10, 0) + timedelta(seconds=rng.randint(0, 10 ** 6))
+    for _ in range(steps):
+        # Toggle membership of a few families, which may rejoin later on
+        for family in rng.sample(pool, rng.randint(0, 6)):
+            members ^= {family}
+        timestamp += timedelta(seconds=rng.randint(60, 5 * 86400))
+        yield timestamp, [(family, f'https://example.com/{family}/{rng.randint(0, 2)}') for family in sorted(members)]
+
+
+@pytest.fixture
+def open_sage(tmp_path):
+    # Opens sages on database files in a temporary directory, and closes them afterwards
+    opened = []
+
+    def open_sage(name='roster.db'):
+        sage = Sage(str(tmp_path / name))
+        opened.append(sage)
+        return sage
+
+    yield open_sage
+    for sage in opened:
+        sage.close()
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_incremental_updates(open_sage, seed):
+    sage = open_sage()
+    for timestamp, roster in history(seed):
+        sage.compare_guild_members(roster, timestamp)
+    assert sage.verify_tenure_aggregates() == []
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_replayed_rosters(open_sage, seed):
+    sage = open_sage()
+    list(sage.replay_rosters(history(seed)))
+    assert sage.verify_tenure_aggregates() == []
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_backfilled_by_migration(open_sage, seed):
+    rosters = list(history(seed))
+    sage = open_sage()
+    for timestamp, roster in rosters[:25]:
+        sage.compare_guild_members(roster, timestamp)
+    # Return to the schema before the aggregates were introduced, so the migration backfills them from the log
+    sage.db.connection.executescript("""
+        DROP TABLE roster_churn;
+        DROP TABLE member_tenure;
+        DROP TABLE tenure_totals;
+        DELETE FROM roster_status WHERE variable = 'tenure_origin';
+        UPDATE roster_status SET value = '7' WHERE variable = 'schema_version';
+    """)
+    sage.close()
+
+    sage = open_sage()
+    assert sage.verify_tenure_aggregates() == []
+    # Updates after the migration continue from the backfilled aggregates
+    for timestamp, roster in rosters[25:]:
+        sage.compare_guild_members(roster, timestamp)
+    assert sage.verify_tenure_aggregates() == []
+
+
+def test_repair(open_sage):
+    sage = open_sage()
+    for timestamp, roster in history(0):
+        sage.compare_guild_members(roster, timestamp)
+    sage.db.execute_commit("UPDATE roster_churn SET joins = joins + 1")
+    sage.db.execute_commit("DELETE FROM member_tenure WHERE family = (SELECT MIN(family) FROM member_tenure)")
+    assert sage.verify_tenure_aggregates(repair=True) != []
+    assert sage.verify_tenure_aggregates() == []
@@ -0,0 +1,48 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+class Workers:
+    """
+    Runs blocking work (parsing, database writes, rendering) away from the event loop,
+    and coalesces concurrent requests for the same work into a single run.
+    """
+
+    def __init__(self, max_workers=2):
+        """
+        :param max_workers: Number of threads to run blocking work on.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='roster-worker')
+        # Runs in progress by key
+        self.flights = {}
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs a blocking function on a worker thread, leaving the event loop free for other commands.
+
+        :param func: Function to run.
+        :param args: Positional arguments of the function.
+        :param kwargs: Keyword arguments of the function.
+        :return: Result of the function.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def single_flight(self, key, factory):
+        """
+        Runs a coroutine unless one with the same key is already running, in which case its result is shared.
+        Cancelling one of the callers does not cancel the run for the others.
+
+        :param key: Identifies the work, e.g. 'roster'.
+        :param factory: Function without arguments creating the coroutine to run.
+        :return: Result of the (shared) run. Exceptions are raised to every caller.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(factory())
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+        return await asyncio.shield(flight)
+
+    def shutdown(self):
+        """ Stops the worker threads once their current work is done. """
+        self.executor.shutdown(wait=True)